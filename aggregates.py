@@ -0,0 +1,100 @@
+import datetime
+import heapq
+import threading
+from collections import defaultdict
+
+# Date formats receipts may carry, most common first
+DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d", "%m/%d/%Y", "%d/%m/%Y"]
+
+def parse_date(value):
+    """Parse an expense date string, returning None if no known format matches"""
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+def period_keys(day):
+    """Return the day, ISO week and month keys a date rolls up into"""
+    iso_year, iso_week, _ = day.isocalendar()
+    return {
+        "day": day.isoformat(),
+        "week": f"{iso_year}-W{iso_week:02d}",
+        "month": f"{day.year}-{day.month:02d}"
+    }
+
+class SpendingAggregates:
+    """Running spending totals maintained incrementally as expenses arrive
+
+    Keeps the overall total, per-category sums, per-day/week/month rollups
+    and the ``recent_limit`` most recent expenses (a bounded min-heap keyed
+    on date), so a summary can be built without rescanning history.
+    """
+
+    def __init__(self, recent_limit=5):
+        self.recent_limit = recent_limit
+        self.total = 0.0
+        self.count = 0
+        self.by_category = defaultdict(float)
+        self.rollups = {
+            "day": defaultdict(lambda: defaultdict(float)),
+            "week": defaultdict(lambda: defaultdict(float)),
+            "month": defaultdict(lambda: defaultdict(float))
+        }
+        self.position = 0
+        self.version = 0
+        self.category_versions = defaultdict(int)
+        self._recent = []
+        self._lock = threading.RLock()
+
+    def add(self, expense):
+        """Fold a single expense into the aggregates"""
+        amount = float(expense["amount"])
+        category = expense["category"]
+        with self._lock:
+            self.total += amount
+            self.count += 1
+            self.by_category[category] += amount
+            self.version += 1
+            self.category_versions[category] += 1
+
+            day = parse_date(expense["date"])
+            if day is None:
+                return
+            for period, key in period_keys(day).items():
+                self.rollups[period][key][category] += amount
+
+            # Ties on date keep the later insert, matching "most recent"
+            entry = (day.toordinal(), self.count, expense)
+            if len(self._recent) < self.recent_limit:
+                heapq.heappush(self._recent, entry)
+            elif entry[:2] > self._recent[0][:2]:
+                heapq.heapreplace(self._recent, entry)
+
+    def catch_up(self, store):
+        """Apply expenses written to the store since the last catch-up
+
+        Other worker processes write to the same store, so this is how each
+        process picks up their inserts. It costs one indexed query when
+        nothing is new.
+        """
+        with self._lock:
+            while True:
+                expenses, position = store.changes_since(self.position)
+                if not expenses:
+                    return
+                for expense in expenses:
+                    self.add(expense)
+                self.position = position
+
+    def recent(self):
+        """Return the most recent expenses, newest first"""
+        with self._lock:
+            return [expense for _, _, expense in sorted(self._recent, reverse=True)]
+
+    def period_total(self, period, key):
+        """Return (total, by_category) for one day/week/month key"""
+        with self._lock:
+            by_category = dict(self.rollups[period].get(key, {}))
+        return sum(by_category.values()), by_category
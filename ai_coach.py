@@ -1,44 +1,245 @@
-from dotenv import load_dotenv
 import os
+import io
+import csv
+import copy
+import json
+import base64
+import re
+import hashlib
+import uuid
+import time
+import datetime
+import zipfile
+import shutil
+import tempfile
+import functools
+from dotenv import load_dotenv
+from flask import Blueprint, Flask, Response, Request, current_app, g, has_request_context, request, jsonify, render_template, redirect, url_for, stream_with_context
+from cache import LRUCache, SQLiteCache, TieredCache, stream_content_key
+from category_index import CategoryIndex
+from dedup import DuplicateIndex, DuplicateReceipt, dhash
+from local_classifier import LocalTier
+from pipeline import ReceiptPipeline
+from storage import DEFAULT_USER, EXPENSE_FIELDS, create_store, parse_shard_list
+from tenants import TenantRegistry
+from snapshots import SnapshotStore, previous_key
+from aggregates import parse_date, period_keys
+from jobs import JobQueue, RetryLater
+from clients import ClientManager
+from resilience import AdaptiveRateLimiter, BackendUnavailable, CircuitBreaker, ServiceGuard
+from metrics import Metrics, TraceLog
+from prompts import PromptSavings, estimate_tokens, fit_lines, salient_lines, truncate
+from images import downscale_for_ocr, spool_copy, stream_size
+from receipt_parser import extract_receipt_data
 
-load_dotenv()  # loads variables from .env file into environment
+# Load .env before any of the settings below are read
+load_dotenv()
 
-access_key = os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID")
-access_secret = os.getenv("ALIBABA_CLOUD_ACCESS_KEY_SECRET")
-dashscope_key = os.getenv("DASHSCOPE_API_KEY")
+# Uploads stay in memory up to this size and only spill to a temp file above it
+UPLOAD_SPOOL_MAX_BYTES = int(os.environ.get('UPLOAD_SPOOL_MAX_BYTES', 8 * 1024 * 1024))
 
-print(access_key, access_secret, dashscope_key)  # just to test if loaded properly
+class SpooledRequest(Request):
+    """Request that buffers uploaded files in a spooled temporary file"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES)
 
-import os
-import json
-import uuid
-import datetime
-from flask import Flask, request, jsonify, render_template, redirect, url_for
-import pandas as pd
-from alibabacloud_ocr_api20210707.client import Client as OcrClient
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_ocr_api20210707 import models as ocr_models
-import dashscope
-from dashscope.aigc.generation import Generation
+bp = Blueprint('coach', __name__)
+
+# Per-stage latency histograms and counters, served at /metrics
+METRICS = Metrics()
+# Optional JSON-lines trace of each request's stages ("-" for stdout)
+TRACES = TraceLog(os.environ.get('TRACE_LOG') or None)
+
+@bp.before_app_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    g.trace = TRACES.start(method=request.method, path=request.path)
+
+@bp.after_app_request
+def record_request_timing(response):
+    METRICS.observe(
+        'http_request_seconds',
+        time.perf_counter() - g.request_start,
+        endpoint=request.endpoint or 'unknown',
+        method=request.method,
+        status=response.status_code
+    )
+    g.status = response.status_code
+    return response
+
+@bp.teardown_app_request
+def finish_request_trace(error=None):
+    TRACES.finish(g.pop('trace', None), endpoint=request.endpoint, status=g.pop('status', 500))
+
+# Users are split across this many storage shards by a hash of their id
+EXPENSE_SHARDS = int(os.environ.get('EXPENSE_SHARDS', 1))
+
+# Storage for receipts and expenses, shared by every worker process. A node
+# only opens the shards in NODE_SHARDS (e.g. "0-3"), so nodes can split users
+STORE = create_store(
+    backend=os.environ.get('EXPENSE_STORE', 'sqlite'),
+    path=os.environ.get('EXPENSE_DB_PATH', 'data/expenses.db'),
+    pool_size=int(os.environ.get('EXPENSE_DB_POOL_SIZE', 8)),
+    shards=EXPENSE_SHARDS,
+    owned_shards=parse_shard_list(os.environ.get('NODE_SHARDS'), EXPENSE_SHARDS)
+)
 
-app = Flask(__name__)
+# Per-user store views and running spending totals for the AI coach
+TENANTS = TenantRegistry(STORE, max_tenants=int(os.environ.get('TENANT_CACHE_SIZE', 1000)))
 
-# Mock database for storing receipts and expenses
-RECEIPTS_DB = []
-EXPENSES_DB = []
+# Per-period spending rollups for the dashboard and the coach, refreshed by a
+# background job at most once per SNAPSHOT_REFRESH_DELAY seconds after uploads
+SNAPSHOTS = SnapshotStore(
+    None if os.environ.get('EXPENSE_STORE', 'sqlite') == 'memory'
+    else os.environ.get('SNAPSHOT_DB_PATH', 'data/snapshots.db') or None,
+    top_merchants=int(os.environ.get('SNAPSHOT_TOP_MERCHANTS', 5))
+)
+SNAPSHOT_REFRESH_DELAY = float(os.environ.get('SNAPSHOT_REFRESH_DELAY', 5))
+
+# Requests name their user in this header; without it they act as DEFAULT_USER
+USER_HEADER = 'X-User-Id'
+USER_ID_PATTERN = re.compile(r'[A-Za-z0-9_.@-]{1,64}')
+
+class UserRejected(Exception):
+    """Raised for a user id this node cannot serve, with the JSON error and status to return"""
+    
+    def __init__(self, body, status):
+        super().__init__(body["error"])
+        self.body = body
+        self.status = status
+
+def resolve_tenant(user_id):
+    """Return the Tenant for ``user_id``, raising UserRejected if it is invalid or not ours
+    
+    Users whose shard lives on another node get 421 Misdirected Request
+    with the shard number, so a router can retry on the right node.
+    """
+    if not USER_ID_PATTERN.fullmatch(user_id):
+        raise UserRejected({"error": f"{USER_HEADER} must be 1-64 letters, digits or _.@-"}, 400)
+    if not TENANTS.owns(user_id):
+        raise UserRejected({
+            "error": "This user's data is served by another node",
+            "shard": TENANTS.shard_for(user_id)
+        }, 421)
+    return TENANTS.get(user_id)
+
+def user_scoped(view):
+    """Resolve the request's user into ``g.tenant`` before running the view"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            g.tenant = resolve_tenant(request.headers.get(USER_HEADER, DEFAULT_USER))
+        except UserRejected as e:
+            return jsonify(e.body), e.status
+        return view(*args, **kwargs)
+    return wrapper
 
 # Configure Alibaba Cloud credentials
 def create_ocr_client():
     """Create and return an Alibaba Cloud OCR client"""
+    # The OCR SDK is slow to import, so it is loaded with the first client
+    from alibabacloud_ocr_api20210707.client import Client as OcrClient
+    from alibabacloud_tea_openapi import models as open_api_models
+    
     config = open_api_models.Config(
         access_key_id=os.environ.get('ALIBABA_CLOUD_ACCESS_KEY_ID'),
         access_key_secret=os.environ.get('ALIBABA_CLOUD_ACCESS_KEY_SECRET')
     )
     config.endpoint = 'ocr-api.cn-hangzhou.aliyuncs.com'
+    config.connect_timeout = int(os.environ.get('OCR_CONNECT_TIMEOUT_MS', 5000))
+    config.read_timeout = int(os.environ.get('OCR_READ_TIMEOUT_MS', 15000))
+    config.max_idle_conns = int(os.environ.get('OCR_MAX_IDLE_CONNS', 4))
     return OcrClient(config)
 
-# Configure DashScope
-dashscope.api_key = os.environ.get('DASHSCOPE_API_KEY')
+def build_ocr_request(body):
+    """Wrap an image body in a RecognizeReceipt request"""
+    from alibabacloud_ocr_api20210707 import models as ocr_models
+    return ocr_models.RecognizeReceiptRequest(body=body)
+
+def call_generation(**kwargs):
+    """Call DashScope Generation, importing the SDK on first use"""
+    import dashscope
+    from dashscope.aigc.generation import Generation
+    
+    if dashscope.api_key is None:
+        dashscope.api_key = os.environ.get('DASHSCOPE_API_KEY')
+    return Generation.call(**kwargs)
+
+# Calls per second allowed to each API (0 for no limit); the rate halves when
+# the API throttles us and climbs back as calls succeed
+OCR_RATE_LIMIT = float(os.environ.get('OCR_RATE_LIMIT', 10))
+GENERATION_RATE_LIMIT = float(os.environ.get('GENERATION_RATE_LIMIT', 10))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 2))
+# Failed calls in a row before an API's circuit opens (0 to disable), and how
+# long it stays open before a trial call
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', 30))
+
+def create_guard(service, rate):
+    """Rate limiter and circuit breaker for one API"""
+    return ServiceGuard(
+        service,
+        limiter=AdaptiveRateLimiter(rate, max_wait=RATE_LIMIT_MAX_WAIT) if rate > 0 else None,
+        breaker=CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS) if CIRCUIT_FAILURE_THRESHOLD > 0 else None
+    )
+
+# Shared, pooled OCR and generation clients used by every request
+CLIENTS = ClientManager(
+    ocr_factory=create_ocr_client,
+    generation_call=call_generation,
+    ocr_pool_size=int(os.environ.get('OCR_POOL_SIZE', 4)),
+    generation_pool_size=int(os.environ.get('GENERATION_POOL_SIZE', 8)),
+    max_retries=int(os.environ.get('CLIENT_MAX_RETRIES', 3)),
+    backoff_base=float(os.environ.get('CLIENT_BACKOFF_BASE', 0.5)),
+    pool_timeout=float(os.environ.get('OCR_POOL_TIMEOUT', 30)),
+    metrics=METRICS,
+    guards={
+        "ocr": create_guard("ocr", OCR_RATE_LIMIT),
+        "dashscope": create_guard("dashscope", GENERATION_RATE_LIMIT)
+    }
+)
+
+# Cache of parsed OCR results, keyed by a hash of the image bytes
+def create_ocr_cache():
+    """Create the OCR result cache, optionally backed by SQLite on disk"""
+    ttl = float(os.environ.get('OCR_CACHE_TTL', 0)) or None
+    memory = LRUCache(
+        max_entries=int(os.environ.get('OCR_CACHE_SIZE', 1024)),
+        ttl=ttl
+    )
+    disk = None
+    cache_path = os.environ.get('OCR_CACHE_PATH')
+    if cache_path:
+        disk = SQLiteCache(
+            cache_path,
+            max_entries=int(os.environ.get('OCR_CACHE_DISK_SIZE', 100000)),
+            ttl=ttl
+        )
+    return TieredCache(memory, disk)
+
+OCR_CACHE = create_ocr_cache()
+
+# Merchant -> category index consulted before calling DashScope
+CATEGORY_INDEX = CategoryIndex(
+    path=os.environ.get('CATEGORY_INDEX_PATH', 'data/category_index.db') or None,
+    min_observations=int(os.environ.get('CATEGORY_INDEX_MIN_OBSERVATIONS', 2)),
+    min_confidence=float(os.environ.get('CATEGORY_INDEX_MIN_CONFIDENCE', 0.8))
+)
+
+# Fingerprints of stored receipts, used to turn away repeat uploads
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', '1') == '1'
+DUPLICATES = DuplicateIndex(
+    path=os.environ.get('DEDUP_DB_PATH', 'data/dedup.db') or None,
+    image_distance=int(os.environ.get('DEDUP_IMAGE_DISTANCE', 4)),
+    text_similarity=float(os.environ.get('DEDUP_TEXT_SIMILARITY', 0.85))
+)
+
+# Local classifier tried after the index; predictions below the threshold go to DashScope
+LOCAL_CLASSIFIER = LocalTier(
+    path=os.environ.get('LOCAL_CLASSIFIER_PATH', 'data/local_classifier.json'),
+    threshold=float(os.environ.get('LOCAL_CLASSIFIER_THRESHOLD', 0.85))
+)
 
 # Categories for expenses
 CATEGORIES = [
@@ -46,161 +247,464 @@ CATEGORIES = [
     "Shopping", "Utilities", "Healthcare", "Travel", "Other"
 ]
 
-@app.route('/')
+@bp.route('/')
 def index():
     """Render the main application page"""
     return render_template('index.html', categories=CATEGORIES)
 
-@app.route('/upload', methods=['POST'])
+@bp.route('/upload', methods=['POST'])
+@user_scoped
 def upload_receipt():
     """Handle receipt upload and OCR processing"""
-    if 'receipt' not in request.files:
+    # Reading the multipart body spools the upload
+    with METRICS.stage('receive'):
+        files = request.files
+    if 'receipt' not in files:
         return jsonify({"error": "No receipt file uploaded"}), 400
     
-    receipt_file = request.files['receipt']
+    receipt_file = files['receipt']
     if receipt_file.filename == '':
         return jsonify({"error": "No file selected"}), 400
     
-    # Save the uploaded file temporarily
-    temp_path = f"/tmp/{uuid.uuid4()}.jpg"
-    receipt_file.save(temp_path)
+    # Receipts that match one already stored are rejected unless allow_duplicate is set
+    allow_duplicate = request.args.get('allow_duplicate') in ('1', 'true')
+    if request.args.get('async') in ('1', 'true'):
+        return queue_receipt(receipt_file, allow_duplicate)
     
+    # Process the receipt straight from the upload buffer
+    body, status = upload_result(receipt_file.stream, g.tenant.user_id, allow_duplicate)
+    with METRICS.stage('serialize'):
+        return jsonify(body), status
+
+def upload_result(image, user_id, allow_duplicate=False):
+    """Ingest one uploaded image, returning the /upload JSON body and status"""
     try:
-        # Process the receipt with OCR
-        extracted_data = process_receipt_with_ocr(temp_path)
-        
-        # Create receipt and expense records
-        receipt_id = str(uuid.uuid4())
-        receipt_data = {
-            "id": receipt_id,
-            "date": extracted_data.get("date", datetime.datetime.now().strftime("%Y-%m-%d")),
-            "merchant": extracted_data.get("merchant", "Unknown"),
-            "total_amount": extracted_data.get("total_amount", 0.0),
-            "items": extracted_data.get("items", []),
-            "raw_text": extracted_data.get("raw_text", "")
-        }
-        
-        # Auto-categorize the expense
-        category = categorize_expense(receipt_data)
-        
-        # Create expense record
-        expense = {
-            "id": str(uuid.uuid4()),
-            "receipt_id": receipt_id,
-            "date": receipt_data["date"],
-            "merchant": receipt_data["merchant"],
-            "amount": receipt_data["total_amount"],
-            "category": category
-        }
-        
-        # Save to our mock database
-        RECEIPTS_DB.append(receipt_data)
-        EXPENSES_DB.append(expense)
-        
-        # Clean up
-        os.remove(temp_path)
-        
-        return jsonify({
+        receipt_data, expense = ingest_receipt(image, user_id, allow_duplicate)
+        return {
             "status": "success",
             "receipt": receipt_data,
             "expense": expense
-        })
-        
+        }, 200
+    except DuplicateReceipt as e:
+        return {"error": str(e), "duplicate_of": e.match}, 409
+    except BackendUnavailable as e:
+        # OCR is down or shedding load: keep the receipt and process it once it recovers
+        job_id = spool_receipt_job(image, user_id, allow_duplicate, delay=e.retry_after)
+        return {
+            "status": "queued",
+            "job_id": job_id,
+            "status_url": job_status_url(job_id),
+            "error": str(e)
+        }, 202
     except Exception as e:
-        # Clean up on error
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
 
-def process_receipt_with_ocr(image_path):
-    """Process a receipt image with Alibaba Cloud OCR"""
-    client = create_ocr_client()
+def ingest_receipt(image, user_id, allow_duplicate=False):
+    """OCR, categorize and save one receipt image, raising DuplicateReceipt for repeats
     
-    with open(image_path, 'rb') as f:
-        image_bytes = f.read()
+    The photo and the extracted fields are checked before categorization,
+    so a repeat upload costs no LLM call.
+    """
+    image_hash = fingerprint_image(image)
+    receipt_data = build_receipt(process_receipt_image(image), user_id, image_hash)
+    if not allow_duplicate:
+        check_duplicate_receipt(receipt_data)
     
-    request = ocr_models.RecognizeReceiptRequest(
-        body=image_bytes
-    )
+    # Auto-categorize the expense
+    category, degraded = categorize_expense(receipt_data)
+    expense = record_expense(receipt_data, category, allow_duplicate, degraded)
+    return receipt_data, expense
+
+def fingerprint_image(image):
+    """Return the perceptual hash of a receipt photo, or None
+    
+    Photos of different receipts from one till can hash alike, so the hash
+    is only a hint that check_duplicate_receipt confirms after OCR.
+    """
+    if not DEDUP_ENABLED:
+        return None
+    with METRICS.stage('dedup'):
+        return dhash(image)
+
+def check_duplicate_receipt(receipt_data):
+    """Raise DuplicateReceipt if OCR results match a receipt the user already stored"""
+    if not DEDUP_ENABLED:
+        return
+    image_hash = receipt_data.get("image_hash")
+    with METRICS.stage('dedup'):
+        match = DUPLICATES.check_receipt(
+            receipt_data["user_id"], receipt_data, int(image_hash, 16) if image_hash else None
+        )
+    if match is not None:
+        raise DuplicateReceipt(match)
+
+# Directory where uploads wait for the job queue; it must survive restarts
+JOB_SPOOL_DIR = os.environ.get('JOB_SPOOL_DIR', 'data/uploads')
+
+def queue_receipt(receipt_file, allow_duplicate=False):
+    """Save an upload and queue it for background processing"""
+    callback_url = request.form.get('callback_url')
+    if callback_url:
+        try:
+            JOB_QUEUE.check_callback(callback_url)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    
+    job_id = spool_receipt_job(receipt_file.stream, g.tenant.user_id, allow_duplicate, callback_url)
+    return jsonify({
+        "status": "queued",
+        "job_id": job_id,
+        "status_url": job_status_url(job_id)
+    }), 202
+
+def spool_receipt_job(image, user_id, allow_duplicate=False, callback_url=None, delay=0):
+    """Save a receipt image to the spool directory and queue a job to process it"""
+    os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+    image_path = os.path.join(JOB_SPOOL_DIR, f"{uuid.uuid4()}.jpg")
+    image.seek(0)
+    with open(image_path, 'wb') as f:
+        shutil.copyfileobj(image, f)
+    
+    payload = {"image_path": image_path, "user_id": user_id, "allow_duplicate": allow_duplicate}
+    return JOB_QUEUE.submit('receipt', payload, callback_url=callback_url, delay=delay)
+
+def job_status_url(job_id):
+    # Outside a Flask request (the ASGI routes) the app is served from the root
+    if has_request_context():
+        return url_for('coach.get_job', job_id=job_id)
+    return f"/jobs/{job_id}"
+
+def process_receipt_job(payload):
+    """Job handler: OCR, categorize and save a spooled receipt image"""
+    image_path = payload["image_path"]
+    # Failed attempts keep the image for the next one; discard_receipt_job
+    # removes it once the job has failed for good
+    keep_image = True
+    try:
+        with open(image_path, 'rb') as image:
+            # Jobs queued before receipts had owners belong to the default user
+            receipt_data, expense = ingest_receipt(
+                image, payload.get("user_id", DEFAULT_USER), payload.get("allow_duplicate", False)
+            )
+        keep_image = False
+        return {"receipt": receipt_data, "expense": expense}
+    except DuplicateReceipt as e:
+        # Not worth retrying: the job finishes and reports what it matched
+        keep_image = False
+        return {"status": "duplicate", "duplicate_of": e.match}
+    except BackendUnavailable as e:
+        raise RetryLater(e.retry_after, str(e))
+    finally:
+        if not keep_image:
+            os.remove(image_path)
+
+def discard_receipt_job(payload):
+    """Remove the spooled image of a receipt job that has failed its last attempt"""
+    if os.path.exists(payload["image_path"]):
+        os.remove(payload["image_path"])
+
+@bp.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Return the status of a background job
     
+    Pass ``wait=<seconds>`` to long-poll until the job finishes.
+    """
     try:
-        response = client.recognize_receipt(request)
-        result = response.body.to_map()
+        wait = min(float(request.args.get('wait', 0)), 60)
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+    
+    job = JOB_QUEUE.wait(job_id, wait) if wait > 0 else JOB_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+def build_receipt(extracted_data, user_id=DEFAULT_USER, image_hash=None):
+    """Create a receipt record for ``user_id`` from the data extracted by OCR"""
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "image_hash": None if image_hash is None else f"{image_hash:016x}",
+        "date": extracted_data.get("date", datetime.datetime.now().strftime("%Y-%m-%d")),
+        "merchant": extracted_data.get("merchant", "Unknown"),
+        "total_amount": extracted_data.get("total_amount", 0.0),
+        "currency": extracted_data.get("currency"),
+        "items": extracted_data.get("items", []),
+        "raw_text": extracted_data.get("raw_text", "")
+    }
+
+def record_expense(receipt_data, category, allow_duplicate=False, degraded=False):
+    """Create the expense for a categorized receipt and save both records
+    
+    ``degraded`` marks a category from fallback_category, which the local
+    classifier is not trained on. Raises DuplicateReceipt, without saving,
+    if a matching receipt was stored since the upload was checked.
+    """
+    tenant = TENANTS.get(receipt_data["user_id"])
+    if DEDUP_ENABLED:
+        image_hash = receipt_data.get("image_hash")
+        match = DUPLICATES.claim(
+            tenant.user_id, receipt_data,
+            image_hash=int(image_hash, 16) if image_hash else None,
+            force=allow_duplicate
+        )
+        if match is not None:
+            raise DuplicateReceipt(match)
+    expense = {
+        "id": str(uuid.uuid4()),
+        "receipt_id": receipt_data["id"],
+        "user_id": tenant.user_id,
+        "date": receipt_data["date"],
+        "merchant": receipt_data["merchant"],
+        "amount": receipt_data["total_amount"],
+        "category": category,
+        "degraded": degraded
+    }
+    
+    with METRICS.stage('store'):
+        try:
+            tenant.store.add(receipt_data, expense)
+        except Exception:
+            # Nothing was saved, so a retry must not match the claimed fingerprint
+            if DEDUP_ENABLED:
+                DUPLICATES.release(receipt_data["id"])
+            raise
+        tenant.catch_up()
+    schedule_snapshot_refresh()
+    return expense
+
+# Batch ingestion limits
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 500))
+BATCH_MAX_FILE_BYTES = int(os.environ.get('BATCH_MAX_FILE_BYTES', 20 * 1024 * 1024))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp', '.pdf')
+
+def ocr_stage(upload):
+    """Batch pipeline stage 1: OCR a ``(user_id, image)`` upload into a receipt record
+    
+    Repeat uploads come back as ``{"duplicate_of": match}`` so they skip
+    categorization.
+    """
+    user_id, image = upload
+    try:
+        image_hash = fingerprint_image(image)
+        receipt_data = build_receipt(process_receipt_image(image), user_id, image_hash)
+        check_duplicate_receipt(receipt_data)
+    except DuplicateReceipt as e:
+        return {"duplicate_of": e.match}
+    except BackendUnavailable as e:
+        # Left for the job queue to finish once OCR recovers
+        return {"queued_job": spool_receipt_job(image, user_id, delay=e.retry_after)}
+    return receipt_data
+
+def categorize_stage(receipts):
+    """Batch pipeline stage 2: categorize a group of receipts and save them"""
+    fresh = [receipt_data for receipt_data in receipts if "duplicate_of" not in receipt_data and "queued_job" not in receipt_data]
+    with METRICS.stage('categorize_batch'):
+        categories = iter(categorize_expenses_batch(fresh) if fresh else [])
+    
+    results = []
+    for receipt_data in receipts:
+        if "queued_job" in receipt_data:
+            job_id = receipt_data["queued_job"]
+            results.append({"status": "queued", "job_id": job_id, "status_url": job_status_url(job_id)})
+            continue
+        try:
+            if "duplicate_of" in receipt_data:
+                raise DuplicateReceipt(receipt_data["duplicate_of"])
+            category, degraded = next(categories)
+            results.append({"receipt": receipt_data, "expense": record_expense(receipt_data, category, degraded=degraded)})
+        except DuplicateReceipt as e:
+            results.append({"status": "duplicate", "duplicate_of": e.match})
+    return results
+
+# Shared pipeline so concurrency limits hold across simultaneous batches
+RECEIPT_PIPELINE = ReceiptPipeline(
+    ocr_stage,
+    categorize_stage,
+    ocr_workers=int(os.environ.get('OCR_CONCURRENCY', 4)),
+    categorize_workers=int(os.environ.get('CATEGORIZE_CONCURRENCY', 2)),
+    batch_size=int(os.environ.get('CATEGORIZE_BATCH_SIZE', 10))
+)
+
+def read_batch_files(files):
+    """Collect uploaded images and zip archive members as (name, stream) pairs"""
+    items = []
+    
+    def add(name, size, open_stream):
+        if size > BATCH_MAX_FILE_BYTES:
+            raise ValueError(f"{name} exceeds the {BATCH_MAX_FILE_BYTES} byte limit")
+        if len(items) >= BATCH_MAX_FILES:
+            raise ValueError(f"A batch may contain at most {BATCH_MAX_FILES} receipts")
+        items.append((name, open_stream()))
+    
+    for uploaded in files:
+        if uploaded.filename == '':
+            continue
+        
+        if uploaded.filename.lower().endswith('.zip') or uploaded.mimetype in ('application/zip', 'application/x-zip-compressed'):
+            with zipfile.ZipFile(uploaded.stream) as archive:
+                for member in archive.infolist():
+                    name = member.filename
+                    if member.is_dir() or name.startswith('__MACOSX/') or not name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    add(name, member.file_size,
+                        lambda: spool_copy(archive.open(member), UPLOAD_SPOOL_MAX_BYTES))
+        else:
+            # Request buffers are closed when the view returns, before results stream
+            add(uploaded.filename, stream_size(uploaded.stream),
+                lambda: spool_copy(uploaded.stream, UPLOAD_SPOOL_MAX_BYTES))
+    return items
+
+@bp.route('/upload/batch', methods=['POST'])
+@user_scoped
+def upload_receipt_batch():
+    """Process many receipts (files or a zip archive), streaming results as NDJSON"""
+    files = request.files.getlist('receipts') + request.files.getlist('receipt')
+    if not files:
+        return jsonify({"error": "No receipt files uploaded"}), 400
+    
+    try:
+        items = read_batch_files(files)
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if not items:
+        return jsonify({"error": "No receipt images found"}), 400
+    return Response(batch_results(items, g.tenant.user_id), mimetype='application/x-ndjson')
+
+def batch_results(items, user_id):
+    """Run (name, image) items through the pipeline, yielding NDJSON result lines and a summary"""
+    # Pipeline workers run outside the request, so each upload carries its owner
+    items = [(name, (user_id, image)) for name, image in items]
+    counts = {"success": 0, "duplicate": 0, "queued": 0}
+    for result in RECEIPT_PIPELINE.run(items):
+        if result["status"] in counts:
+            counts[result["status"]] += 1
+        yield json.dumps(result) + "\n"
+    
+    yield json.dumps({
+        "status": "done",
+        "total": len(items),
+        "succeeded": counts["success"],
+        "duplicates": counts["duplicate"],
+        "queued": counts["queued"],
+        "failed": len(items) - sum(counts.values())
+    }) + "\n"
+
+# Oversized phone photos are shrunk before upload to OCR
+OCR_DOWNSCALE = os.environ.get('OCR_DOWNSCALE', '1') == '1'
+OCR_MAX_DIMENSION = int(os.environ.get('OCR_MAX_DIMENSION', 2000))
+OCR_DOWNSCALE_MIN_BYTES = int(os.environ.get('OCR_DOWNSCALE_MIN_BYTES', 1024 * 1024))
+
+def process_receipt_image(image):
+    """Run OCR on a receipt image (bytes or a seekable binary stream) and extract structured data"""
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    
+    # Skip the OCR round trip for images we have already processed
+    with METRICS.stage('hash'):
+        cache_key = stream_content_key(image)
+        cached = OCR_CACHE.get(cache_key)
+    if cached is not None:
+        METRICS.inc('ocr_cache_hits_total')
+        return copy.deepcopy(cached)
+    
+    body = image
+    if OCR_DOWNSCALE:
+        with METRICS.stage('downscale'):
+            body = downscale_for_ocr(image, max_dimension=OCR_MAX_DIMENSION, min_bytes=OCR_DOWNSCALE_MIN_BYTES)
+    METRICS.observe('ocr_request_bytes', stream_size(body))
+    
+    request = build_ocr_request(body)
+    
+    try:
+        with METRICS.stage('ocr'):
+            response = CLIENTS.recognize_receipt(request)
+            result = response.body.to_map()
         
         # Parse OCR results
         raw_text = result.get('Data', {}).get('Content', '')
         
         # Extract structured data from the OCR text
-        extracted = extract_receipt_data(raw_text)
+        with METRICS.stage('parse'):
+            extracted = extract_receipt_data(raw_text)
         extracted['raw_text'] = raw_text
         
+        OCR_CACHE.set(cache_key, copy.deepcopy(extracted))
         return extracted
     except Exception as e:
         print(f"OCR processing error: {e}")
         raise
 
-def extract_receipt_data(ocr_text):
-    """Extract structured data from OCR text"""
-    # Basic parsing logic - in a real application you would need more robust parsing
-    lines = ocr_text.split('\n')
-    
-    # Default values
-    data = {
-        "merchant": "Unknown",
-        "date": datetime.datetime.now().strftime("%Y-%m-%d"),
-        "total_amount": 0.0,
-        "items": []
-    }
+def categorize_locally(receipt_data):
+    """Categorize without an API call, returning None when DashScope is needed"""
+    # Reuse past categorizations for merchants we have already seen
+    match = CATEGORY_INDEX.lookup(receipt_data['merchant'], receipt_data.get('items'))
+    if match is not None:
+        return match[0]
     
-    # Simple parsing - this would need to be much more sophisticated in a real app
-    for line in lines:
-        if "total" in line.lower():
-            # Try to extract total amount
-            parts = line.split()
-            for part in parts:
-                try:
-                    if part.startswith("$"):
-                        data["total_amount"] = float(part.replace("$", "").replace(",", ""))
-                    else:
-                        amount = float(part.replace(",", ""))
-                        data["total_amount"] = amount
-                        break
-                except ValueError:
-                    continue
-        
-        # Very basic merchant detection - first line that's not a date
-        if data["merchant"] == "Unknown" and not any(x in line.lower() for x in ["date", "receipt", "invoice"]):
-            data["merchant"] = line.strip()
+    category = LOCAL_CLASSIFIER.predict(receipt_data)
+    if category in CATEGORIES:
+        return category
+    return None
+
+def categorize_expense(receipt_data):
+    """Automatically categorize an expense, returning (category, degraded)"""
+    with METRICS.stage('categorize'):
+        category = categorize_locally(receipt_data)
+        if category is not None:
+            METRICS.inc('categorizations_total', tier='local')
+            return category, False
         
-        # Simple date detection
-        date_formats = ["%Y-%m-%d", "%Y/%m/%d", "%m/%d/%Y", "%d/%m/%Y"]
-        for fmt in date_formats:
-            try:
-                datetime.datetime.strptime(line.strip(), fmt)
-                data["date"] = line.strip()
-                break
-            except ValueError:
-                continue
-    
-    # Extract items (very simplified)
-    item_section = False
-    for line in lines:
-        if "item" in line.lower() or "qty" in line.lower():
-            item_section = True
-            continue
+        category = categorize_with_dashscope(receipt_data)
+        if category is None:
+            return fallback_category(receipt_data), True
         
-        if item_section and "total" not in line.lower() and len(line.strip()) > 0:
-            # Simplified item extraction
-            data["items"].append({"description": line.strip(), "price": 0.0})
+        METRICS.inc('categorizations_total', tier='dashscope')
+        CATEGORY_INDEX.record(receipt_data['merchant'], category, receipt_data.get('items'))
+        return category, False
+
+def fallback_category(receipt_data):
+    """Category for a receipt DashScope could not answer for (failing, throttled or circuit open)
     
-    return data
+    The local model's best guess, however unsure, beats filing everything
+    under "Other" while DashScope is down. Expenses saved with it are
+    marked degraded so the classifier is never retrained on its own guesses.
+    """
+    category = LOCAL_CLASSIFIER.best_guess(receipt_data)
+    if category in CATEGORIES:
+        METRICS.inc('categorizations_total', tier='degraded')
+        return category
+    METRICS.inc('categorizations_total', tier='fallback')
+    return "Other"
 
-def categorize_expense(receipt_data):
-    """Automatically categorize an expense based on the receipt data"""
-    # Use DashScope to categorize the expense
+# Token budgets for the receipt text and coach context sent to DashScope
+CATEGORIZE_TEXT_TOKENS = int(os.environ.get('CATEGORIZE_TEXT_TOKENS', 200))
+BATCH_TEXT_TOKENS = int(os.environ.get('CATEGORIZE_BATCH_TEXT_TOKENS', 75))
+ASK_SUMMARY_TOKENS = int(os.environ.get('ASK_SUMMARY_TOKENS', 600))
+ASK_QUESTION_TOKENS = int(os.environ.get('ASK_QUESTION_TOKENS', 200))
+ASK_MAX_CATEGORIES = int(os.environ.get('ASK_MAX_CATEGORIES', 8))
+
+PROMPT_SAVINGS = PromptSavings()
+
+def record_prompt_savings(kind, original_tokens, sent_tokens):
+    """Count the estimated tokens a trimmed prompt saved"""
+    saved = PROMPT_SAVINGS.record(kind, original_tokens, sent_tokens)
+    METRICS.inc('prompt_tokens_saved_total', saved, prompt=kind)
+
+def receipt_prompt_text(receipt_data, max_tokens, kind):
+    """Return the salient lines of a receipt's OCR text within a token budget"""
+    raw_text = receipt_data.get('raw_text', '') or ''
+    trimmed = salient_lines(raw_text, max_tokens)
+    record_prompt_savings(kind, estimate_tokens(raw_text), estimate_tokens(trimmed))
+    return trimmed
+
+def categorize_with_dashscope(receipt_data):
+    """Ask DashScope for the expense category, returning None if the call fails"""
+    receipt_text = receipt_prompt_text(receipt_data, CATEGORIZE_TEXT_TOKENS, 'categorize')
     prompt = f"""
     I have a receipt from {receipt_data['merchant']} for ${receipt_data['total_amount']}.
-    The raw text from the receipt is: {receipt_data.get('raw_text', '')}
+    The raw text from the receipt is: {receipt_text}
     
     Please categorize this expense into exactly one of these categories:
     {', '.join(CATEGORIES)}
@@ -209,7 +713,7 @@ def categorize_expense(receipt_data):
     """
     
     try:
-        response = Generation.call(
+        response = CLIENTS.generate(
             model='qwen-max',
             prompt=prompt,
             top_p=0.8,
@@ -217,85 +721,472 @@ def categorize_expense(receipt_data):
         )
         
         if response.status_code == 200:
-            # Extract the category from the response
-            predicted_category = response.output.text.strip()
-            
-            # Ensure it's a valid category
-            if predicted_category in CATEGORIES:
-                return predicted_category
-            else:
-                # Find the closest match or default to "Other"
-                for category in CATEGORIES:
-                    if category.lower() in predicted_category.lower():
-                        return category
-                return "Other"
+            # Extract the category from the response, defaulting to "Other"
+            return match_category(response.output.text) or "Other"
         else:
             print(f"DashScope error: {response.code}, {response.message}")
-            return "Other"
+            return None
     except Exception as e:
         print(f"Categorization error: {e}")
-        return "Other"
+        return None
+
+def match_category(text):
+    """Map an LLM answer onto one of CATEGORIES, or None if nothing matches"""
+    predicted_category = str(text).strip()
+    
+    # Ensure it's a valid category
+    if predicted_category in CATEGORIES:
+        return predicted_category
+    
+    # Find the closest match
+    for category in CATEGORIES:
+        if category.lower() in predicted_category.lower():
+            return category
+    return None
+
+def categorize_expenses_batch(receipts):
+    """Categorize several receipts, sharing one DashScope prompt for local misses
+    
+    Returns (category, degraded) pairs in the same order as ``receipts``.
+    Entries the batched answer does not cover are categorized one at a time.
+    """
+    categories = [None] * len(receipts)
+    misses = []
+    degraded = set()
+    for position, receipt_data in enumerate(receipts):
+        category = categorize_locally(receipt_data)
+        if category is not None:
+            categories[position] = category
+        else:
+            misses.append(position)
+    
+    if len(misses) > 1:
+        batch_answer = categorize_batch_with_dashscope([receipts[p] for p in misses])
+        for position, category in zip(misses, batch_answer):
+            if category is not None:
+                categories[position] = category
+                CATEGORY_INDEX.record(receipts[position]['merchant'], category, receipts[position].get('items'))
+    
+    # Fall back to per-item calls for anything the batch could not answer
+    for position in misses:
+        if categories[position] is None:
+            receipt_data = receipts[position]
+            category = categorize_with_dashscope(receipt_data)
+            if category is not None:
+                CATEGORY_INDEX.record(receipt_data['merchant'], category, receipt_data.get('items'))
+            else:
+                category = fallback_category(receipt_data)
+                degraded.add(position)
+            categories[position] = category
+    return [(category, position in degraded) for position, category in enumerate(categories)]
+
+def categorize_batch_with_dashscope(receipts):
+    """Ask DashScope to categorize several receipts in one prompt
+    
+    Returns one entry per receipt: a valid category, or None where the
+    answer was missing or could not be matched to CATEGORIES.
+    """
+    entries = []
+    for number, receipt_data in enumerate(receipts, start=1):
+        raw_text = ' | '.join(receipt_prompt_text(receipt_data, BATCH_TEXT_TOKENS, 'categorize_batch').split('\n'))
+        entries.append(
+            f"{number}. Merchant: {receipt_data['merchant']} | Amount: ${receipt_data['total_amount']} | Text: {raw_text}"
+        )
+    receipts_list = '\n    '.join(entries)
+    
+    prompt = f"""
+    Categorize each of these {len(receipts)} receipts into exactly one of these categories:
+    {', '.join(CATEGORIES)}
+    
+    Receipts:
+    {receipts_list}
+    
+    Return only a JSON array of {len(receipts)} category names, in the same order as the receipts.
+    """
+    
+    try:
+        response = CLIENTS.generate(
+            model='qwen-max',
+            prompt=prompt,
+            top_p=0.8,
+            result_format='text'
+        )
+        
+        if response.status_code != 200:
+            print(f"DashScope error: {response.code}, {response.message}")
+            return [None] * len(receipts)
+        
+        text = response.output.text
+        answer = json.loads(text[text.index('['):text.rindex(']') + 1])
+        if not isinstance(answer, list):
+            raise ValueError("expected a JSON array")
+    except Exception as e:
+        print(f"Batch categorization error: {e}")
+        return [None] * len(receipts)
+    
+    answer = answer[:len(receipts)] + [None] * (len(receipts) - len(answer))
+    return [match_category(item) if item is not None else None for item in answer]
+
+# Background job queue for asynchronous uploads, persisted so jobs survive restarts
+JOB_QUEUE = JobQueue(
+    os.environ.get('JOB_DB_PATH', 'data/jobs.db'),
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    callback_hosts=[host.strip() for host in os.environ.get('JOB_CALLBACK_HOSTS', '').split(',') if host.strip()]
+)
+JOB_QUEUE.register('receipt', process_receipt_job, on_failed=discard_receipt_job)
+
+def schedule_snapshot_refresh():
+    """Queue a snapshot refresh unless one was queued in the last SNAPSHOT_REFRESH_DELAY seconds"""
+    if SNAPSHOTS.claim_schedule(SNAPSHOT_REFRESH_DELAY):
+        # Every refresh reuses one job row rather than adding a row per upload
+        JOB_QUEUE.submit('snapshots', {}, delay=SNAPSHOT_REFRESH_DELAY, job_id='snapshots')
+
+def refresh_snapshots_job(payload):
+    """Job handler: recompute the snapshots of periods with new expenses"""
+    with METRICS.stage('snapshots'):
+        return {"periods": SNAPSHOTS.refresh(STORE)}
+
+JOB_QUEUE.register('snapshots', refresh_snapshots_job)
+
+# Pagination limits for /expenses
+EXPENSES_PAGE_SIZE = int(os.environ.get('EXPENSES_PAGE_SIZE', 100))
+EXPENSES_MAX_PAGE_SIZE = int(os.environ.get('EXPENSES_MAX_PAGE_SIZE', 1000))
+
+def encode_cursor(position):
+    """Encode a store position as an opaque pagination cursor"""
+    return base64.urlsafe_b64encode(str(position).encode()).decode().rstrip('=')
 
-@app.route('/expenses')
+def decode_cursor(cursor):
+    """Decode a pagination cursor, raising ValueError if it is malformed"""
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("cursor is malformed")
+
+def parse_expense_filters(args):
+    """Read /expenses filters from the query string, raising ValueError on bad input"""
+    filters = {}
+    for name in ('category', 'merchant'):
+        if args.get(name):
+            filters[name] = args[name]
+    for name in ('start_date', 'end_date'):
+        if args.get(name):
+            datetime.datetime.strptime(args[name], "%Y-%m-%d")
+            filters[name] = args[name]
+    for name in ('min_amount', 'max_amount'):
+        if args.get(name):
+            filters[name] = float(args[name])
+    return filters
+
+def stream_csv(expenses):
+    """Yield CSV text for an iterable of expenses in chunks of roughly 64KB"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPENSE_FIELDS)
+    writer.writeheader()
+    for expense in expenses:
+        writer.writerow(expense)
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@bp.route('/expenses')
+@user_scoped
 def get_expenses():
-    """Return all expenses"""
-    return jsonify(EXPENSES_DB)
+    """Return a page of expenses, or stream every match as NDJSON or CSV
+    
+    Supports filters (category, merchant, start_date, end_date, min_amount,
+    max_amount), cursor pagination (limit, cursor) and format=ndjson|csv
+    exports. The next page's cursor is returned in the X-Next-Cursor and
+    Link headers, so the JSON body stays a plain list of expenses. Only
+    the requesting user's expenses are returned.
+    """
+    try:
+        filters = parse_expense_filters(request.args)
+        limit = int(request.args.get('limit', EXPENSES_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    
+    export_format = request.args.get('format', 'json')
+    if export_format not in ('json', 'ndjson', 'csv'):
+        return jsonify({"error": "format must be one of json, ndjson, csv"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    limit = min(limit, EXPENSES_MAX_PAGE_SIZE)
+    
+    # The data version changes on every write, so together with the query
+    # it identifies the response body without having to build it
+    query = sorted(request.args.items(multi=True))
+    store = g.tenant.store
+    etag = hashlib.sha1(f"{g.tenant.user_id}:{store.data_version()}:{query}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    if export_format == 'ndjson':
+        body = (json.dumps(expense) + "\n" for expense in store.iter_expenses(**filters))
+        response = Response(body, mimetype='application/x-ndjson')
+    elif export_format == 'csv':
+        response = Response(stream_csv(store.iter_expenses(**filters)), mimetype='text/csv')
+        response.headers['Content-Disposition'] = 'attachment; filename=expenses.csv'
+    else:
+        expenses, next_after = store.page_expenses(limit, after=after, **filters)
+        response = jsonify(expenses)
+        if next_after is not None:
+            next_cursor = encode_cursor(next_after)
+            args = {key: value for key, value in request.args.items() if key != 'cursor'}
+            next_url = url_for('.get_expenses', cursor=next_cursor, **args)
+            response.headers['X-Next-Cursor'] = next_cursor
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Largest merchant list the dashboard may request, and longest daily series
+ANALYTICS_MAX_LIMIT = int(os.environ.get('ANALYTICS_MAX_LIMIT', 100))
+ANALYTICS_MAX_DAYS = int(os.environ.get('ANALYTICS_MAX_DAYS', 3660))
+
+@bp.route('/analytics/<view>')
+@user_scoped
+def get_analytics(view):
+    """Return dashboard aggregates computed over the user's columnar expense store
+    
+    Views: timeseries (bucket=day|week|month), categories, merchants
+    (limit) and rolling (window, in days). All accept start_date, end_date
+    and category filters. The periods view (bucket, limit) reads the
+    precomputed snapshots, newest first, and takes no category filter.
+    """
+    from analytics import BUCKETS
+    
+    try:
+        filters = parse_expense_filters(request.args)
+        bucket = request.args.get('bucket', 'day')
+        window = int(request.args.get('window', 7))
+        limit = int(request.args.get('limit', 10))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    filters = {name: filters[name] for name in ('start_date', 'end_date', 'category') if name in filters}
+    
+    if bucket not in BUCKETS:
+        return jsonify({"error": f"bucket must be one of {', '.join(BUCKETS)}"}), 400
+    if window < 1 or limit < 1:
+        return jsonify({"error": "window and limit must be positive"}), 400
+    if filters.get('start_date') and filters.get('end_date') and filters['start_date'] > filters['end_date']:
+        return jsonify({"error": "start_date must not be after end_date"}), 400
+    
+    views = {
+        'timeseries': lambda: g.tenant.columns().timeseries(bucket, **filters),
+        'categories': lambda: g.tenant.columns().category_breakdown(**filters),
+        'merchants': lambda: g.tenant.columns().top_merchants(min(limit, ANALYTICS_MAX_LIMIT), **filters),
+        'rolling': lambda: g.tenant.columns().rolling_average(window, max_days=ANALYTICS_MAX_DAYS, **filters),
+        'periods': lambda: snapshot_periods(g.tenant, bucket, min(limit, ANALYTICS_MAX_LIMIT), filters, version)
+    }
+    if view not in views:
+        return jsonify({"error": f"Unknown view, expected one of {', '.join(views)}"}), 404
+    if view == 'periods' and 'category' in filters:
+        return jsonify({"error": "The periods view does not take a category filter"}), 400
+    
+    version = g.tenant.store.data_version()
+    # Snapshots change when a refresh lands, not when the upload does
+    tag_version = f"{version}:{SNAPSHOTS.version(g.tenant.user_id)}" if view == 'periods' else version
+    query = sorted(request.args.items(multi=True))
+    etag = hashlib.sha1(f"{g.tenant.user_id}:{tag_version}:{view}:{query}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    try:
+        response = jsonify(views[view]())
+    except ValueError as e:
+        # Only the rolling series refuses ranges; anything else is a bug
+        if view != 'rolling':
+            raise
+        return jsonify({"error": f"Range too large: {e}; narrow it with start_date and end_date"}), 400
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-@app.route('/ask', methods=['POST'])
+def snapshot_periods(tenant, period, limit, filters, version):
+    """Return a user's period snapshots, flagged stale (and refreshed soon) if uploads are not in them yet"""
+    stale = SNAPSHOTS.version(tenant.user_id) != version
+    if stale:
+        schedule_snapshot_refresh()
+    return {
+        "bucket": period,
+        "periods": SNAPSHOTS.history(tenant.user_id, period, limit, filters.get('start_date'), filters.get('end_date')),
+        "stale": stale
+    }
+
+@bp.route('/metrics')
+def get_metrics():
+    """Expose stage latencies and API usage in the Prometheus text format"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/stats')
+def get_stats():
+    """Return cache and category index statistics"""
+    return jsonify({
+        "ocr_cache": OCR_CACHE.stats(),
+        "category_index": CATEGORY_INDEX.stats(),
+        "duplicates": DUPLICATES.stats(),
+        "local_classifier": LOCAL_CLASSIFIER.stats(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "jobs": JOB_QUEUE.stats(),
+        "clients": CLIENTS.stats(),
+        "tenants": TENANTS.stats(),
+        "snapshots": SNAPSHOTS.stats(),
+        "prompt_savings": PROMPT_SAVINGS.stats()
+    })
+
+@bp.route('/ask', methods=['POST'])
+@user_scoped
 def ask_question():
     """Process natural language questions about expenses"""
     data = request.json
     if not data or 'question' not in data:
         return jsonify({"error": "No question provided"}), 400
     
-    question = data['question']
-    
-    # Convert expenses to DataFrame for analysis
-    expenses_df = pd.DataFrame(EXPENSES_DB)
+    return jsonify({"answer": answer_question(g.tenant, data['question'])})
+
+def answer_question(tenant, question):
+    """Answer a coach question from the tenant's up-to-date spending totals"""
+    # Pick up expenses recorded by other workers since the last question
+    with METRICS.stage('catch_up'):
+        tenant.catch_up()
     
     # Get insights using DashScope
-    insights = get_insights_from_dashscope(question, expenses_df)
+    return get_insights_from_dashscope(question, tenant.aggregates, tenant.user_id)
+
+@bp.route('/ask/stream', methods=['POST'])
+@user_scoped
+def ask_question_stream():
+    """Answer a question about expenses, streaming tokens as Server-Sent Events"""
+    data = request.json
+    if not data or 'question' not in data:
+        return jsonify({"error": "No question provided"}), 400
     
-    return jsonify({"answer": insights})
+    tenant = g.tenant
+    tenant.catch_up()
+    return Response(
+        stream_with_context(insight_events(tenant, data['question'])),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
 
-def get_insights_from_dashscope(question, expenses_df):
-    """Get spending insights using DashScope"""
-    # Prepare expense summary for the prompt
-    if expenses_df.empty:
-        expenses_summary = "No expenses recorded yet."
-    else:
-        total_spent = expenses_df['amount'].sum()
-        by_category = expenses_df.groupby('category')['amount'].sum().to_dict()
-        
-        expenses_summary = f"Total spent: ${total_spent:.2f}\n"
-        expenses_summary += "Spending by category:\n"
-        for category, amount in by_category.items():
-            expenses_summary += f"- {category}: ${amount:.2f}\n"
-        
-        if 'date' in expenses_df.columns:
-            # Get recent expenses
-            expenses_df['date'] = pd.to_datetime(expenses_df['date'])
-            recent_expenses = expenses_df.sort_values('date', ascending=False).head(5)
-            
-            expenses_summary += "\nRecent expenses:\n"
-            for _, row in recent_expenses.iterrows():
-                expenses_summary += f"- {row['date'].strftime('%Y-%m-%d')}: ${row['amount']:.2f} at {row['merchant']} ({row['category']})\n"
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def insight_events(tenant, question):
+    """Yield a coach answer as Server-Sent Events: tokens, then ``done`` or ``error``"""
+    try:
+        for token in stream_insights_from_dashscope(question, tenant.aggregates, tenant.user_id):
+            yield f"data: {json.dumps({'token': token})}\n\n"
+    except Exception as e:
+        print(f"DashScope error: {e}")
+        message = "Sorry, I couldn't analyze your expenses due to a technical issue."
+        yield f"event: error\ndata: {json.dumps({'error': message})}\n\n"
+        return
+    yield "event: done\ndata: {}\n\n"
+
+def coach_periods(aggregates, user_id=None):
+    """Return this week's and this month's spending for the coach, with last period's total
     
-    # Create prompt for DashScope
-    prompt = f"""
-    You are an AI Spending Coach helping a user understand their expenses.
+    The user's snapshots are read when they are up to date with the store;
+    otherwise the running totals stand in, without top merchants.
+    """
+    current = period_keys(datetime.date.today())
+    if user_id is not None and STORE.owns(user_id) \
+            and SNAPSHOTS.version(user_id) == STORE.for_user(user_id).data_version():
+        return {period: SNAPSHOTS.get(user_id, period, current[period]) for period in ('week', 'month')}
+    periods = {}
+    for period in ('week', 'month'):
+        total, _ = aggregates.period_total(period, current[period])
+        previous_total, _ = aggregates.period_total(period, previous_key(period, current[period]))
+        periods[period] = {"total": total, "previous_total": previous_total, "top_merchants": []}
+    return periods
+
+def build_expenses_summary(aggregates, max_categories=None, periods=None):
+    """Summarize spending for the coach prompt in O(categories) time
     
-    Here is a summary of the user's expenses:
-    {expenses_summary}
+    With ``max_categories``, only the largest categories are listed and the
+    rest are folded into a single line. ``periods`` is what coach_periods
+    returns; it is looked up from the running totals when omitted.
+    """
+    if aggregates.count == 0:
+        return "No expenses recorded yet."
     
-    The user's question is: "{question}"
+    expenses_summary = f"Total spent: ${aggregates.total:.2f}\n"
+    expenses_summary += "Spending by category:\n"
+    by_category = sorted(aggregates.by_category.items(), key=lambda item: -item[1])
+    if max_categories is not None and len(by_category) > max_categories:
+        remainder = by_category[max_categories:]
+        by_category = by_category[:max_categories]
+        by_category.append((f"{len(remainder)} other categories", sum(amount for _, amount in remainder)))
+    for category, amount in by_category:
+        expenses_summary += f"- {category}: ${amount:.2f}\n"
     
-    Provide a helpful, concise analysis addressing their question based on the expense data.
-    Focus on actionable insights and useful observations about spending patterns.
+    # Spending in the current week and month, against the previous ones
+    if periods is None:
+        periods = coach_periods(aggregates)
+    expenses_summary += "\n"
+    for period in ('week', 'month'):
+        snapshot = periods[period]
+        expenses_summary += f"Spent this {period}: ${snapshot['total']:.2f} (last {period}: ${snapshot['previous_total']:.2f})\n"
+    if periods['month']['top_merchants']:
+        merchants = ', '.join(f"{m['merchant']} ${m['total']:.2f}" for m in periods['month']['top_merchants'])
+        expenses_summary += f"Top merchants this month: {merchants}\n"
+    
+    recent_expenses = aggregates.recent()
+    if recent_expenses:
+        expenses_summary += "\nRecent expenses:\n"
+        for expense in recent_expenses:
+            expense_date = parse_date(expense['date']).isoformat()
+            expenses_summary += f"- {expense_date}: ${expense['amount']:.2f} at {expense['merchant']} ({expense['category']})\n"
+    
+    return expenses_summary
+
+# Cache of coach answers, keyed on the question and the data it depends on
+ANSWER_CACHE = LRUCache(
+    max_entries=int(os.environ.get('ANSWER_CACHE_SIZE', 512)),
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL', 3600)) or None
+)
+
+def normalize_question(question):
+    """Normalize a question so trivially different phrasings share a cache entry"""
+    return re.sub(r'\s+', ' ', question.lower()).strip(' ?!.')
+
+def answer_cache_key(question, aggregates, user_id=DEFAULT_USER):
+    """Build the answer cache key for a user's question
+    
+    Questions that name specific categories are keyed on those categories'
+    versions, so an upload in another category does not invalidate them.
+    Any other question is keyed on the overall data version.
     """
+    normalized = normalize_question(question)
+    mentioned = sorted(c for c in CATEGORIES if c.lower() in normalized)
+    if mentioned:
+        scope = ','.join(f"{c}:{aggregates.category_versions.get(c, 0)}" for c in mentioned)
+    else:
+        scope = f"all:{aggregates.version}"
+    return f"{user_id}|{scope}|{normalized}"
+
+def get_insights_from_dashscope(question, aggregates, user_id=DEFAULT_USER):
+    """Get spending insights using DashScope"""
+    # Repeat questions against unchanged data are answered from the cache
+    cache_key = answer_cache_key(question, aggregates, user_id)
+    cached_answer = ANSWER_CACHE.get(cache_key)
+    if cached_answer is not None:
+        return cached_answer
+    
+    prompt = build_insights_prompt(question, aggregates, user_id)
     
     try:
-        response = Generation.call(
+        response = CLIENTS.generate(
             model='qwen-max',
             prompt=prompt,
             top_p=0.8,
@@ -303,6 +1194,7 @@ def get_insights_from_dashscope(question, expenses_df):
         )
         
         if response.status_code == 200:
+            ANSWER_CACHE.set(cache_key, response.output.text)
             return response.output.text
         else:
             return f"Sorry, I couldn't analyze your expenses. Error: {response.message}"
@@ -310,7 +1202,65 @@ def get_insights_from_dashscope(question, expenses_df):
         print(f"DashScope error: {e}")
         return "Sorry, I couldn't analyze your expenses due to a technical issue."
 
-@app.route('/templates/index.html')
+def stream_insights_from_dashscope(question, aggregates, user_id=DEFAULT_USER):
+    """Yield an answer from DashScope incrementally as it is generated"""
+    cache_key = answer_cache_key(question, aggregates, user_id)
+    cached_answer = ANSWER_CACHE.get(cache_key)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    
+    responses = CLIENTS.generate(
+        model='qwen-max',
+        prompt=build_insights_prompt(question, aggregates, user_id),
+        top_p=0.8,
+        result_format='text',
+        stream=True,
+        incremental_output=True
+    )
+    
+    chunks = []
+    for response in responses:
+        if response.status_code != 200:
+            # Closing settles the call's outcome now rather than when the generator is collected
+            responses.close()
+            yield f"Sorry, I couldn't analyze your expenses. Error: {response.message}"
+            return
+        chunks.append(response.output.text)
+        yield response.output.text
+    
+    ANSWER_CACHE.set(cache_key, ''.join(chunks))
+
+def build_insights_prompt(question, aggregates, user_id=None):
+    """Build the AI coach prompt for a question"""
+    # Prepare expense summary for the prompt, bounded to the token budget
+    with METRICS.stage('summary'):
+        periods = coach_periods(aggregates, user_id)
+        full_summary = build_expenses_summary(aggregates, periods=periods)
+        summary_lines = build_expenses_summary(aggregates, max_categories=ASK_MAX_CATEGORIES, periods=periods).split('\n')
+        expenses_summary = '\n'.join(fit_lines(summary_lines, ASK_SUMMARY_TOKENS))
+    bounded_question = truncate(question, ASK_QUESTION_TOKENS)
+    record_prompt_savings(
+        'ask',
+        estimate_tokens(full_summary) + estimate_tokens(question),
+        estimate_tokens(expenses_summary) + estimate_tokens(bounded_question)
+    )
+    
+    # Create prompt for DashScope
+    prompt = f"""
+    You are an AI Spending Coach helping a user understand their expenses.
+    
+    Here is a summary of the user's expenses:
+    {expenses_summary}
+    
+    The user's question is: "{bounded_question}"
+    
+    Provide a helpful, concise analysis addressing their question based on the expense data.
+    Focus on actionable insights and useful observations about spending patterns.
+    """
+    return prompt
+
+@bp.route('/templates/index.html')
 def get_template():
     """Return the HTML template for the UI"""
     return """
@@ -519,15 +1469,21 @@ def get_template():
                 }
             });
             
-            // Load expenses
-            function loadExpenses() {
-                document.getElementById("expenses-list").innerHTML = "Loading...";
+            // Load expenses, one page at a time
+            function loadExpenses(cursor) {
+                const expensesList = document.getElementById("expenses-list");
+                if (!cursor) {
+                    expensesList.innerHTML = "Loading...";
+                }
                 
-                fetch("/expenses")
-                    .then(response => response.json())
-                    .then(expenses => {
-                        if (expenses.length === 0) {
-                            document.getElementById("expenses-list").innerHTML = 
+                fetch(cursor ? "/expenses?cursor=" + encodeURIComponent(cursor) : "/expenses")
+                    .then(response => {
+                        const nextCursor = response.headers.get("X-Next-Cursor");
+                        return response.json().then(expenses => ({ expenses, nextCursor }));
+                    })
+                    .then(({ expenses, nextCursor }) => {
+                        if (!cursor && expenses.length === 0) {
+                            expensesList.innerHTML = 
                                 "<p>No expenses yet. Upload some receipts!</p>";
                             return;
                         }
@@ -544,10 +1500,22 @@ def get_template():
                             `;
                         });
                         
-                        document.getElementById("expenses-list").innerHTML = html;
+                        if (!cursor) {
+                            expensesList.innerHTML = "";
+                        }
+                        const loadMore = document.getElementById("load-more");
+                        if (loadMore) {
+                            loadMore.remove();
+                        }
+                        expensesList.insertAdjacentHTML("beforeend", html);
+                        
+                        if (nextCursor) {
+                            expensesList.insertAdjacentHTML("beforeend",
+                                `<button id="load-more" onclick="loadExpenses('${nextCursor}')">Load more</button>`);
+                        }
                     })
                     .catch(error => {
-                        document.getElementById("expenses-list").innerHTML = 
+                        expensesList.innerHTML = 
                             `<p style="color: red;">Error loading expenses: ${error.message}</p>`;
                     });
             }
@@ -576,37 +1544,63 @@ def get_template():
                 // Scroll to bottom
                 chatBox.scrollTop = chatBox.scrollHeight;
                 
-                // Send question to API
-                fetch("/ask", {
+                // Stream the answer from the API, rendering tokens as they arrive
+                fetch("/ask/stream", {
                     method: "POST",
                     headers: {
                         "Content-Type": "application/json"
                     },
                     body: JSON.stringify({ question: question })
                 })
-                .then(response => response.json())
-                .then(data => {
-                    // Remove loading message
-                    chatBox.removeChild(loadingMessage);
+                .then(response => {
+                    if (!response.ok) {
+                        return response.json().then(data => { throw new Error(data.error); });
+                    }
                     
-                    // Add AI response
-                    const aiMessage = document.createElement("div");
-                    aiMessage.className = "message ai-message";
-                    aiMessage.textContent = data.answer;
-                    chatBox.appendChild(aiMessage);
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = "";
+                    let answer = "";
                     
-                    // Scroll to bottom
-                    chatBox.scrollTop = chatBox.scrollHeight;
+                    function handleEvent(rawEvent) {
+                        let eventType = "message";
+                        let data = "";
+                        rawEvent.split("\\n").forEach(line => {
+                            if (line.startsWith("event:")) {
+                                eventType = line.slice(6).trim();
+                            } else if (line.startsWith("data:")) {
+                                data += line.slice(5).trim();
+                            }
+                        });
+                        
+                        if (eventType === "error") {
+                            throw new Error(JSON.parse(data).error);
+                        }
+                        if (eventType === "message" && data) {
+                            answer += JSON.parse(data).token;
+                            loadingMessage.textContent = answer;
+                            chatBox.scrollTop = chatBox.scrollHeight;
+                        }
+                    }
+                    
+                    function read() {
+                        return reader.read().then(({ done, value }) => {
+                            if (done) {
+                                return;
+                            }
+                            buffer += decoder.decode(value, { stream: true });
+                            const events = buffer.split("\\n\\n");
+                            buffer = events.pop();
+                            events.forEach(handleEvent);
+                            return read();
+                        });
+                    }
+                    
+                    return read();
                 })
                 .catch(error => {
-                    // Remove loading message
-                    chatBox.removeChild(loadingMessage);
-                    
-                    // Add error message
-                    const errorMessage = document.createElement("div");
-                    errorMessage.className = "message ai-message";
-                    errorMessage.textContent = "Sorry, I encountered an error: " + error.message;
-                    chatBox.appendChild(errorMessage);
+                    // Replace the pending message with the error
+                    loadingMessage.textContent = "Sorry, I encountered an error: " + error.message;
                     
                     // Scroll to bottom
                     chatBox.scrollTop = chatBox.scrollHeight;
@@ -624,5 +1618,20 @@ def get_template():
     </html>
     """
 
+def create_app():
+    """Create the Flask app and start the background job workers
+    
+    Heavy SDKs (OCR, DashScope, NumPy) are not imported here; they load
+    with the first request that needs them.
+    """
+    app = Flask(__name__)
+    app.request_class = SpooledRequest
+    app.register_blueprint(bp)
+    JOB_QUEUE.start()
+    # Picks up expenses stored before the snapshots existed or while no worker ran
+    schedule_snapshot_refresh()
+    return app
+
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
@@ -0,0 +1,240 @@
+import datetime
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from aggregates import parse_date, period_keys
+
+# Dates are stored as days since 1970-01-01; undated expenses get NO_DATE
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+NO_DATE = np.iinfo(np.int64).min
+BUCKETS = ("day", "week", "month")
+
+# Receipts share a small set of date strings, so parsed values are memoized
+@lru_cache(maxsize=65536)
+def to_day(value):
+    """Convert a date string to days since the epoch, or NO_DATE"""
+    day = parse_date(value)
+    return day.toordinal() - EPOCH if day is not None else NO_DATE
+
+def from_day(day):
+    return datetime.date.fromordinal(int(day) + EPOCH)
+
+def bucket_keys(days, bucket):
+    """Map epoch days onto integer day, week or month bucket keys"""
+    if bucket == "day":
+        return days
+    if bucket == "week":
+        # 1970-01-01 was a Thursday; shifting by 3 makes weeks start on Monday
+        return (days + 3) // 7
+    return days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+
+def bucket_start(key, bucket):
+    """Return the first date of an integer bucket key"""
+    if bucket == "day":
+        return from_day(key)
+    if bucket == "week":
+        return from_day(key * 7 - 3)
+    return datetime.date(1970 + int(key) // 12, int(key) % 12 + 1, 1)
+
+def sum_by_code(codes, amounts):
+    """Return (codes, totals, counts) for every code that occurs, via bincount"""
+    if not len(codes):
+        return codes, amounts, codes
+    low = codes.min()
+    offsets = codes - low
+    totals = np.bincount(offsets, weights=amounts)
+    counts = np.bincount(offsets)
+    present = np.flatnonzero(counts)
+    return present + low, totals[present], counts[present]
+
+class ExpenseColumns:
+    """Columnar copy of the expenses for vectorized dashboard queries
+
+    Dates are int64 epoch days, categories and merchants are small integer
+    codes into name tables, and amounts are float64. Columns are grown
+    geometrically and kept in step with the store through ``catch_up``, so
+    each query is a few NumPy passes over contiguous arrays instead of
+    building rows or DataFrames per request.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.position = 0
+        self.days = np.empty(capacity, dtype=np.int64)
+        self.categories = np.empty(capacity, dtype=np.int16)
+        self.merchants = np.empty(capacity, dtype=np.int32)
+        self.amounts = np.empty(capacity, dtype=np.float64)
+        self.category_names = []
+        self.merchant_names = []
+        self._category_codes = {}
+        self._merchant_codes = {}
+        self._lock = threading.RLock()
+
+    def _code(self, codes, names, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def _reserve(self, extra):
+        needed = self.size + extra
+        capacity = len(self.amounts)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        # Replace rather than resize in place so views handed to readers stay valid
+        for name in ("days", "categories", "merchants", "amounts"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def extend(self, expenses):
+        """Append a batch of expense dicts"""
+        if not expenses:
+            return
+        with self._lock:
+            self._reserve(len(expenses))
+            end = self.size + len(expenses)
+            self.days[self.size:end] = [to_day(expense["date"]) for expense in expenses]
+            self.categories[self.size:end] = [
+                self._code(self._category_codes, self.category_names, expense["category"])
+                for expense in expenses
+            ]
+            self.merchants[self.size:end] = [
+                self._code(self._merchant_codes, self.merchant_names, expense["merchant"])
+                for expense in expenses
+            ]
+            self.amounts[self.size:end] = [float(expense["amount"]) for expense in expenses]
+            self.size = end
+
+    def catch_up(self, store, batch_size=10000):
+        """Append expenses written to the store since the last catch-up"""
+        with self._lock:
+            while True:
+                expenses, position = store.changes_since(self.position, limit=batch_size)
+                if not expenses:
+                    return
+                self.extend(expenses)
+                self.position = position
+
+    def _select(self, start_date=None, end_date=None, category=None, dated=False):
+        """Return (days, categories, merchants, amounts) for the matching rows"""
+        with self._lock:
+            size = self.size
+            columns = (self.days[:size], self.categories[:size], self.merchants[:size], self.amounts[:size])
+            category_code = self._category_codes.get(category)
+
+        if category is not None and category_code is None:
+            return tuple(column[:0] for column in columns)
+
+        days = columns[0]
+        mask = None
+        conditions = []
+        if dated or start_date or end_date:
+            conditions.append(days != NO_DATE)
+        if start_date:
+            conditions.append(days >= to_day(start_date))
+        if end_date:
+            conditions.append(days <= to_day(end_date))
+        if category is not None:
+            conditions.append(columns[1] == category_code)
+        for condition in conditions:
+            mask = condition if mask is None else mask & condition
+        if mask is None:
+            return columns
+        return tuple(column[mask] for column in columns)
+
+    def timeseries(self, bucket="day", **filters):
+        """Return spending per day, ISO week or month, oldest first"""
+        days, _, _, amounts = self._select(dated=True, **filters)
+        keys, totals, counts = sum_by_code(bucket_keys(days, bucket), amounts)
+        series = []
+        for key, total, count in zip(keys.tolist(), totals.tolist(), counts.tolist()):
+            start = bucket_start(key, bucket)
+            series.append({
+                "period": period_keys(start)[bucket],
+                "start": start.isoformat(),
+                "total": round(total, 2),
+                "count": count
+            })
+        return series
+
+    def category_breakdown(self, **filters):
+        """Return spending per category, largest first, with its share of the total"""
+        _, categories, _, amounts = self._select(**filters)
+        codes, totals, counts = sum_by_code(categories.astype(np.int64), amounts)
+        overall = totals.sum() if len(totals) else 0.0
+        order = np.argsort(-totals, kind="stable")
+        return [
+            {
+                "category": self.category_names[codes[i]],
+                "total": round(float(totals[i]), 2),
+                "count": int(counts[i]),
+                "share": round(float(totals[i] / overall), 4) if overall else 0.0
+            }
+            for i in order
+        ]
+
+    def top_merchants(self, limit=10, **filters):
+        """Return the ``limit`` merchants with the highest spending"""
+        _, _, merchants, amounts = self._select(**filters)
+        codes, totals, counts = sum_by_code(merchants.astype(np.int64), amounts)
+        if len(totals) > limit:
+            top = np.argpartition(-totals, limit - 1)[:limit]
+        else:
+            top = np.arange(len(totals))
+        top = top[np.argsort(-totals[top], kind="stable")]
+        return [
+            {
+                "merchant": self.merchant_names[codes[i]],
+                "total": round(float(totals[i]), 2),
+                "count": int(counts[i])
+            }
+            for i in top
+        ]
+
+    def rolling_average(self, window=7, start_date=None, end_date=None, category=None, max_days=None):
+        """Return daily totals with the trailing ``window``-day average
+
+        Days without spending count as zero, so the series is continuous
+        between the first and last day in range. The range stops ``window``
+        days beyond the data at either end, where every row would be zero,
+        and a series longer than ``max_days`` raises ValueError.
+        """
+        days, _, _, amounts = self._select(start_date, end_date, category, dated=True)
+        if not len(days):
+            return []
+        low, high = int(days.min()), int(days.max())
+        first = max(to_day(start_date), low - window + 1) if start_date else low
+        last = min(to_day(end_date), high + window - 1) if end_date else high
+        if max_days is not None and last - first + 1 > max_days:
+            raise ValueError(f"the rolling series would span {last - first + 1} days, more than {max_days}")
+        daily = np.bincount(days - first, weights=amounts, minlength=last - first + 1)
+
+        cumulative = np.concatenate(([0.0], np.cumsum(daily)))
+        index = np.arange(1, len(daily) + 1)
+        lower = np.maximum(index - window, 0)
+        averages = (cumulative[index] - cumulative[lower]) / np.minimum(index, window)
+        return [
+            {
+                "date": from_day(first + offset).isoformat(),
+                "total": round(total, 2),
+                "average": round(average, 2)
+            }
+            for offset, (total, average) in enumerate(zip(daily.tolist(), averages.tolist()))
+        ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rows": self.size,
+                "capacity": len(self.amounts),
+                "categories": len(self.category_names),
+                "merchants": len(self.merchant_names),
+                "bytes": sum(column.nbytes for column in (self.days, self.categories, self.merchants, self.amounts))
+            }
@@ -0,0 +1,296 @@
+import asyncio
+import contextvars
+import functools
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import ai_coach
+from ai_coach import METRICS, TRACES, UserRejected
+from storage import DEFAULT_USER
+
+# Blocking OCR, DashScope and storage calls run on this many threads, which
+# caps how many requests one process has in flight
+ASGI_MAX_IN_FLIGHT = int(os.environ.get('ASGI_MAX_IN_FLIGHT', 256))
+
+def build_environ(scope, body, length):
+    """WSGI environ for an ASGI HTTP scope whose body has been spooled to ``body``"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f"HTTP_{name}"
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    # The whole body is spooled, so chunked uploads get a length too
+    environ['CONTENT_LENGTH'] = str(length)
+    return environ
+
+class Exchange:
+    """One ASGI HTTP request: its spooled body, parsed request and response channel
+
+    Blocking calls made through ``run`` share one copy of the request's
+    context, so its trace (and Flask's request context, when the WSGI app
+    serves it) follows the request from thread to thread.
+    """
+
+    def __init__(self, scope, send, body, length, executor):
+        self.scope = scope
+        self.body = body
+        self.length = length
+        self.request = ai_coach.SpooledRequest(build_environ(scope, body, length))
+        self.executor = executor
+        self.context = None
+        self.started = False
+        self._send = send
+
+    async def run(self, fn, *args):
+        """Await a blocking call on the thread pool"""
+        if self.context is None:
+            self.context = contextvars.copy_context()
+        call = functools.partial(self.context.run, fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def start(self, status, headers):
+        self.started = True
+        await self._send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers]
+        })
+
+    async def send(self, chunk, more=True):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        await self._send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+
+    async def send_json(self, app, body, status):
+        """Send a JSON response serialized the way Flask's jsonify does"""
+        data = (app.json.dumps(body) + '\n').encode('utf-8')
+        await self.start(status, [('Content-Type', 'application/json'), ('Content-Length', len(data))])
+        await self.send(data, more=False)
+        return status
+
+    async def stream(self, status, headers, chunks):
+        """Send a response whose body is produced by a blocking iterator
+
+        Each chunk is pulled on the thread pool and sent from the event
+        loop, so a slow reader holds no thread between chunks.
+        """
+        iterator = iter(chunks)
+        try:
+            await self.start(status, headers)
+            while True:
+                chunk = await self.run(next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await self.send(chunk)
+            await self.send(b'', more=False)
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                await self.run(close)
+        return status
+
+    async def serve_wsgi(self, app):
+        """Run the Flask app for this request on the thread pool"""
+        self.body.seek(0)
+        environ = build_environ(self.scope, self.body, self.length)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return lambda data: response.setdefault('written', []).append(data)
+
+        chunks = await self.run(app, environ, start_response)
+        if 'written' in response:
+            chunks = response.pop('written') + list(chunks)
+        await self.stream(response['status'], response['headers'], chunks)
+
+class AsgiApp:
+    """ASGI front end for the coach app
+
+    ``/upload``, ``/upload/batch``, ``/ask`` and ``/ask/stream`` are served
+    natively: the request body is received on the event loop and each
+    blocking OCR, DashScope or storage call is awaited on a bounded thread
+    pool, so one process can keep hundreds of API calls in flight while
+    uploads and streamed answers trickle over slow connections. They return
+    exactly what the Flask routes do. Every other route, and the cases of
+    those four that need Flask's request context (``async=1`` uploads,
+    bodies that are not JSON), runs the Flask app on the same pool.
+    """
+
+    def __init__(self, app, max_in_flight=ASGI_MAX_IN_FLIGHT):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix='asgi')
+        self.routes = {
+            ('POST', '/upload'): ('coach.upload_receipt', self.upload),
+            ('POST', '/upload/batch'): ('coach.upload_receipt_batch', self.upload_batch),
+            ('POST', '/ask'): ('coach.ask_question', self.ask),
+            ('POST', '/ask/stream'): ('coach.ask_question_stream', self.ask_stream)
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+        start = time.perf_counter()
+        body = tempfile.SpooledTemporaryFile(max_size=ai_coach.UPLOAD_SPOOL_MAX_BYTES)
+        try:
+            length = await self.receive_body(receive, body)
+            if length is None:
+                return
+            exchange = Exchange(scope, send, body, length, self.executor)
+            route = self.routes.get((scope['method'], scope['path']))
+            if route is None:
+                return await exchange.serve_wsgi(self.app)
+            await self.dispatch(exchange, start, *route)
+        finally:
+            body.close()
+
+    async def receive_body(self, receive, body):
+        """Spool the request body, returning its length or None if the client went away"""
+        length = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            body.write(chunk)
+            length += len(chunk)
+            if not message.get('more_body', False):
+                body.seek(0)
+                return length
+
+    async def dispatch(self, exchange, start, endpoint, handler):
+        """Serve a native route with the same timing and trace as the Flask hooks record"""
+        request = exchange.request
+        trace = TRACES.start(method=request.method, path=request.path)
+        status = 500
+        fallback = False
+        try:
+            try:
+                tenant = await exchange.run(ai_coach.resolve_tenant, request.headers.get(ai_coach.USER_HEADER, DEFAULT_USER))
+            except UserRejected as e:
+                status = await exchange.send_json(self.app, e.body, e.status)
+                return
+
+            status = await handler(exchange, tenant)
+            if status is None:
+                # Flask's own trace and timing cover the request from here
+                fallback = True
+                return await exchange.serve_wsgi(self.app)
+        except Exception as e:
+            print(f"ASGI error on {request.path}: {e}")
+            if not exchange.started:
+                await exchange.send_json(self.app, {"error": "Internal Server Error"}, 500)
+        finally:
+            request.close()
+            if not fallback:
+                METRICS.observe(
+                    'http_request_seconds',
+                    time.perf_counter() - start,
+                    endpoint=endpoint,
+                    method=request.method,
+                    status=status
+                )
+                TRACES.finish(trace, endpoint=endpoint, status=status)
+
+    async def upload(self, exchange, tenant):
+        request = exchange.request
+        if request.args.get('async') in ('1', 'true'):
+            return None
+
+        with METRICS.stage('receive'):
+            files = await exchange.run(lambda: request.files)
+        if 'receipt' not in files:
+            return await exchange.send_json(self.app, {"error": "No receipt file uploaded"}, 400)
+        receipt_file = files['receipt']
+        if receipt_file.filename == '':
+            return await exchange.send_json(self.app, {"error": "No file selected"}, 400)
+
+        allow_duplicate = request.args.get('allow_duplicate') in ('1', 'true')
+        body, status = await exchange.run(ai_coach.upload_result, receipt_file.stream, tenant.user_id, allow_duplicate)
+        with METRICS.stage('serialize'):
+            return await exchange.send_json(self.app, body, status)
+
+    async def upload_batch(self, exchange, tenant):
+        request = exchange.request
+        files = await exchange.run(lambda: request.files.getlist('receipts') + request.files.getlist('receipt'))
+        if not files:
+            return await exchange.send_json(self.app, {"error": "No receipt files uploaded"}, 400)
+
+        try:
+            items = await exchange.run(ai_coach.read_batch_files, files)
+        except (ValueError, zipfile.BadZipFile) as e:
+            return await exchange.send_json(self.app, {"error": str(e)}, 400)
+        if not items:
+            return await exchange.send_json(self.app, {"error": "No receipt images found"}, 400)
+
+        return await exchange.stream(200, [('Content-Type', 'application/x-ndjson')],
+                                     ai_coach.batch_results(items, tenant.user_id))
+
+    def question(self, exchange):
+        """Return the posted JSON, or None when Flask should answer (not JSON or malformed)"""
+        request = exchange.request
+        return request.get_json(silent=True) if request.is_json else None
+
+    async def ask(self, exchange, tenant):
+        data = self.question(exchange)
+        if data is None:
+            return None
+        if not data or 'question' not in data:
+            return await exchange.send_json(self.app, {"error": "No question provided"}, 400)
+
+        answer = await exchange.run(ai_coach.answer_question, tenant, data['question'])
+        return await exchange.send_json(self.app, {"answer": answer}, 200)
+
+    async def ask_stream(self, exchange, tenant):
+        data = self.question(exchange)
+        if data is None:
+            return None
+        if not data or 'question' not in data:
+            return await exchange.send_json(self.app, {"error": "No question provided"}, 400)
+
+        await exchange.run(tenant.catch_up)
+        headers = [('Content-Type', 'text/event-stream; charset=utf-8'), *ai_coach.SSE_HEADERS.items()]
+        return await exchange.stream(200, headers, ai_coach.insight_events(tenant, data['question']))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                ai_coach.JOB_QUEUE.stop()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+def create_asgi_app():
+    """Create the ASGI app, e.g. ``uvicorn asgi:create_asgi_app --factory``"""
+    return AsgiApp(ai_coach.create_app())
@@ -0,0 +1,172 @@
+"""Concurrency benchmark: the ASGI front end against threaded WSGI serving
+
+Sends the same burst of /ask and /upload requests to the Flask app from a
+fixed number of threads (as a threaded WSGI worker would serve them) and to
+the ASGI app from one event loop with every request in flight at once.
+Both run in one process against the fake backends, with the client pools
+sized to the burst. Reports throughput, latency percentiles and the peak
+number of concurrent DashScope calls.
+
+    python benchmarks/bench_asgi.py --requests 256 --threads 8 --profile typical
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fakes
+from run_benchmarks import CORPUS_PATH, git_revision, measure, summarize
+
+SCENARIOS = ("ask", "upload")
+BOUNDARY = "benchasgi"
+
+class InFlight:
+    """Wraps the generation call to count how many run at once"""
+
+    def __init__(self, call):
+        self.call = call
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        try:
+            return self.call(**kwargs)
+        finally:
+            with self._lock:
+                self.current -= 1
+
+def multipart(image):
+    head = (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"receipt\"; filename=\"r.jpg\"\r\n"
+            "Content-Type: image/jpeg\r\n\r\n").encode()
+    return head + image + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+def requests_for(scenario, count, run_id):
+    """(path, content type, body) for ``count`` distinct requests"""
+    if scenario == "ask":
+        # Distinct questions measure the uncached path
+        return [("/ask", "application/json",
+                 json.dumps({"question": f"How can I cut my spending? ({run_id}-{i})"}).encode())
+                for i in range(count)]
+    return [("/upload", f"multipart/form-data; boundary={BOUNDARY}",
+             multipart(fakes.fake_image(i, nonce=run_id * count + i))) for i in range(count)]
+
+async def call_asgi(app, path, content_type, body):
+    """Send one request straight to an ASGI app, returning the status code"""
+    scope = {
+        "type": "http", "method": "POST", "path": path, "root_path": "", "query_string": b"",
+        "http_version": "1.1", "scheme": "http", "server": ("bench", 80), "client": ("127.0.0.1", 0),
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    response = {}
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+
+    await app(scope, receive, send)
+    return response.get("status")
+
+def run_wsgi(app, batch, threads):
+    client = app.test_client()
+
+    def operation(i):
+        path, content_type, body = batch[i]
+        return client.post(path, data=body, content_type=content_type).status_code == 200
+    return measure("wsgi", len(batch), operation, len(batch), threads)
+
+def run_asgi(app, batch):
+    async def timed(request):
+        start = time.perf_counter()
+        try:
+            ok = await call_asgi(app, *request) == 200
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    async def burst():
+        return await asyncio.gather(*(timed(request) for request in batch))
+
+    start = time.perf_counter()
+    outcomes = asyncio.run(burst())
+    return summarize("asgi", len(batch), [duration for duration, _ in outcomes],
+                     sum(not ok for _, ok in outcomes), time.perf_counter() - start)
+
+def run(requests, threads, profile, selected):
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    # The client pools must not be the bottleneck being measured
+    os.environ.setdefault("OCR_POOL_SIZE", str(requests))
+    os.environ.setdefault("GENERATION_POOL_SIZE", str(requests))
+    os.environ.setdefault("DEDUP_ENABLED", "0")
+    os.environ.setdefault("OCR_RATE_LIMIT", "0")
+    os.environ.setdefault("GENERATION_RATE_LIMIT", "0")
+    os.chdir(tempfile.mkdtemp(prefix="bench-asgi-"))
+    import ai_coach
+    import asgi
+
+    fakes.install(ai_coach, profile, corpus)
+    in_flight = ai_coach.CLIENTS.generation_call = InFlight(ai_coach.CLIENTS.generation_call)
+    flask_app = ai_coach.create_app()
+    asgi_app = asgi.AsgiApp(flask_app, max_in_flight=requests)
+
+    results = []
+    for run_id, scenario in enumerate(selected):
+        for mode in ("wsgi", "asgi"):
+            batch = requests_for(scenario, requests, run_id * 2 + (mode == "asgi"))
+            in_flight.peak = 0
+            result = run_wsgi(flask_app, batch, threads) if mode == "wsgi" else run_asgi(asgi_app, batch)
+            result.update(scenario=scenario, mode=mode, peak_generation_calls=in_flight.peak)
+            del result["dataset_size"]
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+
+    return {
+        "benchmark": "asgi",
+        "revision": git_revision(),
+        "profile": profile,
+        "requests": requests,
+        "wsgi_threads": threads,
+        "results": results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=256, help="requests per burst, all in flight at once over ASGI")
+    parser.add_argument("--threads", type=int, default=8, help="WSGI worker threads")
+    parser.add_argument("--profile", default="typical", choices=sorted(fakes.PROFILES),
+                        help="latency/error profile of the fake backends")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset to run")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    selected = [name for name in args.scenarios.split(",") if name]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    results = run(args.requests, args.threads, args.profile, selected)
+    print(json.dumps(results, indent=2))
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
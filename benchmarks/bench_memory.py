@@ -0,0 +1,137 @@
+"""Memory benchmark for in-memory receipt and expense records
+
+Builds the same synthetic receipts and expenses twice: once as the plain
+dicts the app passes around, and once through MemoryStore, which keeps
+slotted records with OCR text spilled to a cold file. Reports heap bytes
+per receipt+expense pair (via tracemalloc), the cold file size and how
+long a filtered scan takes over each (records are converted back to
+dicts for the response, which the plain dicts do not need).
+
+    python benchmarks/bench_memory.py --records 1000000 --json memory.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from storage import MemoryStore
+
+CORPUS_PATH = os.path.join(BENCHMARK_DIR, "ocr_samples.json")
+
+def generate(corpus, count, seed=0):
+    """Yield (receipt, expense) dict pairs like the upload path builds"""
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    users = [f"user-{n}" for n in range(100)]
+    for n in range(count):
+        sample = rng.choice(corpus)
+        receipt_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        date = (today - datetime.timedelta(days=rng.randrange(365))).isoformat()
+        amount = round(rng.uniform(2, 250), 2)
+        user_id = rng.choice(users)
+        # Every OCR result is its own string, so give each copy a unique line
+        raw_text = f"{sample['text']}\nREF {n:08d}"
+        receipt = {
+            "id": receipt_id,
+            "user_id": user_id,
+            "date": date,
+            "merchant": sample["merchant"],
+            "total_amount": amount,
+            "currency": sample["currency"],
+            "items": [{"description": f"ITEM {n % 50}", "price": round(amount / 2, 2)},
+                      {"description": "BAG", "price": 0.0}],
+            "raw_text": raw_text
+        }
+        expense = {
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "receipt_id": receipt_id,
+            "user_id": user_id,
+            "date": date,
+            "merchant": sample["merchant"],
+            "amount": amount,
+            "category": sample["category"]
+        }
+        yield receipt, expense
+
+def measure_heap(build):
+    """Build a representation under tracemalloc and return it with the heap bytes it holds"""
+    gc.collect()
+    tracemalloc.start()
+    held = build()
+    gc.collect()
+    heap = tracemalloc.get_traced_memory()[0]
+    # Tracing slows every allocation and keeps a record of each, so it
+    # stops before the scan is timed
+    tracemalloc.stop()
+    return held, heap
+
+def run(records, corpus):
+    category = corpus[0]["category"]
+
+    def build_dicts():
+        receipts, expenses = {}, []
+        for receipt, expense in generate(corpus, records):
+            receipts[receipt["id"]] = receipt
+            expenses.append(expense)
+        return receipts, expenses
+
+    def scan_dicts(held):
+        return [expense for expense in held[1] if expense["category"] == category and expense["amount"] >= 50]
+
+    def build_records():
+        store = MemoryStore()
+        for receipt, expense in generate(corpus, records):
+            store.add(receipt, expense)
+        return store
+
+    def scan_records(store):
+        return store.page_expenses(records, category=category, min_amount=50)[0]
+
+    results = {}
+    for name, build, scan in (("dicts", build_dicts, scan_dicts), ("records", build_records, scan_records)):
+        held, heap = measure_heap(build)
+        start = time.perf_counter()
+        matched = scan(held)
+        results[name] = {
+            "heap_mb": round(heap / 2 ** 20, 1),
+            "bytes_per_pair": round(heap / records),
+            "filtered_scan_seconds": round(time.perf_counter() - start, 3),
+            "matched": len(matched)
+        }
+        if name == "records":
+            results[name]["cold_text_mb"] = round(held._texts.size / 2 ** 20, 1)
+        del held, matched
+
+    return {
+        "benchmark": "memory",
+        "records": records,
+        "python": sys.version.split()[0],
+        "results": results,
+        "heap_ratio": round(results["dicts"]["heap_mb"] / results["records"]["heap_mb"], 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1000000, help="receipt+expense pairs to build")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        corpus = json.load(f)
+    results = run(args.records, corpus)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Micro-benchmark for extract_receipt_data
+
+Parses the sample OCR corpus repeatedly and reports throughput, per-receipt
+latency and field accuracy against the labels in ocr_samples.json.
+
+    python benchmarks/bench_parser.py --repeat 2000 --json parser.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from receipt_parser import extract_receipt_data
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_samples.json")
+CHECKED_FIELDS = ("merchant", "date", "total_amount", "currency")
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def field_accuracy(corpus):
+    """Return the share of labeled fields the parser gets right"""
+    correct = 0
+    for sample in corpus:
+        parsed = extract_receipt_data(sample["text"])
+        correct += sum(parsed[field] == sample[field] for field in CHECKED_FIELDS)
+    return correct / (len(corpus) * len(CHECKED_FIELDS))
+
+def run(repeat):
+    corpus = load_corpus()
+    texts = [sample["text"] for sample in corpus]
+    total_bytes = sum(len(text.encode("utf-8")) for text in texts)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            extract_receipt_data(text)
+    elapsed = time.perf_counter() - start
+
+    parsed = repeat * len(texts)
+    return {
+        "benchmark": "extract_receipt_data",
+        "receipts": parsed,
+        "seconds": round(elapsed, 4),
+        "receipts_per_second": round(parsed / elapsed, 1),
+        "microseconds_per_receipt": round(elapsed / parsed * 1e6, 2),
+        "megabytes_per_second": round(total_bytes * repeat / elapsed / 1e6, 2),
+        "field_accuracy": round(field_accuracy(corpus), 4)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=1000, help="passes over the corpus")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
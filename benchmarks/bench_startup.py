@@ -0,0 +1,92 @@
+"""Cold-start benchmark for the Flask app
+
+Starts a fresh interpreter per run (as a new gunicorn worker or serverless
+instance would) and measures importing ai_coach, create_app(), the first
+/expenses request, and the SDK imports that are now deferred to the first
+OCR or DashScope call. "eager_equivalent" is the total before the
+deferral: the import plus the deferred SDK imports.
+
+    python benchmarks/bench_startup.py --runs 10 --json startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("alibabacloud_ocr_api20210707.client", "dashscope", "numpy")
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import ai_coach
+imported = time.perf_counter()
+app = ai_coach.create_app()
+created = time.perf_counter()
+loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+app.test_client().get('/expenses')
+first_request = time.perf_counter()
+deferred = 0.0
+for name in HEAVY_MODULES:
+    if name not in sys.modules:
+        before = time.perf_counter()
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+        deferred += time.perf_counter() - before
+print(json.dumps({
+    "import_seconds": imported - start,
+    "create_app_seconds": created - imported,
+    "first_request_seconds": first_request - created,
+    "deferred_sdk_seconds": deferred,
+    "eager_equivalent_seconds": imported - start + deferred,
+    "heavy_modules_at_startup": loaded
+}))
+"""
+
+def run_once():
+    workdir = tempfile.mkdtemp(prefix="startup-")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    code = f"HEAVY_MODULES = {HEAVY_MODULES!r}\n" + CHILD
+    output = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    # The app may print to stdout while importing; the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+def run(runs):
+    samples = [run_once() for _ in range(runs)]
+    timings = {}
+    for key in samples[0]:
+        if key.endswith("_seconds"):
+            values = sorted(sample[key] for sample in samples)
+            timings[key.replace("_seconds", "_ms")] = {
+                "median": round(statistics.median(values) * 1000, 2),
+                "min": round(values[0] * 1000, 2),
+                "max": round(values[-1] * 1000, 2)
+            }
+    return {
+        "benchmark": "startup",
+        "runs": runs,
+        "python": sys.version.split()[0],
+        "timings": timings,
+        "heavy_modules_at_startup": samples[0]["heavy_modules_at_startup"]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to start")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.runs)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Regression check for prompt trimming
+
+Compares full OCR text against the trimmed text sent to DashScope for every
+labeled sample in ocr_samples.json. Optionally each sample is padded with
+filler item lines to look like a long grocery receipt. Offline, it checks that
+trimming keeps the fields the parser recovers (merchant, date, total,
+currency). With --live it also categorizes every sample through DashScope
+with and without trimming and fails if accuracy against the labels drops.
+
+    python benchmarks/check_prompt_accuracy.py --pad 60
+    python benchmarks/check_prompt_accuracy.py --live --tolerance 0.0
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompts import estimate_tokens, salient_lines
+from receipt_parser import extract_receipt_data
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_samples.json")
+CHECKED_FIELDS = ("merchant", "date", "total_amount", "currency")
+
+def pad_receipt(text, lines):
+    """Insert cheap filler items before the totals, like a long grocery run"""
+    if not lines:
+        return text
+    rows = text.split("\n")
+    filler = [f"GROCERY ITEM {n:03d} {0.5 + n % 7 * 0.25:.2f}" for n in range(lines)]
+    # Keep the header (merchant, date) on top
+    return "\n".join(rows[:4] + filler + rows[4:])
+
+def check(corpus, budget, pad, live=False):
+    original_tokens = trimmed_tokens = 0
+    field_matches = field_total = 0
+    samples = []
+    for sample in corpus:
+        text = pad_receipt(sample["text"], pad)
+        trimmed = salient_lines(text, budget)
+        original_tokens += estimate_tokens(text)
+        trimmed_tokens += estimate_tokens(trimmed)
+
+        full_fields = extract_receipt_data(text)
+        trimmed_fields = extract_receipt_data(trimmed)
+        matches = [field for field in CHECKED_FIELDS if trimmed_fields[field] == full_fields[field]]
+        field_matches += len(matches)
+        field_total += len(CHECKED_FIELDS)
+        samples.append({
+            "name": sample["name"],
+            "text": text,
+            "category": sample["category"],
+            "lost_fields": [field for field in CHECKED_FIELDS if field not in matches]
+        })
+
+    report = {
+        "samples": len(corpus),
+        "budget_tokens": budget,
+        "pad_lines": pad,
+        "original_tokens": original_tokens,
+        "trimmed_tokens": trimmed_tokens,
+        "saved_share": round(1 - trimmed_tokens / original_tokens, 4) if original_tokens else 0.0,
+        "field_retention": round(field_matches / field_total, 4) if field_total else 1.0,
+        "lost_fields": {s["name"]: s["lost_fields"] for s in samples if s["lost_fields"]}
+    }
+    if live:
+        report.update(live_accuracy(samples, budget))
+    return report
+
+def live_accuracy(samples, budget):
+    """Categorize each sample through DashScope with full and trimmed text"""
+    import ai_coach
+
+    results = {}
+    for label, tokens in (("full", 10 ** 9), ("trimmed", budget)):
+        ai_coach.CATEGORIZE_TEXT_TOKENS = tokens
+        correct = 0
+        for sample in samples:
+            receipt = extract_receipt_data(sample["text"])
+            receipt["raw_text"] = sample["text"]
+            correct += ai_coach.categorize_with_dashscope(receipt) == sample["category"]
+        results[f"{label}_accuracy"] = round(correct / len(samples), 4)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget", type=int, default=int(os.environ.get("CATEGORIZE_TEXT_TOKENS", 200)),
+                        help="token budget for trimmed receipt text")
+    parser.add_argument("--pad", type=int, default=0, help="filler item lines added to each sample")
+    parser.add_argument("--live", action="store_true", help="also compare DashScope categorization accuracy")
+    parser.add_argument("--tolerance", type=float, default=0.0, help="allowed accuracy drop with --live")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        corpus = json.load(f)
+    report = check(corpus, args.budget, args.pad, live=args.live)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    failed = report["field_retention"] < 1.0
+    if args.live:
+        failed = failed or report["trimmed_accuracy"] < report["full_accuracy"] - args.tolerance
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""In-process stand-ins for the Alibaba Cloud OCR and DashScope APIs
+
+The fakes mimic the shape of the SDK responses the app reads and add
+configurable latency, error and throttling rates, so benchmarks exercise the
+real request path (pooling, retries, parsing) without network calls.
+"""
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+class LatencyProfile:
+    """Latency and failure behaviour of a fake backend
+
+    Each call sleeps for ``latency`` seconds +/- ``jitter`` (uniform). A
+    ``throttle_rate`` share of calls raise a throttling error (which the
+    client manager retries) and an ``error_rate`` share fail outright.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def outcome(self):
+        """Sleep for one call and return its outcome: ok, throttled or error"""
+        with self._lock:
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            roll = self._random.random()
+        time.sleep(delay)
+        if roll < self.throttle_rate:
+            return "throttled"
+        if roll < self.throttle_rate + self.error_rate:
+            return "error"
+        return "ok"
+
+# (OCR, DashScope) behaviour; "typical" is roughly what production sees
+PROFILES = {
+    "instant": (LatencyProfile(), LatencyProfile()),
+    "typical": (
+        LatencyProfile(latency=0.4, jitter=0.15, seed=1),
+        LatencyProfile(latency=1.2, jitter=0.4, seed=2)
+    ),
+    "flaky": (
+        LatencyProfile(latency=0.4, jitter=0.2, error_rate=0.02, throttle_rate=0.1, seed=1),
+        LatencyProfile(latency=1.2, jitter=0.6, error_rate=0.02, throttle_rate=0.1, seed=2)
+    ),
+    # DashScope incident: every call hangs until it times out, then fails
+    "outage": (
+        LatencyProfile(latency=0.4, jitter=0.15, seed=1),
+        LatencyProfile(latency=5.0, error_rate=1.0, seed=2)
+    )
+}
+
+class FakeThrottled(Exception):
+    """Raised like the SDKs do when a quota is exceeded"""
+    code = "Throttling.User"
+    status_code = 429
+
+class FakeServerError(Exception):
+    """Raised like the OCR SDK does for a 5xx response"""
+    code = "InternalError"
+    status_code = 500
+
+def fake_image(sample_index, nonce=0):
+    """Return upload bytes the fake OCR client maps back to a corpus sample"""
+    return f"FAKE-RECEIPT:{sample_index}:{nonce}".encode() + b"\0" * 256
+
+class FakeOcrClient:
+    """Stand-in for ``OcrClient`` that returns corpus text for fake images"""
+
+    def __init__(self, profile, corpus):
+        self.profile = profile
+        self.corpus = corpus
+        self.bytes_received = 0
+
+    def recognize_receipt(self, request):
+        body = request.body
+        data = body.read() if hasattr(body, "read") else bytes(body)
+        self.bytes_received += len(data)
+
+        outcome = self.profile.outcome()
+        if outcome == "throttled":
+            raise FakeThrottled("Request was denied due to user flow control")
+        if outcome == "error":
+            raise FakeServerError("InternalError: the OCR service failed")
+
+        match = re.match(rb"FAKE-RECEIPT:(\d+):", data)
+        text = self.corpus[int(match.group(1)) % len(self.corpus)]["text"] if match else ""
+        content = {"Data": {"Content": text}}
+        return SimpleNamespace(body=SimpleNamespace(to_map=lambda: content))
+
+class FakeGeneration:
+    """Stand-in for ``Generation.call``
+
+    Categorization prompts are answered from the corpus labels (by merchant),
+    batch prompts with a JSON array, and anything else with a short coaching
+    answer. Streaming calls yield the answer in a few chunks.
+    """
+
+    def __init__(self, profile, corpus, default_category="Other"):
+        self.profile = profile
+        self.default_category = default_category
+        self.categories = {sample["merchant"].lower(): sample["category"] for sample in corpus}
+        self.calls = 0
+
+    def _category(self, text):
+        text = text.lower()
+        for merchant, category in self.categories.items():
+            if merchant in text:
+                return category
+        return self.default_category
+
+    def _answer(self, prompt):
+        if "Return only a JSON array" in prompt:
+            lines = re.findall(r"^\s*\d+\. Merchant: (.*)$", prompt, re.MULTILINE)
+            return json.dumps([self._category(line) for line in lines])
+        if "Return only the category name" in prompt:
+            return self._category(prompt.split("The raw text", 1)[0])
+        return (
+            "Most of your spending goes to groceries and dining. Setting a weekly "
+            "dining budget and planning meals ahead would be the quickest saving."
+        )
+
+    def _response(self, status_code, text="", prompt=""):
+        return SimpleNamespace(
+            status_code=status_code,
+            code="" if status_code == 200 else "InternalError",
+            message="" if status_code == 200 else "The DashScope service failed",
+            output=SimpleNamespace(text=text),
+            usage=SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=len(text) // 4)
+        )
+
+    def __call__(self, prompt="", stream=False, **kwargs):
+        self.calls += 1
+        outcome = self.profile.outcome()
+        if outcome == "throttled":
+            raise FakeThrottled("Requests rate limit exceeded")
+        if outcome == "error":
+            response = self._response(500)
+            return iter([response]) if stream else response
+
+        answer = self._answer(prompt)
+        if not stream:
+            return self._response(200, answer, prompt)
+        words = answer.split(" ")
+        chunks = [" ".join(words[i:i + 8]) + " " for i in range(0, len(words), 8)]
+        return iter([self._response(200, chunk, prompt) for chunk in chunks])
+
+def install(app_module, profile_name, corpus):
+    """Point the app's shared clients at fakes for the named profile"""
+    ocr_profile, generation_profile = PROFILES[profile_name]
+    app_module.CLIENTS.ocr_pool.factory = lambda: FakeOcrClient(ocr_profile, corpus)
+    app_module.CLIENTS.generation_call = FakeGeneration(generation_profile, corpus)
+    # Keep retries short so throttling shows up as latency, not minutes of sleep
+    app_module.CLIENTS.backoff_base = 0.05
+    app_module.CLIENTS.backoff_max = 0.5
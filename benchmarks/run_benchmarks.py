@@ -0,0 +1,242 @@
+"""End-to-end benchmark and load test against fake OCR and DashScope backends
+
+Seeds the store to each dataset size, then drives /upload, /expenses and /ask
+through the Flask test client from several threads, alongside in-process
+runs of extract_receipt_data and the coach summary. Reports throughput and
+p50/p95/p99 latency per scenario and dataset size as JSON, so results from
+different commits can be diffed.
+
+    python benchmarks/run_benchmarks.py --sizes 1000,10000,100000 --profile typical --json results.json
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fakes
+
+SCENARIOS = ("parser", "summary", "expenses", "upload", "ask")
+CORPUS_PATH = os.path.join(BENCHMARK_DIR, "ocr_samples.json")
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def summarize(name, dataset_size, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "scenario": name,
+        "dataset_size": dataset_size,
+        "requests": count,
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput_per_second": round(count / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / count * 1000, 3) if count else 0.0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if count else 0.0
+        }
+    }
+
+def measure(name, dataset_size, operation, requests, concurrency):
+    """Run ``operation(i)`` ``requests`` times; it returns True on success"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = operation(i)
+        except Exception:
+            ok = False
+        duration = time.perf_counter() - start
+        with lock:
+            latencies.append(duration)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, range(requests)))
+    else:
+        for i in range(requests):
+            timed(i)
+    return summarize(name, dataset_size, latencies, errors, time.perf_counter() - start)
+
+def seed_expenses(app_module, corpus, count, rng):
+    """Write ``count`` synthetic receipts and expenses straight to the default user's store"""
+    tenant = app_module.TENANTS.get(app_module.DEFAULT_USER)
+    today = datetime.date.today()
+    for _ in range(count):
+        sample = rng.choice(corpus)
+        receipt_id = str(uuid.uuid4())
+        date = (today - datetime.timedelta(days=rng.randrange(365))).isoformat()
+        amount = round(rng.uniform(2, 250), 2)
+        receipt = {
+            "id": receipt_id,
+            "merchant": sample["merchant"],
+            "date": date,
+            "total_amount": amount,
+            "currency": sample["currency"],
+            "items": [],
+            "raw_text": sample["text"],
+            "image_path": ""
+        }
+        expense = {
+            "id": str(uuid.uuid4()),
+            "receipt_id": receipt_id,
+            "date": date,
+            "merchant": sample["merchant"],
+            "amount": amount,
+            "category": sample["category"]
+        }
+        tenant.store.add(receipt, expense)
+    tenant.catch_up()
+
+def scenarios(app_module, app, corpus):
+    """Return {name: operation} closures for one benchmark run"""
+    from receipt_parser import extract_receipt_data
+
+    clients = threading.local()
+    nonce = iter(range(10 ** 9))
+    nonce_lock = threading.Lock()
+
+    def client():
+        if not hasattr(clients, "client"):
+            clients.client = app.test_client()
+        return clients.client
+
+    def next_nonce():
+        with nonce_lock:
+            return next(nonce)
+
+    def parse(i):
+        extract_receipt_data(corpus[i % len(corpus)]["text"])
+        return True
+
+    aggregates = app_module.TENANTS.get(app_module.DEFAULT_USER).aggregates
+
+    def summary(i):
+        app_module.build_expenses_summary(aggregates)
+        return True
+
+    def expenses(i):
+        # Alternate the first page with a filtered query
+        query = "/expenses?limit=100" if i % 2 == 0 else f"/expenses?limit=100&category={corpus[i % len(corpus)]['category']}"
+        return client().get(query).status_code == 200
+
+    def upload(i):
+        # A fresh nonce per upload keeps the OCR cache from answering; the
+        # corpus repeats, so duplicates are allowed to measure the full pipeline
+        image = fakes.fake_image(i % len(corpus), next_nonce())
+        response = client().post("/upload?allow_duplicate=1", data={"receipt": (io.BytesIO(image), "receipt.jpg")},
+                                 content_type="multipart/form-data")
+        return response.status_code == 200
+
+    def ask(i):
+        # Distinct questions measure the uncached path
+        question = f"How can I cut my spending this month? ({next_nonce()})"
+        return client().post("/ask", json={"question": question}).status_code == 200
+
+    return {"parser": parse, "summary": summary, "expenses": expenses, "upload": upload, "ask": ask}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run(sizes, profile, requests, concurrency, selected, seed=0):
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    # Run against a throwaway data directory so the real databases are untouched
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("EXPENSE_STORE", "sqlite")
+    # The fakes have no quota to protect, so only the circuit breakers stay on
+    os.environ.setdefault("OCR_RATE_LIMIT", "0")
+    os.environ.setdefault("GENERATION_RATE_LIMIT", "0")
+    import ai_coach
+
+    fakes.install(ai_coach, profile, corpus)
+    operations = scenarios(ai_coach, ai_coach.create_app(), corpus)
+    # CPU-bound scenarios get more iterations; HTTP ones are bounded by fake latency
+    iterations = {"parser": requests * 20, "summary": requests * 20}
+
+    rng = random.Random(seed)
+    results = []
+    seeded = 0
+    for size in sorted(sizes):
+        seed_expenses(ai_coach, corpus, size - seeded, rng)
+        seeded = size
+        for name in selected:
+            parallel = 1 if name in ("parser", "summary") else concurrency
+            results.append(measure(name, size, operations[name], iterations.get(name, requests), parallel))
+            print(json.dumps(results[-1]), file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "profile": profile,
+            "requests": requests,
+            "concurrency": concurrency,
+            "workdir": workdir
+        },
+        "results": results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma-separated dataset sizes")
+    parser.add_argument("--profile", default="instant", choices=sorted(fakes.PROFILES),
+                        help="latency/error profile of the fake backends")
+    parser.add_argument("--requests", type=int, default=50, help="requests per HTTP scenario and size")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads for HTTP scenarios")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset to run")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    selected = [name for name in args.scenarios.split(",") if name]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    results = run(sizes, args.profile, args.requests, args.concurrency, selected)
+    print(json.dumps(results, indent=2))
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
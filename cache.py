@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+def stream_content_key(stream, chunk_size=64 * 1024):
+    """Return a stable content-addressed key for a seekable binary stream, rewinding it afterwards"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with an optional TTL (in seconds)"""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                # Expired entries count as misses and are dropped eagerly
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+class SQLiteCache:
+    """Persistent JSON cache stored in a SQLite database, evicted by LRU and TTL
+
+    Triggers keep the entry count in a meta row, so a write checks the
+    limit with one primary-key read instead of counting the table.
+    """
+
+    def __init__(self, path, max_entries=100000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache (accessed_at)")
+        conn.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS cache_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS cache_count_insert AFTER INSERT ON cache
+            BEGIN
+                UPDATE cache_meta SET value = value + 1 WHERE key = 'entries';
+            END;
+            CREATE TRIGGER IF NOT EXISTS cache_count_delete AFTER DELETE ON cache
+            BEGIN
+                UPDATE cache_meta SET value = value - 1 WHERE key = 'entries';
+            END;
+            INSERT OR IGNORE INTO cache_meta (key, value) SELECT 'entries', COUNT(*) FROM cache;
+            COMMIT;
+        """)
+
+    def _connection(self):
+        # SQLite connections cannot be shared across threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # INSERT OR REPLACE only fires the delete trigger for the row it replaces with this on
+            conn.execute("PRAGMA recursive_triggers = ON")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT value, created_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        value, created_at = row
+        if self.ttl and created_at + self.ttl < now:
+            with self._write_lock:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                conn.commit()
+            self.misses += 1
+            return None
+
+        with self._write_lock:
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        conn = self._connection()
+        now = time.time()
+        with self._write_lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            count = self._count(conn)
+            if count > self.max_entries:
+                overflow = count - self.max_entries
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY accessed_at ASC LIMIT ?)",
+                    (overflow,)
+                )
+                self.evictions += overflow
+            conn.commit()
+
+    def delete(self, key):
+        conn = self._connection()
+        with self._write_lock:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            conn.commit()
+
+    def clear(self):
+        conn = self._connection()
+        with self._write_lock:
+            conn.execute("DELETE FROM cache")
+            conn.commit()
+
+    def _count(self, conn):
+        return conn.execute("SELECT value FROM cache_meta WHERE key = 'entries'").fetchone()[0]
+
+    def __len__(self):
+        return self._count(self._connection())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+class TieredCache:
+    """In-memory LRU cache backed by an optional persistent cache
+
+    Lookups check memory first, then the persistent backend; disk hits are
+    promoted into memory so repeated lookups stay in-process.
+    """
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None
+        }
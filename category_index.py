@@ -0,0 +1,160 @@
+import os
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+
+# Suffixes and noise that differ between receipts from the same merchant
+MERCHANT_SUFFIXES = {"inc", "llc", "ltd", "co", "corp", "company", "store", "shop", "the"}
+NON_WORD = re.compile(r"[^a-z\u4e00-\u9fff]+")
+TOKEN_STOPWORDS = {"qty", "item", "items", "total", "subtotal", "tax", "ea", "each", "x"}
+
+def normalize_merchant(name):
+    """Normalize a merchant name so variants of the same store share a key
+
+    "Walmart Store #1234", "WALMART INC." and "walmart" all normalize to
+    "walmart". Digits (store numbers, phone numbers) and punctuation are dropped.
+    """
+    if not name:
+        return ""
+    words = NON_WORD.sub(" ", name.lower()).split()
+    words = [w for w in words if w not in MERCHANT_SUFFIXES]
+    if words == ["unknown"]:
+        # The placeholder used when OCR could not find a merchant
+        return ""
+    return " ".join(words)
+
+def item_tokens(items):
+    """Return the set of normalized word tokens found in receipt item descriptions"""
+    tokens = set()
+    for item in items or []:
+        description = item.get("description", "") if isinstance(item, dict) else str(item)
+        for word in NON_WORD.sub(" ", description.lower()).split():
+            if len(word) > 2 and word not in TOKEN_STOPWORDS:
+                tokens.add(word)
+    return tokens
+
+class CategoryIndex:
+    """Merchant -> category index filled from past categorizations
+
+    Each observed (merchant, category) pair is counted. A lookup is a hit
+    when the merchant has been seen at least ``min_observations`` times and
+    its most common category accounts for at least ``min_confidence`` of
+    them. Receipts from unknown merchants fall back to a vote over item
+    tokens, which must clear the same confidence bar. Counts are persisted
+    to SQLite when a path is given.
+    """
+
+    def __init__(self, path=None, min_observations=2, min_confidence=0.8):
+        self.path = path
+        self.min_observations = min_observations
+        self.min_confidence = min_confidence
+        self._merchants = defaultdict(lambda: defaultdict(int))
+        self._tokens = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+        self.low_confidence = 0
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS merchant_categories (
+                    merchant TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (merchant, category)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_categories (
+                    token TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (token, category)
+                )
+            """)
+            self._conn.commit()
+            self._load()
+
+    def _load(self):
+        for merchant, category, count in self._conn.execute(
+            "SELECT merchant, category, count FROM merchant_categories"
+        ):
+            self._merchants[merchant][category] = count
+        for token, category, count in self._conn.execute(
+            "SELECT token, category, count FROM token_categories"
+        ):
+            self._tokens[token][category] = count
+
+    def _best(self, counts):
+        total = sum(counts.values())
+        if total == 0:
+            return None, 0.0, 0
+        category = max(counts, key=counts.get)
+        return category, counts[category] / total, total
+
+    def lookup(self, merchant, items=None):
+        """Return (category, confidence) for a confident match, or None"""
+        key = normalize_merchant(merchant)
+        with self._lock:
+            counts = self._merchants.get(key) if key else None
+            if counts:
+                category, confidence, total = self._best(counts)
+            else:
+                # Unknown merchant: let the item tokens vote
+                votes = defaultdict(int)
+                for token in item_tokens(items):
+                    for token_category, count in self._tokens.get(token, {}).items():
+                        votes[token_category] += count
+                category, confidence, total = self._best(votes)
+
+            if category is None:
+                self.misses += 1
+                return None
+            if total < self.min_observations or confidence < self.min_confidence:
+                self.low_confidence += 1
+                return None
+
+            self.hits += 1
+            return category, confidence
+
+    def record(self, merchant, category, items=None):
+        """Count a categorization so future receipts from this merchant can reuse it"""
+        key = normalize_merchant(merchant)
+        tokens = item_tokens(items)
+        with self._lock:
+            if key:
+                self._merchants[key][category] += 1
+            for token in tokens:
+                self._tokens[token][category] += 1
+
+            if self._conn is not None:
+                if key:
+                    self._conn.execute(
+                        "INSERT INTO merchant_categories (merchant, category, count) VALUES (?, ?, 1) "
+                        "ON CONFLICT (merchant, category) DO UPDATE SET count = count + 1",
+                        (key, category)
+                    )
+                self._conn.executemany(
+                    "INSERT INTO token_categories (token, category, count) VALUES (?, ?, 1) "
+                    "ON CONFLICT (token, category) DO UPDATE SET count = count + 1",
+                    [(token, category) for token in tokens]
+                )
+                self._conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.low_confidence
+        return {
+            "merchants": len(self._merchants),
+            "hits": self.hits,
+            "misses": self.misses,
+            "low_confidence": self.low_confidence,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "llm_calls_saved": self.hits
+        }
@@ -0,0 +1,289 @@
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from resilience import BackendUnavailable
+
+# Error codes the Alibaba Cloud and DashScope APIs use when we exceed a quota
+THROTTLING_CODES = ("Throttling", "ServiceUnavailable")
+RETRYABLE_STATUS_CODES = (429, 503)
+
+def status_of(error_or_response):
+    """Return the HTTP status an SDK exception or response carries, or None"""
+    status = getattr(error_or_response, "status_code", None) or getattr(error_or_response, "statusCode", None)
+    data = getattr(error_or_response, "data", None)
+    if status is None and isinstance(data, dict):
+        status = data.get("statusCode")
+    return status
+
+def is_throttled(error_or_response):
+    """Return True if an SDK exception or response means we were throttled"""
+    if status_of(error_or_response) in RETRYABLE_STATUS_CODES:
+        return True
+    code = str(getattr(error_or_response, "code", "") or "")
+    return code.startswith(THROTTLING_CODES)
+
+def is_unavailable(error_or_response):
+    """Return True for a 5xx, a timeout or a connection error: the service failed, not the request"""
+    status = status_of(error_or_response)
+    if status is not None:
+        return status >= 500
+    # The SDKs wrap network errors in their own exceptions
+    error = error_or_response
+    seen = set()
+    while isinstance(error, BaseException) and id(error) not in seen:
+        if isinstance(error, OSError):
+            return True
+        seen.add(id(error))
+        error = getattr(error, "inner_exception", None) or error.__cause__ or error.__context__
+    return False
+
+class ClientPool:
+    """Fixed-size pool of reusable SDK clients
+
+    Clients are created lazily up to ``size`` and handed out one caller at a
+    time, so each keeps its own keep-alive connections warm between requests.
+    A caller waits at most ``timeout`` seconds for a client before
+    BackendUnavailable is raised.
+    """
+
+    def __init__(self, factory, size=4, timeout=30.0, service="ocr"):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.service = service
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._served = {}
+        self.created = 0
+        self.checkouts = 0
+        self.reused = 0
+
+    @contextmanager
+    def client(self):
+        client = self._checkout()
+        try:
+            yield client
+        finally:
+            self._idle.put(client)
+
+    def _checkout(self):
+        try:
+            client = self._idle.get_nowait()
+        except queue.Empty:
+            client = None
+            with self._lock:
+                if self.created < self.size:
+                    # A factory that raises must not use up the slot
+                    client = self.factory()
+                    self.created += 1
+            if client is None:
+                try:
+                    client = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise BackendUnavailable(self.service, "pool_exhausted", self.timeout) from None
+
+        with self._lock:
+            self.checkouts += 1
+            if self._served.get(id(client)):
+                self.reused += 1
+            self._served[id(client)] = self._served.get(id(client), 0) + 1
+        return client
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "clients_created": self.created,
+            "checkouts": self.checkouts,
+            "reused": self.reused,
+            "reuse_rate": round(self.reused / self.checkouts, 4) if self.checkouts else 0.0
+        }
+
+class ClientManager:
+    """Shared OCR and DashScope generation clients with retry on throttling
+
+    OCR calls go through a pool of long-lived ``OcrClient`` instances
+    instead of building a new client (and TLS session) per receipt.
+    Generation calls are bounded by a semaphore. Throttled calls on both
+    sides are retried with exponential backoff and jitter. When ``metrics``
+    is given, every attempt is timed and DashScope token usage is counted.
+
+    ``guards`` maps "ocr" and "dashscope" to a ServiceGuard that paces
+    attempts and fails them fast with BackendUnavailable while the service
+    is down, instead of letting requests queue up behind it.
+    """
+
+    def __init__(self, ocr_factory, generation_call, ocr_pool_size=4, generation_pool_size=8,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, metrics=None, guards=None,
+                 pool_timeout=30.0):
+        self.ocr_pool = ClientPool(ocr_factory, size=ocr_pool_size, timeout=pool_timeout)
+        self.generation_call = generation_call
+        self.generation_pool_size = generation_pool_size
+        self._generation_slots = threading.BoundedSemaphore(generation_pool_size)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = metrics
+        self.guards = guards or {}
+        self.counters = {
+            "ocr_calls": 0,
+            "ocr_retries": 0,
+            "generation_calls": 0,
+            "generation_retries": 0
+        }
+
+    def _timed(self, service):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.timer("external_call_seconds", service=service)
+
+    def _admit(self, service):
+        guard = self.guards.get(service)
+        if guard is None:
+            return
+        try:
+            guard.admit()
+        except BackendUnavailable as e:
+            if self.metrics is not None:
+                self.metrics.inc("backend_rejections_total", service=service, reason=e.reason)
+            raise
+
+    def _release(self, service):
+        guard = self.guards.get(service)
+        if guard is not None:
+            guard.release()
+
+    def _record_outcome(self, service, outcome):
+        guard = self.guards.get(service)
+        if guard is not None:
+            guard.record(outcome)
+        if self.metrics is not None:
+            self.metrics.inc("external_calls_total", service=service, outcome=outcome)
+
+    def _record_usage(self, response):
+        usage = getattr(response, "usage", None)
+        if self.metrics is None or usage is None:
+            return
+        input_tokens = getattr(usage, "input_tokens", 0) or 0
+        output_tokens = getattr(usage, "output_tokens", 0) or 0
+        self.metrics.observe("dashscope_prompt_tokens", input_tokens)
+        self.metrics.inc("dashscope_tokens_total", input_tokens, direction="input")
+        self.metrics.inc("dashscope_tokens_total", output_tokens, direction="output")
+
+    def _outcome(self, error_or_response):
+        """Classify an attempt as ok, throttled, error (the service failed) or rejected (the request did)"""
+        if is_throttled(error_or_response):
+            return "throttled"
+        if is_unavailable(error_or_response):
+            return "error"
+        if getattr(error_or_response, "status_code", 200) != 200 or isinstance(error_or_response, Exception):
+            return "rejected"
+        return "ok"
+
+    def _backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def recognize_receipt(self, request):
+        """Run RecognizeReceipt on a pooled OCR client"""
+        attempt = 0
+        while True:
+            self.counters["ocr_calls"] += 1
+            # Stream bodies must be rewound before a retry can resend them
+            if hasattr(request.body, "seek"):
+                request.body.seek(0)
+            self._admit("ocr")
+            try:
+                with self.ocr_pool.client() as client, self._timed("ocr"):
+                    response = client.recognize_receipt(request)
+                self._record_outcome("ocr", "ok")
+                return response
+            except BackendUnavailable:
+                # No client was free, so the service was never called
+                self._release("ocr")
+                raise
+            except Exception as e:
+                self._record_outcome("ocr", self._outcome(e))
+                if not is_throttled(e) or attempt >= self.max_retries:
+                    raise
+                self.counters["ocr_retries"] += 1
+                self._backoff(attempt)
+                attempt += 1
+
+    def generate(self, **kwargs):
+        """Call DashScope Generation, retrying throttled requests
+
+        Streaming calls (``stream=True``) return the SDK's generator and are
+        not retried; they hold a generation slot until the stream ends or is
+        closed, so start iterating what is returned right away.
+        """
+        if kwargs.get("stream"):
+            self._admit("dashscope")
+            self.counters["generation_calls"] += 1
+            self._generation_slots.acquire()
+            try:
+                responses = self.generation_call(**kwargs)
+            except Exception as e:
+                self._generation_slots.release()
+                self._record_outcome("dashscope", self._outcome(e))
+                raise
+            return self._stream(responses)
+
+        attempt = 0
+        while True:
+            self._admit("dashscope")
+            self.counters["generation_calls"] += 1
+            with self._generation_slots:
+                try:
+                    with self._timed("dashscope"):
+                        response = self.generation_call(**kwargs)
+                except Exception as e:
+                    self._record_outcome("dashscope", self._outcome(e))
+                    if not is_throttled(e) or attempt >= self.max_retries:
+                        raise
+                    response = e
+                else:
+                    self._record_outcome("dashscope", self._outcome(response))
+            if not is_throttled(response) or attempt >= self.max_retries:
+                self._record_usage(response)
+                return response
+            self.counters["generation_retries"] += 1
+            self._backoff(attempt)
+            attempt += 1
+
+    def _stream(self, responses):
+        """Pass a streamed answer through, timing it and counting its final usage
+
+        The outcome is recorded once: at the first failed chunk, when the
+        stream raises, or when it ends or is closed early, so an abandoned
+        stream still settles a half-open breaker's trial call.
+        """
+        outcome = None
+        last = None
+        try:
+            with self._timed("dashscope_stream"):
+                for last in responses:
+                    if outcome is None and self._outcome(last) != "ok":
+                        outcome = self._outcome(last)
+                        self._record_outcome("dashscope", outcome)
+                    yield last
+        except Exception as e:
+            if outcome is None:
+                outcome = self._outcome(e)
+                self._record_outcome("dashscope", outcome)
+            raise
+        finally:
+            self._generation_slots.release()
+            if outcome is None:
+                # Every chunk so far succeeded, whether the stream ended or was closed
+                self._record_outcome("dashscope", "ok" if last is not None else "error")
+        self._record_usage(last)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["ocr_pool"] = self.ocr_pool.stats()
+        stats["generation_pool_size"] = self.generation_pool_size
+        stats["guards"] = {service: guard.stats() for service, guard in self.guards.items()}
+        return stats
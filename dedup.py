@@ -0,0 +1,399 @@
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+
+from category_index import normalize_merchant
+from receipt_parser import find_date
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it only the OCR-text checks run
+    Image = None
+
+HASH_BITS = 64
+TEXT_TOKEN = re.compile(r"[a-z0-9\u4e00-\u9fff]+")
+
+# MinHash signatures of OCR text: 32 hash functions, compared 4 at a time
+MINHASH_PERMUTATIONS = 32
+MINHASH_BANDS = 8
+MERSENNE_PRIME = (1 << 61) - 1
+
+def make_permutations(count, seed=0):
+    """Fixed (a, b) pairs for the MinHash functions, identical in every process"""
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME)) for _ in range(count)]
+
+PERMUTATIONS = make_permutations(MINHASH_PERMUTATIONS)
+
+def dhash(stream, size=8):
+    """Perceptual difference hash of an image stream as a 64-bit int
+
+    The image is shrunk to (size + 1) x size grayscale pixels and each bit
+    records whether a pixel is brighter than its right neighbour, so
+    re-encodes, resizes and small lighting changes keep most bits. Returns
+    None when Pillow is missing or the data is not an image. The stream is
+    left rewound.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(stream) as image:
+            image = ImageOps.exif_transpose(image).convert("L").resize((size + 1, size))
+            pixels = list(image.getdata())
+    except Exception:
+        return None
+    finally:
+        stream.seek(0)
+
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    # Flat images (blank pages) have no gradients to tell them apart
+    return value or None
+
+def text_shingles(text, size=3):
+    """Character trigrams of OCR text with case, punctuation and spacing normalized"""
+    text = " ".join(TEXT_TOKEN.findall((text or "").lower()))
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))} if text else set()
+
+def minhash(text):
+    """MinHash signature of OCR text, or None for empty text
+
+    The share of positions where two signatures agree estimates the
+    Jaccard similarity of the texts' trigrams, so a re-scan of the same
+    receipt scores close to 1 despite a few OCR misreads.
+    """
+    shingles = text_shingles(text)
+    if not shingles:
+        return None
+    values = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+              for s in shingles]
+    return tuple(min((a * value + b) % MERSENNE_PRIME for value in values) for a, b in PERMUTATIONS)
+
+def similarity(a, b):
+    """Share of MinHash positions two signatures agree on"""
+    return sum(x == y for x, y in zip(a, b)) / MINHASH_PERMUTATIONS
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+def printed_date(receipt):
+    """The receipt's date if OCR found one in its text, or None
+
+    The parser falls back to today's date when the text has none, and two
+    receipts sharing that says nothing about whether they are the same.
+    """
+    text = receipt.get("raw_text") or ""
+    if not any(find_date(line) for line in text.split("\n")):
+        return None
+    return receipt.get("date")
+
+def receipt_key(receipt):
+    """(merchant, date, amount in cents) key, or None for receipts OCR could not read"""
+    merchant = normalize_merchant(receipt.get("merchant"))
+    cents = round(float(receipt.get("total_amount") or 0) * 100)
+    date = printed_date(receipt)
+    if not merchant or not date or cents <= 0:
+        return None
+    return f"{merchant}|{date}|{cents}"
+
+class HammingIndex:
+    """Multi-index hash table for finding 64-bit hashes within ``max_distance`` bits
+
+    Hashes are split into ``max_distance + 1`` bands and filed under each
+    band's value. Any hash within the distance must match at least one band
+    exactly (pigeonhole), so a lookup only compares the few entries sharing
+    a band instead of scanning every stored hash.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        widths = [HASH_BITS // bands + (band < HASH_BITS % bands) for band in range(bands)]
+        self._bands = []
+        shift = 0
+        for width in widths:
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [defaultdict(list) for _ in self._bands]
+
+    def add(self, scope, value, item):
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table[(scope, value >> shift & mask)].append((value, item))
+
+    def matches(self, scope, value):
+        """Return (distance, item) for every hash within range, closest first"""
+        found = {}
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            for other, item in table.get((scope, value >> shift & mask), ()):
+                distance = hamming(value, other)
+                if distance <= self.max_distance:
+                    found[id(item)] = (distance, item)
+        return sorted(found.values(), key=lambda match: match[0])
+
+    def discard(self, receipt_id):
+        """Remove every entry whose item belongs to ``receipt_id`` (a scan; only failed saves need it)"""
+        removed = False
+        for table in self._tables:
+            for entries in table.values():
+                kept = [entry for entry in entries if entry[1][0] != receipt_id]
+                removed = removed or len(kept) < len(entries)
+                entries[:] = kept
+        return removed
+
+class MinHashIndex:
+    """Locality-sensitive index over MinHash signatures
+
+    Signatures are split into bands and filed under each band's values;
+    texts similar enough to share a whole band become candidates, and
+    only candidates are scored. With 8 bands of 4, pairs at 0.85
+    similarity are found 99.7% of the time while dissimilar receipts
+    rarely collide.
+    """
+
+    def __init__(self, threshold, bands=MINHASH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = MINHASH_PERMUTATIONS // bands
+        self._tables = [defaultdict(list) for _ in range(bands)]
+
+    def _keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    def add(self, scope, signature, item):
+        for band, key in self._keys(signature):
+            self._tables[band][(scope, key)].append((signature, item))
+
+    def matches(self, scope, signature):
+        """Yield (similarity, item) for candidates at or above the threshold, best first"""
+        scored = {}
+        for band, key in self._keys(signature):
+            for other, item in self._tables[band].get((scope, key), ()):
+                score = similarity(signature, other)
+                if score >= self.threshold:
+                    scored[id(item)] = (score, item)
+        return sorted(scored.values(), key=lambda match: -match[0])
+
+    def discard(self, receipt_id):
+        removed = False
+        for table in self._tables:
+            for entries in table.values():
+                kept = [entry for entry in entries if entry[1][0] != receipt_id]
+                removed = removed or len(kept) < len(entries)
+                entries[:] = kept
+        return removed
+
+class DuplicateReceipt(Exception):
+    """Raised when an upload matches a receipt the user has already stored"""
+
+    def __init__(self, match):
+        super().__init__(f"Duplicate of receipt {match['receipt_id']} ({match['reason']})")
+        self.match = match
+
+class DuplicateIndex:
+    """Per-user index of stored receipts for spotting repeat uploads
+
+    Three checks after OCR, each a hash lookup rather than a scan:
+
+    - ``image``: perceptual hash of the photo; receipts from one till look
+      alike, so a near photo must also agree on the date and the amount
+    - ``key``: exact (merchant, date, amount) after OCR; when both receipts
+      have text it must also be similar, as a repeat purchase (the same
+      coffee twice in a day) shares the key but not the till's receipt
+    - ``text``: MinHash similarity of the OCR text, for re-takes where OCR
+      misread the merchant; it must also agree on the date and the amount
+
+    Only a date printed on the receipt counts as agreeing: one the parser
+    defaulted to today is never evidence.
+
+    Fingerprints are persisted to SQLite when a path is given, loaded on
+    first use and topped up with other processes' rows before each check.
+    ``claim`` checks and records inside one write transaction, so two
+    workers cannot both store copies of the same receipt.
+    """
+
+    def __init__(self, path=None, image_distance=4, text_similarity=0.85):
+        self.path = path
+        self._images = HammingIndex(image_distance)
+        self._texts = MinHashIndex(text_similarity)
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._loaded = False
+        self._synced = 0
+        self.entries = 0
+        self.checks = 0
+        self.duplicates = defaultdict(int)
+
+    def _ensure_loaded(self):
+        # Caller holds the lock
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS receipt_fingerprints (
+                -- AUTOINCREMENT so a released fingerprint's rowid is never reused
+                -- and slipped past other processes' sync high-water mark
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                receipt_id TEXT NOT NULL UNIQUE,
+                user_id TEXT NOT NULL,
+                image_hash TEXT,
+                receipt_key TEXT,
+                text_signature TEXT,
+                date TEXT,
+                amount REAL
+            )
+        """)
+        self._sync()
+
+    def _sync(self):
+        """Index fingerprints recorded since the last sync, by this or any other process"""
+        # Caller holds the lock
+        if self._conn is None:
+            return
+        for row in self._conn.execute(
+            "SELECT rowid, receipt_id, user_id, image_hash, receipt_key, text_signature, date, amount "
+            "FROM receipt_fingerprints WHERE rowid > ? ORDER BY rowid", (self._synced,)
+        ):
+            rowid, receipt_id, user_id, image_hash, key, signature, date, amount = row
+            self._index(user_id, receipt_id, image_hash and int(image_hash, 16), key,
+                        signature and tuple(int(value, 16) for value in signature.split()), date, amount)
+            self._synced = rowid
+
+    def _index(self, user_id, receipt_id, image_hash, key, signature, date, amount):
+        if image_hash is not None:
+            self._images.add(user_id, image_hash, (receipt_id, date, amount))
+        if key is not None:
+            self._keys[(user_id, key)] = (receipt_id, signature)
+        if signature is not None:
+            self._texts.add(user_id, signature, (receipt_id, date, amount))
+        self.entries += 1
+
+    def _forget(self, receipt_id):
+        # Caller holds the lock
+        found = self._images.discard(receipt_id)
+        found = self._texts.discard(receipt_id) or found
+        for scope_key, (stored_id, _) in list(self._keys.items()):
+            if stored_id == receipt_id:
+                del self._keys[scope_key]
+                found = True
+        if found:
+            self.entries -= 1
+
+    def _match(self, user_id, receipt, signature, image_hash=None):
+        """Like _match_receipt, skipping receipts another process has released since indexing them"""
+        while True:
+            match = self._match_receipt(user_id, receipt, signature, image_hash)
+            if match is None or self._conn is None:
+                return match
+            if self._conn.execute("SELECT 1 FROM receipt_fingerprints WHERE receipt_id = ?",
+                                  (match["receipt_id"],)).fetchone():
+                return match
+            self.duplicates[match["reason"]] -= 1
+            self._forget(match["receipt_id"])
+
+    def _found(self, reason, receipt_id, score=1.0):
+        self.duplicates[reason] += 1
+        return {"receipt_id": receipt_id, "reason": reason, "score": round(score, 3)}
+
+    def _match_receipt(self, user_id, receipt, signature, image_hash=None):
+        key = receipt_key(receipt)
+        if key is not None and (user_id, key) in self._keys:
+            receipt_id, other = self._keys[(user_id, key)]
+            if signature is None or other is None:
+                return self._found("key", receipt_id)
+            if similarity(signature, other) >= self._texts.threshold:
+                return self._found("key", receipt_id, similarity(signature, other))
+        date = printed_date(receipt)
+        if image_hash is not None and date is not None:
+            for distance, (receipt_id, other_date, amount) in self._images.matches(user_id, image_hash):
+                if other_date == date and amount == receipt.get("total_amount"):
+                    return self._found("image", receipt_id, 1 - distance / HASH_BITS)
+        if signature is not None and date is not None:
+            for score, (receipt_id, other_date, amount) in self._texts.matches(user_id, signature):
+                if other_date == date and amount == receipt.get("total_amount"):
+                    return self._found("text", receipt_id, score)
+        return None
+
+    def check_receipt(self, user_id, receipt, image_hash=None):
+        """Return the match for OCR results of an already stored receipt, or None"""
+        signature = minhash(receipt.get("raw_text"))
+        with self._lock:
+            self._ensure_loaded()
+            self._sync()
+            self.checks += 1
+            return self._match(user_id, receipt, signature, image_hash)
+
+    def claim(self, user_id, receipt, image_hash=None, force=False):
+        """Record a receipt unless it duplicates a stored one; return the match if it does
+
+        Checking and recording happen under one lock and, with a database,
+        one write transaction that first picks up every other process's
+        fingerprints, so two copies of the same receipt arriving together
+        cannot both be stored. ``force`` records the receipt without checking.
+        """
+        key = receipt_key(receipt)
+        signature = minhash(receipt.get("raw_text"))
+        date = printed_date(receipt)
+        with self._lock:
+            self._ensure_loaded()
+            if self._conn is None:
+                match = None if force else self._match_receipt(user_id, receipt, signature, image_hash)
+                if match is None:
+                    self._index(user_id, receipt["id"], image_hash, key, signature, date, receipt.get("total_amount"))
+                return match
+
+            # Holds SQLite's write lock, so other workers' claims wait for this one
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._sync()
+                if not force:
+                    match = self._match(user_id, receipt, signature, image_hash)
+                    if match is not None:
+                        self._conn.execute("COMMIT")
+                        return match
+                cursor = self._conn.execute(
+                    "INSERT OR REPLACE INTO receipt_fingerprints "
+                    "(receipt_id, user_id, image_hash, receipt_key, text_signature, date, amount) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (receipt["id"], user_id, None if image_hash is None else f"{image_hash:016x}", key,
+                     None if signature is None else " ".join(f"{value:x}" for value in signature),
+                     date, receipt.get("total_amount"))
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._index(user_id, receipt["id"], image_hash, key, signature, date, receipt.get("total_amount"))
+            self._synced = max(self._synced, cursor.lastrowid)
+        return None
+
+    def release(self, receipt_id):
+        """Drop a claimed receipt's fingerprint, for a receipt whose save failed after ``claim``"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM receipt_fingerprints WHERE receipt_id = ?", (receipt_id,))
+            self._forget(receipt_id)
+
+    def stats(self):
+        return {
+            "entries": self.entries,
+            "checks": self.checks,
+            "duplicates": dict(self.duplicates)
+        }
@@ -0,0 +1,53 @@
+import io
+import shutil
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are sent as uploaded
+    Image = None
+
+def spool_copy(source, max_memory):
+    """Copy a binary stream into a buffer that spills to disk above ``max_memory`` bytes"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    shutil.copyfileobj(source, spooled, 64 * 1024)
+    spooled.seek(0)
+    return spooled
+
+def stream_size(stream):
+    """Return the size of a seekable stream, leaving it positioned at the start"""
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def downscale_for_ocr(stream, max_dimension=2000, min_bytes=1024 * 1024, quality=85):
+    """Shrink oversized photos before OCR
+
+    Images over ``min_bytes`` are rotated upright, scaled to fit within
+    ``max_dimension`` pixels and re-encoded as JPEG. The original stream is
+    returned (rewound) when Pillow is missing, the data is not an image, or
+    re-encoding would not make it smaller.
+    """
+    size = stream_size(stream)
+    if Image is None or size < min_bytes:
+        return stream
+
+    try:
+        with Image.open(stream) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_dimension, max_dimension))
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=quality, optimize=True)
+    except Exception:
+        # PDFs and formats Pillow cannot read go to OCR untouched
+        stream.seek(0)
+        return stream
+
+    if output.tell() >= size:
+        stream.seek(0)
+        return stream
+    output.seek(0)
+    return output
@@ -0,0 +1,318 @@
+import http.client
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import uuid
+
+class RetryLater(Exception):
+    """Raised by a handler to run its job again after ``delay`` seconds without using up an attempt"""
+
+    def __init__(self, delay, reason=""):
+        super().__init__(reason or f"retry in {delay:.1f}s")
+        self.delay = delay
+
+def resolve_callback(url, allowed_hosts=None):
+    """Check a callback URL and return the address to send it to
+
+    Raises ValueError unless the URL is http(s) and its host resolves only
+    to public addresses, so a client cannot point the callback at loopback,
+    private, link-local or reserved hosts such as a metadata service. Hosts
+    in ``allowed_hosts`` are trusted wherever they resolve; when it is given,
+    no other host is accepted.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("callback_url must be an http(s) URL")
+    host = parts.hostname.lower()
+    if allowed_hosts and host not in allowed_hosts:
+        raise ValueError(f"callback_url host {host} is not allowed")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (ValueError, socket.gaierror) as e:
+        raise ValueError(f"callback_url host {host} cannot be resolved: {e}")
+    addresses = [info[4][0] for info in infos]
+    if not allowed_hosts:
+        for address in addresses:
+            if not ipaddress.ip_address(address.split("%")[0]).is_global:
+                raise ValueError(f"callback_url host {host} is not a public address")
+    return addresses[0]
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to an address resolved in advance, so DNS cannot change it after the check"""
+
+    def __init__(self, host, port=None, address=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host, port=None, address=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+def post_callback(url, body, address, timeout=10):
+    """POST a JSON body to a checked callback URL; redirects are not followed"""
+    parts = urllib.parse.urlsplit(url)
+    connection_class = PinnedHTTPSConnection if parts.scheme == "https" else PinnedHTTPConnection
+    conn = connection_class(parts.hostname, parts.port, address=address, timeout=timeout)
+    try:
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        if response.status >= 300:
+            raise ValueError(f"callback answered HTTP {response.status}")
+    finally:
+        conn.close()
+
+class JobQueue:
+    """Persistent job queue stored in SQLite and processed by worker threads
+
+    Jobs are claimed with a lease, so a job whose worker died (process
+    restart, crash) is picked up again once its lease expires. Several
+    processes can share one queue database. Failed jobs are retried up to
+    ``max_attempts`` times before being marked failed. Callback URLs must
+    pass ``resolve_callback``, restricted to ``callback_hosts`` if given.
+    """
+
+    def __init__(self, path, workers=2, lease_seconds=600, max_attempts=3, poll_interval=0.5,
+                 callback_hosts=None):
+        self.path = path
+        self.callback_hosts = {host.lower() for host in callback_hosts or ()}
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._failure_handlers = {}
+        self._threads = []
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._stopping = False
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                callback_url TEXT,
+                lease_until REAL,
+                run_after REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after, created_at);
+        """)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def register(self, kind, handler, on_failed=None):
+        """Register the function that processes jobs of a given kind
+
+        The handler receives the job payload and returns a JSON-serializable
+        result. Raising an exception fails the attempt. ``on_failed`` is
+        called with the payload once the last attempt has failed, to clean up
+        what the job would otherwise have consumed.
+        """
+        self._handlers[kind] = handler
+        if on_failed is not None:
+            self._failure_handlers[kind] = on_failed
+
+    def check_callback(self, callback_url):
+        """Raise ValueError if a callback URL would not be accepted"""
+        resolve_callback(callback_url, self.callback_hosts)
+
+    def submit(self, kind, payload, callback_url=None, delay=0, job_id=None):
+        """Queue a job and return its id
+
+        Passing a fixed ``job_id`` reuses that job's row: a finished or
+        running job is queued to run again, and one already queued is left
+        as it is, so a recurring job never adds rows.
+        """
+        now = time.time()
+        if job_id is None:
+            job_id = str(uuid.uuid4())
+            self._connection().execute(
+                "INSERT INTO jobs (id, kind, payload, status, callback_url, run_after, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), callback_url, now + delay, now, now)
+            )
+        else:
+            self._connection().execute(
+                "INSERT INTO jobs (id, kind, payload, status, callback_url, run_after, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET status = 'queued', payload = excluded.payload, attempts = 0, "
+                "result = NULL, error = NULL, callback_url = excluded.callback_url, lease_until = NULL, "
+                "run_after = excluded.run_after, created_at = excluded.created_at, updated_at = excluded.updated_at "
+                "WHERE jobs.status != 'queued'",
+                (job_id, kind, json.dumps(payload), callback_url, now + delay, now, now)
+            )
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return job_id
+
+    def get(self, job_id):
+        """Return a job's status and result, or None if it does not exist"""
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    def wait(self, job_id, timeout):
+        """Return the job once it finishes or ``timeout`` seconds pass"""
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in ("succeeded", "failed") or time.time() >= deadline:
+                return job
+            with self._wakeup:
+                self._wakeup.wait(min(self.poll_interval, max(0, deadline - time.time())))
+
+    def stats(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in rows}
+
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _claim(self):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                "OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                    "lease_until = ?, updated_at = ? WHERE id = ?",
+                    (now + self.lease_seconds, now, row["id"])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def _work(self):
+        while not self._stopping:
+            try:
+                row = self._claim()
+            except sqlite3.OperationalError as e:
+                print(f"Job queue error: {e}")
+                row = None
+
+            if row is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            self._run(row)
+
+    def _run(self, row):
+        conn = self._connection()
+        handler = self._handlers.get(row["kind"])
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for job kind {row['kind']}")
+            result = handler(json.loads(row["payload"]))
+        except RetryLater as e:
+            # The backend the job needs is down; wait for it rather than failing the job
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, error = ?, lease_until = NULL, "
+                "run_after = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                (str(e), time.time() + e.delay, time.time(), row["id"])
+            )
+            return
+        except Exception as e:
+            print(f"Job {row['id']} failed: {e}")
+            attempts = row["attempts"] + 1
+            status = "failed" if attempts >= self.max_attempts else "queued"
+            # Back off before the next attempt
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, run_after = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'running'",
+                (status, str(e), time.time() + 2 ** attempts, time.time(), row["id"])
+            )
+            if status == "failed":
+                on_failed = self._failure_handlers.get(row["kind"])
+                if on_failed is not None:
+                    try:
+                        on_failed(json.loads(row["payload"]))
+                    except Exception as cleanup_error:
+                        print(f"Job {row['id']} cleanup failed: {cleanup_error}")
+                self._notify(row["id"], row["callback_url"])
+            return
+
+        # A job submitted again while it ran stays queued for its next run
+        conn.execute(
+            "UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND status = 'running'",
+            (json.dumps(result), time.time(), row["id"])
+        )
+        self._notify(row["id"], row["callback_url"])
+
+    def _notify(self, job_id, callback_url):
+        with self._wakeup:
+            self._wakeup.notify_all()
+        if not callback_url:
+            return
+
+        # Completion callbacks are best effort. The host is checked again
+        # here, as its DNS may have changed since the job was queued
+        try:
+            address = resolve_callback(callback_url, self.callback_hosts)
+            post_callback(callback_url, json.dumps(self.get(job_id)).encode(), address)
+        except Exception as e:
+            print(f"Job callback to {callback_url} failed: {e}")
@@ -0,0 +1,288 @@
+"""Local first-tier expense categorizer
+
+A hashing-vectorizer + multinomial logistic regression model trained on our
+own categorized expense history. It runs on the CPU in well under a
+millisecond, so obvious receipts never need a DashScope call.
+
+Retrain offline and print an accuracy/latency report on held-out data:
+
+    python local_classifier.py train --db data/expenses.db --out data/local_classifier.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+
+from category_index import NON_WORD, normalize_merchant
+
+MAX_TEXT_CHARS = 2000
+
+def words(text):
+    return [word for word in NON_WORD.sub(" ", text.lower()).split() if len(word) > 1]
+
+def extract_features(receipt, n_features):
+    """Hash merchant, item and receipt text tokens into a sparse feature dict"""
+    merchant = normalize_merchant(receipt.get("merchant", ""))
+    tokens = [f"m:{word}" for word in merchant.split()]
+    if merchant:
+        tokens.append(f"merchant:{merchant}")
+    for item in receipt.get("items") or []:
+        description = item.get("description", "") if isinstance(item, dict) else str(item)
+        tokens.extend(f"i:{word}" for word in words(description))
+    tokens.extend(f"t:{word}" for word in words((receipt.get("raw_text") or "")[:MAX_TEXT_CHARS]))
+
+    counts = Counter(zlib.crc32(token.encode()) % n_features for token in tokens)
+    return {bucket: 1.0 + math.log(count) for bucket, count in counts.items()}
+
+class LocalClassifier:
+    """Multinomial logistic regression over hashed, TF-IDF weighted tokens"""
+
+    def __init__(self, classes, n_features=2 ** 18):
+        self.classes = list(classes)
+        self.n_features = n_features
+        self.idf = {}
+        self.weights = {label: defaultdict(float) for label in self.classes}
+        self.bias = {label: 0.0 for label in self.classes}
+
+    def vectorize(self, receipt):
+        features = extract_features(receipt, self.n_features)
+        default_idf = self.idf.get("default", 1.0)
+        for bucket in features:
+            features[bucket] *= self.idf.get(bucket, default_idf)
+        norm = math.sqrt(sum(value * value for value in features.values())) or 1.0
+        return {bucket: value / norm for bucket, value in features.items()}
+
+    def _probabilities(self, features):
+        scores = {
+            label: self.bias[label] + sum(weights.get(bucket, 0.0) * value for bucket, value in features.items())
+            for label, weights in self.weights.items()
+        }
+        top = max(scores.values())
+        exps = {label: math.exp(score - top) for label, score in scores.items()}
+        total = sum(exps.values())
+        return {label: value / total for label, value in exps.items()}
+
+    def predict(self, receipt):
+        """Return (category, confidence) for a receipt"""
+        probabilities = self._probabilities(self.vectorize(receipt))
+        label = max(probabilities, key=probabilities.get)
+        return label, probabilities[label]
+
+    def fit(self, receipts, labels, epochs=10, learning_rate=0.5, l2=1e-5, seed=0):
+        """Train with stochastic gradient descent on the softmax loss"""
+        document_frequency = Counter()
+        for receipt in receipts:
+            document_frequency.update(extract_features(receipt, self.n_features).keys())
+        documents = len(receipts)
+        self.idf = {
+            bucket: math.log((1 + documents) / (1 + count)) + 1
+            for bucket, count in document_frequency.items()
+        }
+        self.idf["default"] = math.log(1 + documents) + 1
+
+        examples = [(self.vectorize(receipt), label) for receipt, label in zip(receipts, labels)]
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(examples)
+            rate = learning_rate / (1 + epoch)
+            for features, label in examples:
+                probabilities = self._probabilities(features)
+                for candidate in self.classes:
+                    gradient = probabilities[candidate] - (1.0 if candidate == label else 0.0)
+                    if abs(gradient) < 1e-6:
+                        continue
+                    weights = self.weights[candidate]
+                    for bucket, value in features.items():
+                        weights[bucket] -= rate * (gradient * value + l2 * weights[bucket])
+                    self.bias[candidate] -= rate * gradient
+        return self
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({
+                "classes": self.classes,
+                "n_features": self.n_features,
+                "idf": {str(bucket): value for bucket, value in self.idf.items()},
+                "bias": self.bias,
+                "weights": {
+                    label: {str(bucket): round(weight, 6) for bucket, weight in weights.items() if abs(weight) > 1e-6}
+                    for label, weights in self.weights.items()
+                }
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        model = cls(data["classes"], n_features=data["n_features"])
+        model.idf = {
+            (bucket if bucket == "default" else int(bucket)): value for bucket, value in data["idf"].items()
+        }
+        model.bias = data["bias"]
+        for label, weights in data["weights"].items():
+            model.weights[label] = {int(bucket): weight for bucket, weight in weights.items()}
+        return model
+
+class LocalTier:
+    """Confidence-gated wrapper that decides when to trust the local model
+
+    The model at ``path`` is loaded on the first prediction; until it has
+    been trained (the file exists) the tier is disabled.
+    """
+
+    def __init__(self, model=None, path=None, threshold=0.85):
+        self.model = model
+        self.path = path
+        self.threshold = threshold
+        self.hits = 0
+        self.escalations = 0
+        self.best_guesses = 0
+        self._loaded = model is not None or not path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if not self._loaded:
+                if os.path.exists(self.path):
+                    self.model = LocalClassifier.load(self.path)
+                self._loaded = True
+
+    def predict(self, receipt):
+        """Return a category when the model is confident enough, otherwise None"""
+        if not self._loaded:
+            self._load()
+        if self.model is None:
+            return None
+        category, confidence = self.model.predict(receipt)
+        if confidence < self.threshold:
+            self.escalations += 1
+            return None
+        self.hits += 1
+        return category
+
+    def best_guess(self, receipt):
+        """Return the model's top category whatever its confidence, or None without a model
+
+        Used when DashScope cannot answer, as a better default than "Other".
+        """
+        if not self._loaded:
+            self._load()
+        if self.model is None:
+            return None
+        self.best_guesses += 1
+        return self.model.predict(receipt)[0]
+
+    def stats(self):
+        predictions = self.hits + self.escalations
+        return {
+            "enabled": self.model is not None or (not self._loaded and os.path.exists(self.path)),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "escalations": self.escalations,
+            "best_guesses": self.best_guesses,
+            "hit_rate": round(self.hits / predictions, 4) if predictions else 0.0
+        }
+
+def load_labeled_history(store):
+    """Return (receipts, labels) for every stored expense with a trusted category"""
+    receipts, labels = [], []
+    for expense in store.iter_expenses():
+        # Guesses made while DashScope was down would teach the model its own mistakes
+        if expense.get("degraded"):
+            continue
+        receipt = store.get_receipt(expense["receipt_id"])
+        if receipt is not None:
+            receipts.append(receipt)
+            labels.append(expense["category"])
+    return receipts, labels
+
+def evaluate(model, receipts, labels, thresholds=(0.5, 0.7, 0.85, 0.95)):
+    """Return accuracy, coverage at each confidence threshold and latency"""
+    predictions, latencies = [], []
+    for receipt in receipts:
+        start = time.perf_counter()
+        predictions.append(model.predict(receipt))
+        latencies.append(time.perf_counter() - start)
+
+    correct = sum(predicted == label for (predicted, _), label in zip(predictions, labels))
+    report = {
+        "examples": len(labels),
+        "accuracy": round(correct / len(labels), 4) if labels else 0.0,
+        "thresholds": {}
+    }
+    for threshold in thresholds:
+        confident = [
+            (predicted, label) for (predicted, confidence), label in zip(predictions, labels)
+            if confidence >= threshold
+        ]
+        report["thresholds"][str(threshold)] = {
+            "coverage": round(len(confident) / len(labels), 4) if labels else 0.0,
+            "accuracy": round(sum(p == l for p, l in confident) / len(confident), 4) if confident else None
+        }
+
+    latencies.sort()
+    if latencies:
+        report["latency_ms"] = {
+            "p50": round(latencies[len(latencies) // 2] * 1000, 4),
+            "p99": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 4),
+            "max": round(latencies[-1] * 1000, 4)
+        }
+    return report
+
+def train(args):
+    from storage import create_store
+
+    # The model is shared by every user, so it learns from all the shards
+    receipts, labels = [], []
+    for _, store in create_store(path=args.db, shards=args.shards).stores():
+        shard_receipts, shard_labels = load_labeled_history(store)
+        receipts += shard_receipts
+        labels += shard_labels
+    if len(set(labels)) < 2:
+        raise SystemExit("Need categorized expenses from at least two categories to train")
+
+    indexes = list(range(len(labels)))
+    random.Random(args.seed).shuffle(indexes)
+    holdout = int(len(indexes) * args.holdout)
+    test, training = indexes[:holdout], indexes[holdout:]
+    classes = sorted(set(labels))
+
+    model = LocalClassifier(classes, n_features=args.features).fit(
+        [receipts[i] for i in training], [labels[i] for i in training], epochs=args.epochs, seed=args.seed
+    )
+    report = {"trained_on": len(training)}
+    if test:
+        report["holdout"] = evaluate(model, [receipts[i] for i in test], [labels[i] for i in test])
+    print(json.dumps(report, indent=2))
+
+    # Ship a model trained on all the history
+    final = LocalClassifier(classes, n_features=args.features).fit(receipts, labels, epochs=args.epochs, seed=args.seed)
+    final.save(args.out)
+    print(f"Saved model to {args.out}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local expense categorizer")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="retrain from the expense history and report accuracy")
+    train_parser.add_argument("--db", default=os.environ.get("EXPENSE_DB_PATH", "data/expenses.db"))
+    train_parser.add_argument("--shards", type=int, default=int(os.environ.get("EXPENSE_SHARDS", 1)),
+                              help="number of expense store shards next to --db")
+    train_parser.add_argument("--out", default=os.environ.get("LOCAL_CLASSIFIER_PATH", "data/local_classifier.json"))
+    train_parser.add_argument("--holdout", type=float, default=0.2, help="share of history held out for the report")
+    train_parser.add_argument("--epochs", type=int, default=10)
+    train_parser.add_argument("--features", type=int, default=2 ** 18)
+    train_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.command == "train":
+        train(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import bisect
+import contextvars
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTE_BUCKETS = (16384, 65536, 262144, 1048576, 4194304, 16777216)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+# Spans of the request being handled on this thread, when tracing is enabled
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Process-wide counters and histograms with Prometheus text output
+
+    Metrics are declared with a help text and then updated by name with
+    keyword labels. ``stage`` times a block into ``stage_seconds`` and, when
+    a request trace is active, records it as a span of that trace.
+    """
+
+    def __init__(self, prefix="bef"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._buckets = {}
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+        self.declare("stage_seconds", "histogram", "Time spent in each request pipeline stage", LATENCY_BUCKETS)
+        self.declare("external_call_seconds", "histogram", "Latency of OCR and DashScope API calls", LATENCY_BUCKETS)
+        self.declare("external_calls_total", "counter", "OCR and DashScope API calls by outcome")
+        self.declare("backend_rejections_total", "counter", "API calls refused by an open circuit or the rate limiter")
+        self.declare("http_request_seconds", "histogram", "HTTP request latency by endpoint", LATENCY_BUCKETS)
+        self.declare("ocr_request_bytes", "histogram", "Size of images sent to OCR", BYTE_BUCKETS)
+        self.declare("dashscope_prompt_tokens", "histogram", "Input tokens per DashScope call", TOKEN_BUCKETS)
+        self.declare("dashscope_tokens_total", "counter", "DashScope tokens used, by direction")
+        self.declare("categorizations_total", "counter", "Receipts categorized, by the tier that answered")
+        self.declare("ocr_cache_hits_total", "counter", "Uploads answered from the OCR result cache")
+        self.declare("prompt_tokens_saved_total", "counter", "Estimated prompt tokens saved by trimming, by prompt")
+
+    def declare(self, name, kind, help_text, buckets=None):
+        self._types[name] = kind
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._buckets.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the block takes into histogram ``name``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(name, duration, **labels)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace["spans"].append({"name": name, **labels, "ms": round(duration * 1000, 3)})
+
+    def stage(self, stage):
+        """Time one pipeline stage (upload parsing, OCR, parsing, ...)"""
+        return self.timer("stage_seconds", stage=stage)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((key, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()),
+                key=lambda entry: entry[0]
+            )
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {self.prefix}_{name} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {self.prefix}_{name} {self._types.get(name, 'untyped')}")
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f"{self.prefix}_{name}{format_labels(labels)} {value:g}")
+
+        for (name, labels), counts, total, count in histograms:
+            describe(name)
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets.get(name, LATENCY_BUCKETS), counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(labels + (("le", f"{bound:g}"),))
+                lines.append(f"{self.prefix}_{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.prefix}_{name}_sum{format_labels(labels)} {total:g}")
+            lines.append(f"{self.prefix}_{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+class TraceLog:
+    """Optional structured per-request trace log, one JSON object per line
+
+    ``start`` begins collecting spans for the current request and ``finish``
+    writes them with the request's totals. Disabled when no path is given;
+    "-" writes to stdout.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        if path == "-":
+            self._file = sys.stdout
+        elif path:
+            self._file = open(path, "a", buffering=1)
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def start(self, **fields):
+        if not self.enabled:
+            return None
+        trace = {"trace_id": uuid.uuid4().hex, **fields, "spans": []}
+        _current_trace.set(trace)
+        return trace, time.perf_counter()
+
+    def finish(self, handle, **fields):
+        if handle is None:
+            return
+        trace, start = handle
+        _current_trace.set(None)
+        trace.update(fields)
+        trace["ms"] = round((time.perf_counter() - start) * 1000, 3)
+        line = json.dumps(trace)
+        with self._lock:
+            self._file.write(line + "\n")
@@ -0,0 +1,110 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class ReceiptPipeline:
+    """Two-stage receipt pipeline: OCR, then categorization
+
+    Each stage runs on its own bounded thread pool, so the number of
+    in-flight OCR and DashScope calls never exceeds the configured limits
+    no matter how many batches are running. Pools are shared by every
+    batch in the process.
+
+    The categorization stage takes a list of OCR results so several
+    receipts can share one LLM prompt. Finished OCR results are sent on
+    right away while a categorization worker is free. Once all workers are
+    busy they queue up into batches of at most ``batch_size``.
+    """
+
+    def __init__(self, ocr_stage, categorize_stage, ocr_workers=4, categorize_workers=2, batch_size=1):
+        self.ocr_stage = ocr_stage
+        self.categorize_stage = categorize_stage
+        self.ocr_workers = ocr_workers
+        self.categorize_workers = categorize_workers
+        self.batch_size = max(1, batch_size)
+        self._ocr_pool = ThreadPoolExecutor(max_workers=ocr_workers, thread_name_prefix="ocr")
+        self._categorize_pool = ThreadPoolExecutor(
+            max_workers=categorize_workers, thread_name_prefix="categorize"
+        )
+
+    def run(self, items):
+        """Process (name, image_bytes) pairs, yielding results in completion order
+
+        Each result is a dict with the item's ``index`` and ``filename`` plus
+        either the stage output (``status: success``) or an ``error``.
+        """
+        items = list(items)
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {"ocr_pending": len(items), "in_flight": 0, "ready": []}
+
+        def take_batch(force):
+            # Caller holds the lock
+            ready = state["ready"]
+            if not ready:
+                return None
+            idle = state["in_flight"] < self.categorize_workers
+            if not (force or idle or len(ready) >= self.batch_size):
+                return None
+            batch, state["ready"] = ready[:self.batch_size], ready[self.batch_size:]
+            state["in_flight"] += 1
+            return batch
+
+        def submit(batch):
+            future = self._categorize_pool.submit(
+                self.categorize_stage, [payload for _, _, payload in batch]
+            )
+            future.add_done_callback(lambda f: categorize_done(f, batch))
+
+        def ocr_done(future, index, name):
+            error = future.exception()
+            if error is not None:
+                results.put(self._error(index, name, "ocr", error))
+
+            with lock:
+                state["ocr_pending"] -= 1
+                if error is None:
+                    state["ready"].append((index, name, future.result()))
+                batch = take_batch(force=state["ocr_pending"] == 0)
+            if batch:
+                submit(batch)
+
+        def categorize_done(future, batch):
+            error = future.exception()
+            for position, (index, name, _) in enumerate(batch):
+                if error is not None:
+                    results.put(self._error(index, name, "categorize", error))
+                else:
+                    result = {"index": index, "filename": name, "status": "success"}
+                    result.update(future.result()[position])
+                    results.put(result)
+
+            # Drain whatever queued up while this batch was running
+            with lock:
+                state["in_flight"] -= 1
+                batch = take_batch(force=state["ocr_pending"] == 0)
+            if batch:
+                submit(batch)
+
+        for index, (name, image_bytes) in enumerate(items):
+            future = self._ocr_pool.submit(self.ocr_stage, image_bytes)
+            future.add_done_callback(
+                lambda f, index=index, name=name: ocr_done(f, index, name)
+            )
+
+        for _ in range(len(items)):
+            yield results.get()
+
+    def _error(self, index, name, stage, error):
+        print(f"Batch {stage} error for {name}: {error}")
+        return {
+            "index": index,
+            "filename": name,
+            "status": "error",
+            "stage": stage,
+            "error": str(error)
+        }
+
+    def shutdown(self):
+        self._ocr_pool.shutdown(wait=False)
+        self._categorize_pool.shutdown(wait=False)
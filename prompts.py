@@ -0,0 +1,108 @@
+import re
+import threading
+from collections import defaultdict
+
+from receipt_parser import SUBTOTAL_LINE, SUMMARY_LINE, TOTAL_LINE, TRAILING_PRICE, find_date, parse_amount
+
+CJK = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+WHITESPACE = re.compile(r"\s+")
+
+# Lines at the top of a receipt that carry the merchant name and address
+HEADER_LINES = 3
+
+def estimate_tokens(text):
+    """Rough token count: about four characters per token, one per CJK character"""
+    if not text:
+        return 0
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def salient_lines(raw_text, max_tokens):
+    """Trim OCR text to the lines that matter for categorization
+
+    Keeps, in priority order, the header (merchant) lines, the date and
+    total lines, then item lines from the most to the least expensive,
+    until ``max_tokens`` is reached. Duplicate lines and payment noise
+    (card, change, tax) are dropped. Selected lines keep receipt order.
+    """
+    lines = []
+    seen = set()
+    for raw_line in (raw_text or "").split("\n"):
+        line = WHITESPACE.sub(" ", raw_line).strip()
+        key = line.lower()
+        if line and key not in seen:
+            seen.add(key)
+            lines.append(line)
+    if estimate_tokens("\n".join(lines)) <= max_tokens:
+        return "\n".join(lines)
+
+    header, totals, items = [], [], []
+    for position, line in enumerate(lines):
+        if position < HEADER_LINES:
+            header.append(position)
+        elif (TOTAL_LINE.search(line) and not SUBTOTAL_LINE.search(line)) or find_date(line):
+            totals.append(position)
+        elif SUMMARY_LINE.search(line) or SUBTOTAL_LINE.search(line):
+            continue
+        else:
+            priced = TRAILING_PRICE.match(line)
+            price = parse_amount(priced.group("price")) if priced else 0.0
+            items.append((price, position))
+    items.sort(key=lambda item: -item[0])
+
+    chosen = []
+    used = 0
+    for position in header + totals + [position for _, position in items]:
+        cost = estimate_tokens(lines[position]) + 1
+        if used + cost > max_tokens:
+            continue
+        chosen.append(position)
+        used += cost
+    return "\n".join(lines[position] for position in sorted(chosen))
+
+def fit_lines(lines, max_tokens):
+    """Return the leading lines that fit within ``max_tokens``"""
+    kept = []
+    used = 0
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+    return kept
+
+def truncate(text, max_tokens):
+    """Cut free text (such as a user question) down to roughly ``max_tokens``"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    cut = text[:max_tokens * 4]
+    while estimate_tokens(cut) > max_tokens:
+        cut = cut[:int(len(cut) * 0.9)]
+    return cut.rstrip() + "..."
+
+class PromptSavings:
+    """Tally of estimated tokens before and after trimming, per prompt kind"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: {"prompts": 0, "original_tokens": 0, "sent_tokens": 0})
+
+    def record(self, kind, original, sent):
+        """Record one prompt and return the tokens saved"""
+        with self._lock:
+            totals = self._totals[kind]
+            totals["prompts"] += 1
+            totals["original_tokens"] += original
+            totals["sent_tokens"] += sent
+        return original - sent
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for kind, totals in self._totals.items():
+                saved = totals["original_tokens"] - totals["sent_tokens"]
+                stats[kind] = dict(totals, saved_tokens=saved, saved_share=(
+                    round(saved / totals["original_tokens"], 4) if totals["original_tokens"] else 0.0
+                ))
+            return stats
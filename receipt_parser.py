@@ -0,0 +1,151 @@
+import datetime
+import re
+
+# All patterns are compiled once at import; each line is scanned a single time
+AMOUNT = r"(?:\d{1,3}(?:[,.']\d{3})+|\d+)[.,]\d{2}"
+WHOLE_AMOUNT = r"\d{1,3}(?:,\d{3})+|\d+"
+CURRENCY_SYMBOL = r"(?:US\$|HK\$|S\$|\bRM(?=\s*\d)|[$€£¥￥])"
+CURRENCY_CODE = r"(?:USD|EUR|GBP|CNY|RMB|JPY|HKD|SGD|MYR)"
+
+TOTAL_LINE = re.compile(
+    r"\b(?:grand\s*total|total|amount\s+due|balance\s+due)\b|合计|总计|实付|应付",
+    re.IGNORECASE
+)
+SUBTOTAL_LINE = re.compile(r"\bsub\s*-?\s*total\b|小计", re.IGNORECASE)
+SUMMARY_LINE = re.compile(
+    r"\b(?:tax|vat|gst|change|cash|card|visa|mastercard|tip|discount|rounding|paid|tender)\b|税|找零|现金",
+    re.IGNORECASE
+)
+ITEM_HEADER = re.compile(r"item|qty", re.IGNORECASE)
+MERCHANT_SKIP = re.compile(r"date|receipt|invoice", re.IGNORECASE)
+HAS_LETTER = re.compile(r"[^\W\d_]")
+
+# A total line may carry a whole-number amount; item prices need cents
+TOTAL_AMOUNT = re.compile(rf"(?<![\d.,])({AMOUNT}|{WHOLE_AMOUNT})(?![\d.,]*\d)")
+TRAILING_PRICE = re.compile(
+    rf"^(?P<description>.*?\S)\s+(?:{CURRENCY_SYMBOL}\s*)?-?(?P<price>{AMOUNT})"
+    rf"(?:\s*(?:{CURRENCY_SYMBOL}|{CURRENCY_CODE}|元))?$"
+)
+CURRENCY = re.compile(rf"{CURRENCY_SYMBOL}|\b{CURRENCY_CODE}\b|元")
+
+# Year-first dates (2024-01-31, 2024/1/31, 2024年1月31日) and
+# day/month-first dates (01/31/2024, 31/01/2024, 31.01.2024)
+YEAR_FIRST_DATE = re.compile(r"(?<!\d)(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})(?!\d)")
+YEAR_LAST_DATE = re.compile(r"(?<!\d)(\d{1,2})([-/.])(\d{1,2})\2(\d{4})(?!\d)")
+
+CURRENCY_CODES = {
+    "$": "USD", "US$": "USD", "USD": "USD",
+    "€": "EUR", "EUR": "EUR",
+    "£": "GBP", "GBP": "GBP",
+    "¥": "CNY", "￥": "CNY", "元": "CNY", "RMB": "CNY", "CNY": "CNY",
+    "JPY": "JPY",
+    "HK$": "HKD", "HKD": "HKD",
+    "S$": "SGD", "SGD": "SGD",
+    "RM": "MYR", "MYR": "MYR"
+}
+
+def parse_amount(text):
+    """Convert an amount like "1,234.56", "1.234,56" or "12" to a float"""
+    text = text.replace(" ", "").replace("'", "")
+    if len(text) > 3 and text[-3] == ",":
+        # Decimal comma: 1.234,56
+        return float(text.replace(".", "").replace(",", "."))
+    return float(text.replace(",", ""))
+
+def find_date(line):
+    """Return the first valid date in a line as YYYY-MM-DD, or None"""
+    match = YEAR_FIRST_DATE.search(line)
+    if match:
+        year, month, day = (int(part) for part in match.groups())
+    else:
+        match = YEAR_LAST_DATE.search(line)
+        if not match:
+            return None
+        first, separator, second, year = match.groups()
+        first, second, year = int(first), int(second), int(year)
+        # Month-first unless that cannot be a month or the separator is European
+        if first > 12 or separator == ".":
+            day, month = first, second
+        else:
+            month, day = first, second
+    try:
+        return datetime.date(year, month, day).isoformat()
+    except ValueError:
+        return None
+
+def extract_receipt_data(ocr_text):
+    """Extract structured data from OCR text in a single pass over its lines
+
+    Returns the merchant (first line that looks like a name), the first date
+    found (normalized to YYYY-MM-DD), the total (the last amount on the last
+    total line, falling back to the subtotal), the detected currency, and
+    items with their prices.
+    """
+    data = {
+        "merchant": "Unknown",
+        "date": None,
+        "total_amount": 0.0,
+        "currency": None,
+        "items": []
+    }
+    subtotal = None
+    total = None
+    item_section = False
+    totals_seen = False
+
+    for raw_line in ocr_text.split("\n"):
+        line = raw_line.strip()
+        if not line:
+            continue
+
+        if data["currency"] is None:
+            currency = CURRENCY.search(line)
+            if currency:
+                data["currency"] = CURRENCY_CODES.get(currency.group(0))
+
+        date = find_date(line) if data["date"] is None else None
+        if date is not None:
+            data["date"] = date
+            continue
+
+        if data["merchant"] == "Unknown" and HAS_LETTER.search(line) and not MERCHANT_SKIP.search(line):
+            data["merchant"] = line
+            continue
+
+        if SUBTOTAL_LINE.search(line):
+            amounts = TOTAL_AMOUNT.findall(line)
+            if amounts:
+                subtotal = parse_amount(amounts[-1])
+            totals_seen = True
+            continue
+
+        if TOTAL_LINE.search(line):
+            amounts = TOTAL_AMOUNT.findall(line)
+            if amounts:
+                total = parse_amount(amounts[-1])
+            totals_seen = True
+            continue
+
+        if totals_seen or SUMMARY_LINE.search(line):
+            continue
+
+        if ITEM_HEADER.search(line) and not item_section:
+            item_section = True
+            continue
+
+        priced = TRAILING_PRICE.match(line)
+        if priced:
+            data["items"].append({
+                "description": priced.group("description"),
+                "price": parse_amount(priced.group("price"))
+            })
+        elif item_section:
+            data["items"].append({"description": line, "price": 0.0})
+
+    if total is not None:
+        data["total_amount"] = total
+    elif subtotal is not None:
+        data["total_amount"] = subtotal
+    if data["date"] is None:
+        data["date"] = datetime.datetime.now().strftime("%Y-%m-%d")
+    return data
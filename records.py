@@ -0,0 +1,239 @@
+import datetime
+import sys
+import tempfile
+import threading
+import uuid
+from functools import lru_cache
+
+from aggregates import parse_date
+
+class CodeTable:
+    """Two-way mapping between names and small integer codes"""
+
+    def __init__(self):
+        self._codes = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def code(self, name):
+        """Return the code for ``name``, assigning the next one on first sight"""
+        code = self._codes.get(name)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(name)
+                if code is None:
+                    code = self._codes[name] = len(self._names)
+                    self._names.append(name)
+        return code
+
+    def get(self, name):
+        """Return the code for ``name``, or None if it has never been seen"""
+        return self._codes.get(name)
+
+    def name(self, code):
+        return self._names[code]
+
+    def __len__(self):
+        return len(self._names)
+
+# There are only a handful of categories, so records store a code into this table
+CATEGORY_CODES = CodeTable()
+
+def pack_id(value):
+    """Store a canonical UUID string as its 128-bit int; other ids stay strings"""
+    try:
+        packed = uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return value
+    return packed.int if str(packed) == value else value
+
+def unpack_id(value):
+    if not isinstance(value, int):
+        return value
+    # Same text as str(uuid.UUID(int=value)) without building a UUID object
+    digits = f"{value:032x}"
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+# Receipts share a small set of date strings, so parsed values are memoized
+@lru_cache(maxsize=65536)
+def pack_day(value):
+    """Store a date string as its proleptic ordinal; unparseable dates stay strings"""
+    day = parse_date(value)
+    return day.toordinal() if day is not None else value
+
+def unpack_day(day):
+    return datetime.date.fromordinal(day).isoformat() if isinstance(day, int) else day
+
+def to_cents(amount):
+    return round(float(amount or 0) * 100)
+
+class ColdText:
+    """Append-only spill file for receipt OCR text
+
+    Text is written once and read back only when a receipt is fetched, so
+    it costs no heap memory in between. ``path`` None uses an anonymous
+    temporary file that disappears with the process.
+    """
+
+    def __init__(self, path=None):
+        self._file = open(path, "a+b") if path else tempfile.TemporaryFile()
+        self._lock = threading.Lock()
+        self._file.seek(0, 2)
+        self.size = self._file.tell()
+
+    def put(self, text):
+        """Store ``text`` and return its (offset, length)"""
+        data = (text or "").encode("utf-8")
+        with self._lock:
+            offset = self.size
+            self._file.seek(offset)
+            self._file.write(data)
+            self.size += len(data)
+        return offset, len(data)
+
+    def get(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        return data.decode("utf-8")
+
+class ExpenseRecord:
+    """Compact in-memory expense
+
+    Ids are 128-bit ints, the date is a day ordinal, the amount is integer
+    cents and the category is a code into CATEGORY_CODES; merchant and user
+    strings are interned so repeats share one object. ``degraded`` marks a
+    category guessed while DashScope was unavailable.
+    """
+
+    __slots__ = ("id", "receipt_id", "user_id", "day", "merchant", "cents", "category_code", "degraded")
+
+    def __init__(self, id, receipt_id, user_id, day, merchant, cents, category_code, degraded=False):
+        self.id = id
+        self.receipt_id = receipt_id
+        self.user_id = user_id
+        self.day = day
+        self.merchant = merchant
+        self.cents = cents
+        self.category_code = category_code
+        self.degraded = degraded
+
+    @classmethod
+    def from_dict(cls, expense, default_user):
+        return cls(
+            pack_id(expense["id"]),
+            pack_id(expense["receipt_id"]),
+            sys.intern(expense.get("user_id") or default_user),
+            pack_day(expense["date"]),
+            sys.intern(expense["merchant"]),
+            to_cents(expense["amount"]),
+            CATEGORY_CODES.code(expense["category"]),
+            bool(expense.get("degraded"))
+        )
+
+    @property
+    def category(self):
+        return CATEGORY_CODES.name(self.category_code)
+
+    def to_dict(self):
+        return {
+            "id": unpack_id(self.id),
+            "receipt_id": unpack_id(self.receipt_id),
+            "user_id": self.user_id,
+            "date": unpack_day(self.day),
+            "merchant": self.merchant,
+            "amount": self.cents / 100,
+            "category": self.category,
+            "degraded": self.degraded
+        }
+
+class ReceiptRecord:
+    """Compact in-memory receipt whose OCR text lives in a ColdText file
+
+    Items are one flat (description, cents, description, cents, ...) tuple,
+    with cents None for lines OCR found no price on; descriptions are
+    interned since the same items recur across receipts. ``raw_text`` is
+    read from the cold file on access.
+    """
+
+    __slots__ = ("id", "user_id", "day", "merchant", "cents", "currency", "items",
+                 "cold", "text_offset", "text_length")
+
+    def __init__(self, id, user_id, day, merchant, cents, currency, items, cold, text_offset, text_length):
+        self.id = id
+        self.user_id = user_id
+        self.day = day
+        self.merchant = merchant
+        self.cents = cents
+        self.currency = currency
+        self.items = items
+        self.cold = cold
+        self.text_offset = text_offset
+        self.text_length = text_length
+
+    @classmethod
+    def from_dict(cls, receipt, cold, default_user):
+        items = []
+        for item in receipt.get("items") or []:
+            items.append(sys.intern(str(item.get("description", ""))))
+            items.append(to_cents(item["price"]) if item.get("price") else None)
+        offset, length = cold.put(receipt.get("raw_text"))
+        return cls(
+            pack_id(receipt["id"]),
+            sys.intern(receipt.get("user_id") or default_user),
+            pack_day(receipt["date"]),
+            sys.intern(receipt["merchant"]),
+            to_cents(receipt["total_amount"]),
+            receipt.get("currency") and sys.intern(receipt["currency"]),
+            tuple(items),
+            cold,
+            offset,
+            length
+        )
+
+    @property
+    def raw_text(self):
+        return self.cold.get(self.text_offset, self.text_length)
+
+    def to_dict(self):
+        return {
+            "id": unpack_id(self.id),
+            "user_id": self.user_id,
+            "date": unpack_day(self.day),
+            "merchant": self.merchant,
+            "total_amount": self.cents / 100,
+            "currency": self.currency,
+            "items": [
+                {"description": description, "price": cents / 100 if cents is not None else 0.0}
+                for description, cents in zip(self.items[::2], self.items[1::2])
+            ],
+            "raw_text": self.raw_text
+        }
+
+def expense_filter(user_id=None, category=None, merchant=None, start_date=None, end_date=None,
+                   min_amount=None, max_amount=None):
+    """Compile /expenses filters into a predicate over ExpenseRecords
+
+    Filter values are converted to record units (category code, day
+    ordinal, cents) once, so each record check is a few int comparisons.
+    """
+    code = CATEGORY_CODES.get(category) if category is not None else None
+    if category is not None and code is None:
+        return lambda record: False
+    start = pack_day(start_date) if start_date is not None else None
+    end = pack_day(end_date) if end_date is not None else None
+    low = min_amount * 100 if min_amount is not None else None
+    high = max_amount * 100 if max_amount is not None else None
+
+    def matches(record):
+        day = record.day
+        return (
+            (user_id is None or record.user_id == user_id)
+            and (code is None or record.category_code == code)
+            and (merchant is None or record.merchant == merchant)
+            and (start is None or (isinstance(day, int) and day >= start))
+            and (end is None or (isinstance(day, int) and day <= end))
+            and (low is None or record.cents >= low)
+            and (high is None or record.cents <= high)
+        )
+    return matches
@@ -0,0 +1,217 @@
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class BackendUnavailable(Exception):
+    """Raised instead of calling a backend whose circuit is open or whose rate limit is exhausted"""
+
+    def __init__(self, service, reason, retry_after):
+        super().__init__(f"{service} is unavailable ({reason}); retry in {retry_after:.1f}s")
+        self.service = service
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate adapts to throttling (AIMD)
+
+    Each call takes a token; tokens refill at ``rate`` per second up to
+    ``burst``. A throttled response halves the rate (at most once per
+    ``cooldown`` seconds, so one burst of 429s counts once, and never below
+    ``min_rate``) and the rate then climbs back by ``increase`` per second
+    of successful calls, up to the configured maximum. The bucket so
+    settles just under the provider's real quota. Callers wait at most
+    ``max_wait`` seconds for their token.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.5, increase=None, max_wait=2.0, cooldown=1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase if increase is not None else rate / 10
+        self.max_wait = max_wait
+        self.cooldown = cooldown
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._adjusted = self._updated
+        self._decreased = None
+        self._lock = threading.Lock()
+        self.throttles = 0
+        self.rejected = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Take a token, sleeping until it is due; return False if that would exceed ``max_wait``"""
+        with self._lock:
+            self._refill(time.monotonic())
+            # Tokens are reserved up front, so waiting callers queue behind each other
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            if wait > self.max_wait:
+                self.rejected += 1
+                return False
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return True
+
+    def on_success(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.rate < self.max_rate:
+                self._refill(now)
+                self.rate = min(self.max_rate, self.rate + self.increase * (now - self._adjusted))
+            self._adjusted = now
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            self.throttles += 1
+            if self._decreased is not None and now - self._decreased < self.cooldown:
+                return
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._decreased = self._adjusted = now
+
+    def stats(self):
+        return {
+            "rate": round(self.rate, 3),
+            "max_rate": self.max_rate,
+            "throttles": self.throttles,
+            "rejected": self.rejected
+        }
+
+class CircuitBreaker:
+    """Stops calling a backend that keeps failing
+
+    After ``failure_threshold`` failed calls in a row the circuit opens and
+    calls are refused without reaching the backend. Once ``reset_timeout``
+    seconds pass it is half open: one trial call goes through, and its
+    success closes the circuit while a failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go ahead"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_at = None
+            # A trial that never reported back (an abandoned stream) stops blocking after a timeout
+            if self.state == HALF_OPEN and (self._trial_at is None or now - self._trial_at >= self.reset_timeout):
+                self._trial_at = now
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """Give back a trial slot that was granted but not used"""
+        with self._lock:
+            self._trial_at = None
+
+    def retry_after(self):
+        """Seconds until the next trial call is let through"""
+        with self._lock:
+            if self.state == CLOSED:
+                return 0.0
+            started = self._trial_at if self.state == HALF_OPEN and self._trial_at is not None else self._opened_at
+            return max(0.0, self.reset_timeout - (time.monotonic() - started))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self._trial_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opens += 1
+                self._opened_at = time.monotonic()
+                self._trial_at = None
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "retry_after": round(self.retry_after(), 1)
+        }
+
+class ServiceGuard:
+    """Rate limiter and circuit breaker in front of one external service
+
+    ``admit`` is called before each attempt and raises BackendUnavailable
+    instead of letting the call through; ``record`` feeds each attempt's
+    outcome back to both. Only "error" (a 5xx, timeout or connection
+    failure) counts against the circuit: throttling is the limiter's to
+    handle, and a "rejected" request (a 4xx, such as an unreadable image)
+    says nothing about the service's health. Either part may be None to
+    disable it.
+    """
+
+    def __init__(self, service, limiter=None, breaker=None):
+        self.service = service
+        self.limiter = limiter
+        self.breaker = breaker
+
+    def admit(self):
+        if self.breaker is not None and not self.breaker.allow():
+            raise BackendUnavailable(self.service, "circuit_open", self.breaker.retry_after())
+        if self.limiter is not None and not self.limiter.acquire():
+            if self.breaker is not None:
+                self.breaker.release()
+            raise BackendUnavailable(self.service, "rate_limited", self.limiter.max_wait)
+
+    def release(self):
+        """Hand back an admission that did not reach the service"""
+        if self.breaker is not None:
+            self.breaker.release()
+
+    def record(self, outcome):
+        if self.limiter is not None:
+            if outcome == "ok":
+                self.limiter.on_success()
+            elif outcome == "throttled":
+                self.limiter.on_throttle()
+        if self.breaker is not None:
+            if outcome == "ok":
+                self.breaker.record_success()
+            elif outcome == "error":
+                self.breaker.record_failure()
+            else:
+                # A half-open circuit's trial proved nothing either way
+                self.breaker.release()
+
+    @property
+    def degraded(self):
+        return self.breaker is not None and self.breaker.state != CLOSED
+
+    def stats(self):
+        return {
+            "degraded": self.degraded,
+            "circuit": self.breaker.stats() if self.breaker is not None else None,
+            "rate_limit": self.limiter.stats() if self.limiter is not None else None
+        }
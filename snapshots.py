@@ -0,0 +1,298 @@
+import datetime
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from aggregates import parse_date, period_keys
+
+PERIODS = ("day", "week", "month")
+ONE_DAY = datetime.timedelta(days=1)
+
+def period_range(period, key):
+    """Return the first and last date of a day, ISO week or month key"""
+    if period == "day":
+        day = datetime.date.fromisoformat(key)
+        return day, day
+    if period == "week":
+        year, week = key.split("-W")
+        start = datetime.date.fromisocalendar(int(year), int(week), 1)
+        return start, start + 6 * ONE_DAY
+    year, month = (int(part) for part in key.split("-"))
+    start = datetime.date(year, month, 1)
+    return start, datetime.date(year + month // 12, month % 12 + 1, 1) - ONE_DAY
+
+def previous_key(period, key):
+    return period_keys(period_range(period, key)[0] - ONE_DAY)[period]
+
+def next_key(period, key):
+    return period_keys(period_range(period, key)[1] + ONE_DAY)[period]
+
+def rollup(expenses, top_merchants=5):
+    """Total, count, category split and largest merchants of one period's expenses"""
+    total = 0.0
+    count = 0
+    categories = defaultdict(float)
+    merchants = defaultdict(lambda: [0.0, 0])
+    for expense in expenses:
+        amount = float(expense["amount"])
+        total += amount
+        count += 1
+        categories[expense["category"]] += amount
+        merchant = merchants[expense["merchant"]]
+        merchant[0] += amount
+        merchant[1] += 1
+    top = heapq.nlargest(top_merchants, merchants.items(), key=lambda item: item[1][0])
+    return {
+        "total": round(total, 2),
+        "count": count,
+        "categories": {category: round(amount, 2)
+                       for category, amount in sorted(categories.items(), key=lambda item: -item[1])},
+        "top_merchants": [{"merchant": name, "total": round(amount, 2), "count": visits}
+                          for name, (amount, visits) in top]
+    }
+
+class SnapshotStore:
+    """Per-user spending rollups for every day, ISO week and month, kept in SQLite
+
+    ``refresh`` follows each store shard's change feed from where it last
+    stopped, marks the periods the new expenses fall in dirty and
+    recomputes only those, each from one indexed date-range read. A row
+    holds the period's total, category split, top merchants and the
+    previous period's total, so reads are primary-key lookups that never
+    touch the expenses. ``version(user_id)`` is the store data version a
+    user's snapshots reflect; it lags the store until the next refresh.
+    """
+
+    def __init__(self, path=None, top_merchants=5):
+        self.path = path
+        self.top_merchants = top_merchants
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        if path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS spending_snapshots (
+                user_id TEXT NOT NULL,
+                period TEXT NOT NULL,
+                period_key TEXT NOT NULL,
+                total REAL NOT NULL,
+                count INTEGER NOT NULL,
+                previous_total REAL NOT NULL DEFAULT 0,
+                categories TEXT NOT NULL,
+                top_merchants TEXT NOT NULL,
+                computed_at REAL NOT NULL,
+                PRIMARY KEY (user_id, period, period_key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS snapshot_dirty (
+                user_id TEXT NOT NULL,
+                period TEXT NOT NULL,
+                period_key TEXT NOT NULL,
+                PRIMARY KEY (user_id, period, period_key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS snapshot_feed (
+                shard INTEGER PRIMARY KEY,
+                position INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS snapshot_versions (
+                user_id TEXT PRIMARY KEY,
+                data_version INTEGER NOT NULL
+            );
+        """)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._scheduled_until = 0.0
+        self.refreshes = 0
+        self.recomputed = 0
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def claim_schedule(self, delay):
+        """Return True if the caller should queue a refresh, at most once per ``delay`` seconds"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._scheduled_until:
+                return False
+            self._scheduled_until = now + delay
+            return True
+
+    def refresh(self, store, batch_size=1000):
+        """Bring the snapshots up to date with a ShardedStore; return the number of periods recomputed"""
+        with self._refresh_lock:
+            versions = {}
+            for shard, shard_store in store.stores():
+                versions.update(self._follow(shard, shard_store, batch_size))
+            recomputed = self._recompute(store, batch_size)
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO snapshot_versions (user_id, data_version) VALUES (?, ?)",
+                    versions.items()
+                )
+                self.refreshes += 1
+                self.recomputed += recomputed
+        return recomputed
+
+    def _follow(self, shard, shard_store, batch_size):
+        """Mark the periods of a shard's new expenses dirty; return the versions of the users seen"""
+        with self._lock:
+            row = self._conn.execute("SELECT position FROM snapshot_feed WHERE shard = ?", (shard,)).fetchone()
+        position = row[0] if row else 0
+        touched = set()
+        while True:
+            expenses, next_position = shard_store.changes_since(position, limit=batch_size)
+            if expenses:
+                dirty = set()
+                for expense in expenses:
+                    touched.add(expense["user_id"])
+                    day = parse_date(expense["date"])
+                    if day is not None:
+                        dirty.update((expense["user_id"], period, key) for period, key in period_keys(day).items())
+                # Marks and the new feed position commit together, so a crash loses neither
+                with self._transaction() as conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO snapshot_dirty (user_id, period, period_key) VALUES (?, ?, ?)",
+                        dirty
+                    )
+                    conn.execute("INSERT OR REPLACE INTO snapshot_feed (shard, position) VALUES (?, ?)",
+                                 (shard, next_position))
+                position = next_position
+                continue
+
+            # Versions are read before the feed is checked once more, so a
+            # version never covers an expense that has not been marked
+            versions = {user_id: shard_store.data_version(user_id) for user_id in touched}
+            if not shard_store.changes_since(position, limit=1)[0]:
+                return versions
+
+    def _recompute(self, store, batch_size):
+        recomputed = 0
+        skipped = 0
+        while True:
+            # Keys sort chronologically, so a period is rebuilt before the one after it
+            with self._lock:
+                dirty = self._conn.execute(
+                    "SELECT user_id, period, period_key FROM snapshot_dirty "
+                    "ORDER BY user_id, period, period_key LIMIT ? OFFSET ?", (batch_size, skipped)
+                ).fetchall()
+            if not dirty:
+                return recomputed
+            for user_id, period, key in dirty:
+                # Nodes sharing the file leave other shards' periods to their owners
+                if not store.owns(user_id):
+                    skipped += 1
+                    continue
+                self._rebuild(store.for_user(user_id), user_id, period, key)
+                recomputed += 1
+                with self._lock:
+                    self._conn.execute(
+                        "DELETE FROM snapshot_dirty WHERE user_id = ? AND period = ? AND period_key = ?",
+                        (user_id, period, key)
+                    )
+
+    def _rebuild(self, user_store, user_id, period, key):
+        start, end = period_range(period, key)
+        snapshot = rollup(user_store.iter_expenses(start_date=start.isoformat(), end_date=end.isoformat()),
+                          self.top_merchants)
+        with self._transaction() as conn:
+            previous = conn.execute(
+                "SELECT total FROM spending_snapshots WHERE user_id = ? AND period = ? AND period_key = ?",
+                (user_id, period, previous_key(period, key))
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO spending_snapshots "
+                "(user_id, period, period_key, total, count, previous_total, categories, top_merchants, computed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, period, key, snapshot["total"], snapshot["count"], previous[0] if previous else 0.0,
+                 json.dumps(snapshot["categories"]), json.dumps(snapshot["top_merchants"]), time.time())
+            )
+            # The next period's change is measured against this one
+            conn.execute(
+                "UPDATE spending_snapshots SET previous_total = ? "
+                "WHERE user_id = ? AND period = ? AND period_key = ?",
+                (snapshot["total"], user_id, period, next_key(period, key))
+            )
+
+    def _format(self, period, key, total, count, previous_total, categories, top_merchants, computed_at):
+        start, end = period_range(period, key)
+        change = round(total - previous_total, 2)
+        return {
+            "period": period,
+            "key": key,
+            "start_date": start.isoformat(),
+            "end_date": end.isoformat(),
+            "total": total,
+            "count": count,
+            "categories": json.loads(categories),
+            "top_merchants": json.loads(top_merchants),
+            "previous_total": previous_total,
+            "change": change,
+            "change_percent": round(change / previous_total * 100, 1) if previous_total else None,
+            "computed_at": computed_at
+        }
+
+    def get(self, user_id, period, key):
+        """Return one period's snapshot; a period with no expenses reads as zero spending"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT total, count, previous_total, categories, top_merchants, computed_at "
+                "FROM spending_snapshots WHERE user_id = ? AND period = ? AND period_key = ?",
+                (user_id, period, key)
+            ).fetchone()
+            if row is None:
+                previous = self._conn.execute(
+                    "SELECT total FROM spending_snapshots WHERE user_id = ? AND period = ? AND period_key = ?",
+                    (user_id, period, previous_key(period, key))
+                ).fetchone()
+                row = (0.0, 0, previous[0] if previous else 0.0, "{}", "[]", None)
+        return self._format(period, key, *row)
+
+    def history(self, user_id, period, limit, start_date=None, end_date=None):
+        """Return up to ``limit`` of the user's snapshots for a period type, newest first"""
+        sql = ("SELECT period_key, total, count, previous_total, categories, top_merchants, computed_at "
+               "FROM spending_snapshots WHERE user_id = ? AND period = ?")
+        params = [user_id, period]
+        for bound, operator in ((start_date, ">="), (end_date, "<=")):
+            day = parse_date(bound) if bound else None
+            if day is not None:
+                sql += f" AND period_key {operator} ?"
+                params.append(period_keys(day)[period])
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY period_key DESC LIMIT ?", params + [limit]).fetchall()
+        return [self._format(period, key, *row) for key, *row in rows]
+
+    def version(self, user_id):
+        """Return the store data version the user's snapshots were built from
+
+        A user no refresh has seen has no expenses yet as far as the
+        snapshots know, which is store version 0.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT data_version FROM snapshot_versions WHERE user_id = ?",
+                                     (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def stats(self):
+        with self._lock:
+            dirty = self._conn.execute("SELECT COUNT(*) FROM snapshot_dirty").fetchone()[0]
+        return {
+            "refreshes": self.refreshes,
+            "periods_recomputed": self.recomputed,
+            "dirty_periods": dirty
+        }
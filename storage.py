@@ -0,0 +1,407 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+
+from records import ColdText, ExpenseRecord, ReceiptRecord, expense_filter, pack_id
+
+EXPENSE_FIELDS = ("id", "receipt_id", "user_id", "date", "merchant", "amount", "category", "degraded")
+FILTERS = ("category", "merchant", "start_date", "end_date", "min_amount", "max_amount")
+
+# Owner of records written before receipts and expenses carried a user id
+DEFAULT_USER = "default"
+
+def expense_from_row(row):
+    expense = {field: row[field] for field in EXPENSE_FIELDS}
+    expense["degraded"] = bool(expense["degraded"])
+    return expense
+
+def shard_for(user_id, shards):
+    """Return the shard number a user's records live in"""
+    return zlib.crc32(user_id.encode("utf-8")) % shards
+
+class ExpenseStore:
+    """Interface for receipt and expense storage backends
+
+    Reads take an optional ``user_id``; without one they span every user.
+    """
+
+    def add(self, receipt, expense):
+        """Save a receipt and its expense together"""
+        raise NotImplementedError
+
+    def get_receipt(self, receipt_id, user_id=None):
+        """Return the receipt with the given id, or None"""
+        raise NotImplementedError
+
+    def page_expenses(self, limit, after=None, user_id=None, **filters):
+        """Return up to ``limit`` filtered expenses after position ``after``
+
+        Returns ``(expenses, next_after)`` where ``next_after`` is the
+        position to resume from, or None when there are no more results.
+        """
+        raise NotImplementedError
+
+    def changes_since(self, position, limit=1000, user_id=None):
+        """Return expenses added after ``position`` and the position of the last one
+
+        Returns ``(expenses, position)``; the position is unchanged when there
+        is nothing new. Used to keep derived views in step with the store.
+        """
+        raise NotImplementedError
+
+    def data_version(self, user_id=None):
+        """Return a counter that changes whenever stored data changes"""
+        raise NotImplementedError
+
+    def count_expenses(self, user_id=None):
+        raise NotImplementedError
+
+    def list_expenses(self, **filters):
+        """Return all filtered expenses in insertion order"""
+        return list(self.iter_expenses(**filters))
+
+    def iter_expenses(self, batch_size=1000, **filters):
+        """Yield filtered expenses in insertion order, one page at a time"""
+        after = None
+        while True:
+            expenses, after = self.page_expenses(batch_size, after=after, **filters)
+            yield from expenses
+            if after is None:
+                return
+
+class MemoryStore(ExpenseStore):
+    """Process-local store, useful for development and tests
+
+    Records are kept as compact slotted objects; receipt OCR text is
+    spilled to a ColdText file (``text_path``, or an anonymous temp file)
+    and only read back by ``get_receipt``.
+    """
+
+    def __init__(self, text_path=None):
+        self._receipts = {}
+        self._expenses = []
+        self._texts = ColdText(text_path)
+        self._version = 0
+        self._user_versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, receipt, expense):
+        receipt_record = ReceiptRecord.from_dict(receipt, self._texts, DEFAULT_USER)
+        expense_record = ExpenseRecord.from_dict(expense, DEFAULT_USER)
+        if expense_record.receipt_id == receipt_record.id:
+            # Share one id object between the pair
+            expense_record.receipt_id = receipt_record.id
+        with self._lock:
+            self._receipts[receipt_record.id] = receipt_record
+            self._expenses.append(expense_record)
+            self._version += 1
+            self._user_versions[expense_record.user_id] += 1
+
+    def get_receipt(self, receipt_id, user_id=None):
+        record = self._receipts.get(pack_id(receipt_id))
+        if record is None or (user_id is not None and record.user_id != user_id):
+            return None
+        return record.to_dict()
+
+    def page_expenses(self, limit, after=None, user_id=None, **filters):
+        # Positions are indexes into the insertion-ordered list
+        matches = expense_filter(user_id=user_id, **filters)
+        page = []
+        position = after or 0
+        for position in range(position, len(self._expenses)):
+            record = self._expenses[position]
+            if matches(record):
+                if len(page) == limit:
+                    return page, position
+                page.append(record.to_dict())
+        return page, None
+
+    def changes_since(self, position, limit=1000, user_id=None):
+        if user_id is not None:
+            expenses, after = self.page_expenses(limit, after=position, user_id=user_id)
+            if not expenses:
+                return [], position or 0
+            return expenses, after if after is not None else len(self._expenses)
+        position = position or 0
+        expenses = [record.to_dict() for record in self._expenses[position:position + limit]]
+        return expenses, position + len(expenses)
+
+    def data_version(self, user_id=None):
+        return self._version if user_id is None else self._user_versions[user_id]
+
+    def count_expenses(self, user_id=None):
+        if user_id is None:
+            return len(self._expenses)
+        return sum(1 for record in self._expenses if record.user_id == user_id)
+
+class ConnectionPool:
+    """Fixed-size pool of SQLite connections shared between threads"""
+
+    def __init__(self, path, size=8):
+        self.path = path
+        self._pool = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+class SQLiteStore(ExpenseStore):
+    """SQLite-backed store (WAL mode) that several worker processes can share"""
+
+    def __init__(self, path, pool_size=8):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.pool = ConnectionPool(path, size=pool_size)
+
+        with self.pool.connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS receipts (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL DEFAULT 'default',
+                    date TEXT NOT NULL,
+                    merchant TEXT NOT NULL,
+                    total_amount REAL NOT NULL,
+                    currency TEXT,
+                    items TEXT NOT NULL,
+                    raw_text TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS expenses (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    receipt_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL DEFAULT 'default',
+                    date TEXT NOT NULL,
+                    merchant TEXT NOT NULL,
+                    amount REAL NOT NULL,
+                    category TEXT NOT NULL,
+                    degraded INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date);
+                CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses (category);
+                CREATE INDEX IF NOT EXISTS idx_expenses_merchant ON expenses (merchant);
+                CREATE INDEX IF NOT EXISTS idx_expenses_receipt_id ON expenses (receipt_id);
+                CREATE TABLE IF NOT EXISTS store_meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO store_meta (key, value) VALUES ('version', 0);
+            """)
+            # Databases created before receipts carried a currency or a user id
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(receipts)")]
+            if "currency" not in columns:
+                conn.execute("ALTER TABLE receipts ADD COLUMN currency TEXT")
+            # ... or expenses recorded whether their category was a degraded guess
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(expenses)")]
+            if "degraded" not in columns:
+                conn.execute("ALTER TABLE expenses ADD COLUMN degraded INTEGER NOT NULL DEFAULT 0")
+            for table in ("receipts", "expenses"):
+                columns = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if "user_id" not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN user_id TEXT NOT NULL DEFAULT 'default'")
+                    if table == "expenses":
+                        # Existing data now belongs to the default user
+                        conn.execute(
+                            "INSERT OR IGNORE INTO store_meta (key, value) "
+                            "SELECT 'version:default', value FROM store_meta WHERE key = 'version'"
+                        )
+            # Per-user reads scan only that user's rows
+            conn.executescript("""
+                CREATE INDEX IF NOT EXISTS idx_expenses_user_seq ON expenses (user_id, seq);
+                CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date);
+                CREATE INDEX IF NOT EXISTS idx_expenses_user_category ON expenses (user_id, category);
+                CREATE INDEX IF NOT EXISTS idx_expenses_user_merchant ON expenses (user_id, merchant);
+            """)
+
+    def add(self, receipt, expense):
+        user_id = expense.get("user_id", DEFAULT_USER)
+        with self.pool.connection() as conn, conn:
+            conn.execute(
+                "INSERT INTO receipts (id, user_id, date, merchant, total_amount, currency, items, raw_text) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (receipt["id"], user_id, receipt["date"], receipt["merchant"], receipt["total_amount"],
+                 receipt.get("currency"), json.dumps(receipt["items"]), receipt["raw_text"])
+            )
+            conn.execute(
+                f"INSERT INTO expenses ({', '.join(EXPENSE_FIELDS)}) VALUES ({', '.join('?' * len(EXPENSE_FIELDS))})",
+                tuple(expense.get("user_id", DEFAULT_USER) if field == "user_id"
+                      else bool(expense.get("degraded")) if field == "degraded" else expense[field]
+                      for field in EXPENSE_FIELDS)
+            )
+            conn.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'version'")
+            conn.execute(
+                "INSERT INTO store_meta (key, value) VALUES (?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + 1",
+                (f"version:{user_id}",)
+            )
+
+    def get_receipt(self, receipt_id, user_id=None):
+        sql, params = "SELECT * FROM receipts WHERE id = ?", [receipt_id]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        with self.pool.connection() as conn:
+            row = conn.execute(sql, params).fetchone()
+        if row is None:
+            return None
+        receipt = dict(row)
+        receipt["items"] = json.loads(receipt["items"])
+        return receipt
+
+    def page_expenses(self, limit, after=None, user_id=None, category=None, merchant=None, start_date=None,
+                      end_date=None, min_amount=None, max_amount=None):
+        # Positions are expense sequence numbers, so paging is a keyset scan
+        clauses, params = [], []
+        for clause, value in (
+            ("user_id = ?", user_id),
+            ("seq > ?", after),
+            ("category = ?", category),
+            ("merchant = ?", merchant),
+            ("date >= ?", start_date),
+            ("date <= ?", end_date),
+            ("amount >= ?", min_amount),
+            ("amount <= ?", max_amount),
+        ):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+
+        sql = f"SELECT seq, {', '.join(EXPENSE_FIELDS)} FROM expenses"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY seq LIMIT ?"
+        params.append(limit + 1)
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        next_after = rows[limit - 1]["seq"] if len(rows) > limit else None
+        return [expense_from_row(row) for row in rows[:limit]], next_after
+
+    def changes_since(self, position, limit=1000, user_id=None):
+        sql, params = f"SELECT seq, {', '.join(EXPENSE_FIELDS)} FROM expenses WHERE seq > ?", [position or 0]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql + " ORDER BY seq LIMIT ?", params + [limit]).fetchall()
+        if not rows:
+            return [], position or 0
+        return [expense_from_row(row) for row in rows], rows[-1]["seq"]
+
+    def data_version(self, user_id=None):
+        key = "version" if user_id is None else f"version:{user_id}"
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT value FROM store_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def count_expenses(self, user_id=None):
+        with self.pool.connection() as conn:
+            if user_id is None:
+                return conn.execute("SELECT COUNT(*) FROM expenses").fetchone()[0]
+            return conn.execute("SELECT COUNT(*) FROM expenses WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+class UserStore(ExpenseStore):
+    """One user's view of a store: every read and write is scoped to ``user_id``"""
+
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+
+    def add(self, receipt, expense):
+        receipt["user_id"] = expense["user_id"] = self.user_id
+        self.store.add(receipt, expense)
+
+    def get_receipt(self, receipt_id, user_id=None):
+        return self.store.get_receipt(receipt_id, user_id=self.user_id)
+
+    def page_expenses(self, limit, after=None, user_id=None, **filters):
+        return self.store.page_expenses(limit, after=after, user_id=self.user_id, **filters)
+
+    def changes_since(self, position, limit=1000, user_id=None):
+        return self.store.changes_since(position, limit=limit, user_id=self.user_id)
+
+    def data_version(self, user_id=None):
+        return self.store.data_version(user_id=self.user_id)
+
+    def count_expenses(self, user_id=None):
+        return self.store.count_expenses(user_id=self.user_id)
+
+class ShardedStore:
+    """Routes each user to one of ``shards`` stores by a stable hash of the user id
+
+    A node opens only the shards listed in ``owned`` (all by default), so
+    several nodes can split users between them; ``owns`` tells a node
+    whether a user's data lives on it.
+    """
+
+    def __init__(self, factory, shards=1, owned=None):
+        self.shards = shards
+        self.owned = set(range(shards)) if owned is None else set(owned)
+        self._stores = {number: factory(number) for number in sorted(self.owned)}
+
+    def shard_for(self, user_id):
+        return shard_for(user_id, self.shards)
+
+    def owns(self, user_id):
+        return self.shard_for(user_id) in self.owned
+
+    def for_user(self, user_id):
+        """Return the scoped store for a user whose shard this node owns"""
+        shard = self.shard_for(user_id)
+        if shard not in self._stores:
+            raise KeyError(f"shard {shard} for user {user_id!r} is not served by this node")
+        return UserStore(self._stores[shard], user_id)
+
+    def stores(self):
+        """Return the (shard, store) pairs open on this node"""
+        return sorted(self._stores.items())
+
+def parse_shard_list(value, shards):
+    """Parse a node's shard assignment such as "0-3,8" (empty means all shards)"""
+    if not value:
+        return None
+    owned = set()
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-", 1)
+            owned.update(range(int(first), int(last) + 1))
+        elif part:
+            owned.add(int(part))
+    if not owned or min(owned) < 0 or max(owned) >= shards:
+        raise ValueError(f"Shard list {value!r} must name shards between 0 and {shards - 1}")
+    return owned
+
+def create_store(backend="sqlite", path="data/expenses.db", pool_size=8, shards=1, owned_shards=None):
+    """Create the configured storage backend, sharded by user
+
+    With one shard the store lives at ``path``; otherwise shard ``n`` lives
+    next to it as ``<name>-<n>.db``.
+    """
+    if backend not in ("memory", "sqlite"):
+        raise ValueError(f"Unknown expense store backend: {backend}")
+    root, extension = os.path.splitext(path)
+
+    def open_shard(number):
+        if backend == "memory":
+            return MemoryStore()
+        shard_path = path if shards == 1 else f"{root}-{number:02d}{extension or '.db'}"
+        return SQLiteStore(shard_path, pool_size=pool_size)
+
+    return ShardedStore(open_shard, shards=shards, owned=owned_shards)
@@ -0,0 +1,68 @@
+import threading
+
+from aggregates import SpendingAggregates
+from cache import LRUCache
+
+class Tenant:
+    """One user's slice of the app: a scoped store plus derived state
+
+    The aggregates and the analytics columns hold only this user's
+    expenses, so summaries and dashboards cost O(that user's data).
+    """
+
+    def __init__(self, user_id, store):
+        self.user_id = user_id
+        self.store = store
+        self.aggregates = SpendingAggregates()
+        self.analytics = None
+        self._lock = threading.Lock()
+
+    def catch_up(self):
+        """Fold this user's new expenses into the aggregates"""
+        self.aggregates.catch_up(self.store)
+
+    def columns(self):
+        """Return the user's columnar analytics store, built on first use"""
+        with self._lock:
+            if self.analytics is None:
+                # NumPy is only loaded when a dashboard is first requested
+                from analytics import ExpenseColumns
+                self.analytics = ExpenseColumns()
+        self.analytics.catch_up(self.store)
+        return self.analytics
+
+class TenantRegistry:
+    """Per-user state for the users this process has seen recently
+
+    Tenants are kept in an LRU so memory stays bounded by
+    ``max_tenants``; an evicted user's state is rebuilt from the store
+    on their next request.
+    """
+
+    def __init__(self, store, max_tenants=1000):
+        self.store = store
+        self._tenants = LRUCache(max_entries=max_tenants)
+        self._lock = threading.Lock()
+
+    def owns(self, user_id):
+        return self.store.owns(user_id)
+
+    def shard_for(self, user_id):
+        return self.store.shard_for(user_id)
+
+    def get(self, user_id):
+        tenant = self._tenants.get(user_id)
+        if tenant is None:
+            with self._lock:
+                tenant = self._tenants.get(user_id)
+                if tenant is None:
+                    tenant = Tenant(user_id, self.store.for_user(user_id))
+                    self._tenants.set(user_id, tenant)
+        return tenant
+
+    def stats(self):
+        return dict(
+            self._tenants.stats(),
+            shards=self.store.shards,
+            owned_shards=sorted(self.store.owned)
+        )